@@ -0,0 +1 @@
+"""benchmarks of the zhongkui-file hot paths, see `bench.py`"""
@@ -0,0 +1,240 @@
+"""benchmarks of the `File` and `scan.py` hot paths
+
+    $ python -m benchmarks.bench -o benchmarks/results.json
+    $ python -m benchmarks.bench --baseline benchmarks/baseline.json
+
+Each benchmark runs on the files of the corpus kinds it applies to, on a
+fresh `File` per call, so no cached result is measured. Results are
+latency percentiles in seconds and throughput. With a baseline, a
+benchmark whose median latency grew by more than `--threshold` is a
+regression and the exit code is 1.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from zhongkui.file import File, __version__
+from zhongkui.file.exiftool import ExiftoolPool
+from zhongkui.file.scan import (diecScan, exiftoolScan, isProbablyPackedPE,
+                                loadPE, magicScan, pefileScan, ssdeepScan,
+                                tridScan)
+from zhongkui.file.sniff import SNIFF_SIZE, sniffFileType
+from .corpus import CORPUS, generate
+
+log = logging.getLogger(__name__)
+
+ALL = tuple(CORPUS)
+PE = ("pe_sections", "pe_overlay")
+TOOLS = ("exiftool", "trid", "diec")
+
+
+def _sniff(path):
+    with open(path, "rb") as f:
+        return sniffFileType(f.read(SNIFF_SIZE))
+
+
+def _calcEntropy(path):
+    sample = File(path)
+    return sample.calcEntropy(sample.fileData)
+
+
+def _isProbablyPacked(path):
+    pe = loadPE(path)
+    try:
+        return isProbablyPackedPE(pe)
+    finally:
+        pe.close()
+
+
+# name: (corpus kinds, external tools, function of a path)
+BENCHMARKS: Dict[str, Tuple[Tuple[str, ...], Tuple[str, ...], Callable]] = {
+    "calcHashes": (ALL, (), lambda path: File(path).calcHashes()),
+    "calcEntropy": (ALL, (), _calcEntropy),
+    "entropyProfile":
+    (ALL, (), lambda path: File(path).analyseStream(hashes=False)),
+    "isProbablyPacked": (PE, (), _isProbablyPacked),
+    "pefileScan": (PE, (), pefileScan),
+    "sniffFileType": (ALL, (), _sniff),
+    "magicScan": (ALL, (), magicScan),
+    "ssdeepScan": (ALL, (), ssdeepScan),
+    "exiftoolScan": (ALL, ("exiftool", ), exiftoolScan),
+    "tridScan": (ALL, ("trid", ), tridScan),
+    "diecScan": (ALL, ("diec", ), diecScan),
+    "getAllInfo": (ALL, TOOLS, lambda path: File(path).getAllInfo()),
+    "getAllInfo_concurrent":
+    (ALL, TOOLS, lambda path: File(path).getAllInfo(concurrent=True)),
+}
+
+
+def percentile(values: List[float], q: float) -> float:
+    """linear interpolation between the closest ranks, `q` in [0, 100]"""
+    values = sorted(values)
+    if not values:
+        return 0.0
+    rank = (len(values) - 1) * q / 100
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def runBenchmark(func: Callable, paths: List[str],
+                 repeat: int) -> Dict[str, Any]:
+    """time `func` on every path `repeat` times after one warm-up call"""
+    func(paths[0])
+    latencies = []
+    size = 0
+    for _ in range(repeat):
+        for path in paths:
+            start = time.perf_counter()
+            func(path)
+            latencies.append(time.perf_counter() - start)
+            size += os.path.getsize(path)
+    total = sum(latencies)
+    return {
+        "calls": len(latencies),
+        "mean": total / len(latencies),
+        "p50": percentile(latencies, 50),
+        "p90": percentile(latencies, 90),
+        "p99": percentile(latencies, 99),
+        "max": max(latencies),
+        "filesPerSecond": len(latencies) / total if total else 0.0,
+        "mbPerSecond": size / total / 1024 / 1024 if total else 0.0,
+    }
+
+
+def run(corpus: Dict[str, List[str]],
+        repeat=3,
+        only: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Run the benchmarks on a corpus from `generate`.
+    Return:
+        results keyed by benchmark, then by corpus kind
+    """
+    results = {}
+    for name, (kinds, tools, func) in BENCHMARKS.items():
+        if only and name not in only:
+            continue
+        missing = [tool for tool in tools if shutil.which(tool) is None]
+        if missing:
+            results[name] = {"skipped": "missing " + ",".join(missing)}
+            log.warning("skip {}: missing {}".format(name, missing))
+            continue
+        results[name] = {}
+        for kind in kinds:
+            if corpus.get(kind):
+                log.info("run {} on {}".format(name, kind))
+                results[name][kind] = runBenchmark(func, corpus[kind], repeat)
+    return results
+
+
+def compare(results: Dict[str, Any],
+            baseline: Dict[str, Any],
+            threshold=0.1) -> List[Dict[str, Any]]:
+    """Compare median latencies with a baseline.
+    Return:
+        one entry per benchmark and kind found in both, `regression` is
+        set when the median grew by more than `threshold`
+    """
+    changes = []
+    for name, kinds in results.items():
+        for kind, result in kinds.items():
+            base = baseline.get(name, {}).get(kind)
+            if not isinstance(result, dict) or not isinstance(base, dict):
+                continue
+            if not base.get("p50"):
+                continue
+            ratio = result["p50"] / base["p50"]
+            changes.append({
+                "benchmark": name,
+                "kind": kind,
+                "baseline": base["p50"],
+                "current": result["p50"],
+                "ratio": ratio,
+                "regression": ratio > 1 + threshold,
+            })
+    return changes
+
+
+def parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.bench")
+    parser.add_argument("--corpus",
+                        default=str(Path(__file__).parent.joinpath("corpus")),
+                        help="corpus directory, generated if missing")
+    parser.add_argument("--seed", type=int, default=0, help="corpus seed")
+    parser.add_argument("--scale",
+                        type=float,
+                        default=1.0,
+                        help="multiplies the corpus file sizes")
+    parser.add_argument("-r",
+                        "--repeat",
+                        type=int,
+                        default=3,
+                        help="passes over the corpus per benchmark")
+    parser.add_argument("-b",
+                        "--benchmark",
+                        action="append",
+                        help="run only these benchmarks")
+    parser.add_argument("-o", "--output", help="JSON results file")
+    parser.add_argument("--baseline", help="JSON results to compare with")
+    parser.add_argument("--threshold",
+                        type=float,
+                        default=0.1,
+                        help="median slowdown counted as a regression")
+    return parser
+
+
+def main(argv=None) -> int:
+    args = parser().parse_args(argv)
+    logging.basicConfig(stream=sys.stderr,
+                        level=logging.INFO,
+                        format="%(asctime)s %(levelname)s %(message)s")
+    # scanners log every call
+    logging.getLogger("zhongkui").setLevel(logging.WARNING)
+
+    corpus = generate(args.corpus, args.seed, args.scale)
+    try:
+        results = run(corpus, args.repeat, args.benchmark)
+    finally:
+        ExiftoolPool.shutdown()
+    report = {
+        "meta": {
+            "version": __version__,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "seed": args.seed,
+            "scale": args.scale,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+
+    status = 0
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        report["comparison"] = compare(results, baseline, args.threshold)
+        for change in report["comparison"]:
+            log.info("{benchmark} {kind}: {ratio:.2f}x{flag}".format(
+                flag=" REGRESSION" if change["regression"] else "",
+                **change))
+            if change["regression"]:
+                status = 1
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,145 @@
+"""synthetic benchmark corpus
+
+Every file is generated from a seed, the same seed and scale give the
+same corpus on every machine:
+
+    random/       incompressible data, the worst case of entropy passes
+    lowentropy/   text-like data from a small alphabet
+    pe_sections/  PE32 files with many small sections
+    pe_overlay/   PE32 files with a large overlay after the sections
+    tiny/         files of a few bytes, per-file overhead dominates
+"""
+import os
+import json
+import random
+import struct
+from pathlib import Path
+from typing import Dict, List
+
+MB = 1024 * 1024
+FILE_ALIGNMENT = 0x200
+SECTION_ALIGNMENT = 0x1000
+IMAGE_BASE = 0x400000
+
+# kind: (files, bytes at scale 1), sections for `pe_sections`
+CORPUS = {
+    "random": (4, 4 * MB),
+    "lowentropy": (4, 4 * MB),
+    "pe_sections": (4, 64),
+    "pe_overlay": (2, 16 * MB),
+    "tiny": (64, 512),
+}
+
+MANIFEST = "corpus.json"
+
+
+def _align(value: int, alignment: int) -> int:
+    return (value + alignment - 1) // alignment * alignment
+
+
+def randomData(rng: random.Random, size: int) -> bytes:
+    return rng.getrandbits(size * 8).to_bytes(size, "little") if size else b""
+
+
+def lowEntropyData(rng: random.Random, size: int) -> bytes:
+    """a random 4 KB block of a small alphabet, repeated"""
+    block = bytes(rng.choice(b"etaoin shrdlu\n") for _ in range(4096))
+    return (block * (size // len(block) + 1))[:size]
+
+
+def buildPE(sections: List[bytes], overlay: bytes = b"",
+            timestamp=0x2a425e19) -> bytes:
+    """A minimal PE32 executable, one section per data block.
+    Args:
+        sections: raw data of each section
+        overlay: data appended after the last section
+    """
+    count = len(sections)
+    headers_size = _align(0x40 + 4 + 20 + 224 + 40 * count, FILE_ALIGNMENT)
+    raw_sizes = [_align(len(data), FILE_ALIGNMENT) for data in sections]
+    virtual_sizes = [_align(max(len(data), 1), SECTION_ALIGNMENT)
+                     for data in sections]
+    image_size = SECTION_ALIGNMENT + sum(virtual_sizes)
+
+    dos = bytearray(0x40)
+    dos[:2] = b"MZ"
+    struct.pack_into("<I", dos, 0x3c, 0x40)
+    coff = struct.pack("<4sHHIIIHH", b"PE\0\0", 0x14c, count, timestamp, 0,
+                       0, 224, 0x0102)
+    optional = struct.pack("<HBBIIIIIIIIIHHHHHHIIIIHHIIIIII", 0x10b, 14, 0,
+                           raw_sizes[0] if count else 0, 0, 0,
+                           SECTION_ALIGNMENT, SECTION_ALIGNMENT,
+                           SECTION_ALIGNMENT, IMAGE_BASE, SECTION_ALIGNMENT,
+                           FILE_ALIGNMENT, 4, 0, 0, 0, 4, 0, 0, image_size,
+                           headers_size, 0, 2, 0, 0x100000, 0x1000, 0x100000,
+                           0x1000, 0, 16) + bytes(16 * 8)
+
+    table = bytearray()
+    body = bytearray()
+    virtual_address = SECTION_ALIGNMENT
+    for index, data in enumerate(sections):
+        table += struct.pack("<8sIIIIIIHHI", ".s{}".format(index).encode(),
+                             len(data), virtual_address, raw_sizes[index],
+                             headers_size + len(body), 0, 0, 0, 0,
+                             0x60000020)
+        body += data + bytes(raw_sizes[index] - len(data))
+        virtual_address += virtual_sizes[index]
+
+    headers = bytes(dos) + coff + optional + bytes(table)
+    return headers + bytes(headers_size - len(headers)) + bytes(body) + overlay
+
+
+def generate(root, seed=0, scale=1.0) -> Dict[str, List[str]]:
+    """Write the corpus under `root`, a corpus of the same seed and scale
+    is reused.
+    Args:
+        root: corpus directory
+        seed: random seed
+        scale: multiplies the file sizes
+    Return:
+        file paths keyed by kind
+    """
+    root = Path(root)
+    manifest = root.joinpath(MANIFEST)
+    settings = {"seed": seed, "scale": scale}
+    if manifest.exists():
+        saved = json.loads(manifest.read_text())
+        if saved.get("settings") == settings and all(
+                os.path.exists(path) for paths in saved["files"].values()
+                for path in paths):
+            return saved["files"]
+
+    files = {}
+    for kind, (count, size) in CORPUS.items():
+        directory = root.joinpath(kind)
+        os.makedirs(directory, exist_ok=True)
+        files[kind] = []
+        for index in range(count):
+            rng = random.Random("{}:{}:{}".format(seed, kind, index))
+            path = directory.joinpath("{}_{}".format(kind, index))
+            path.write_bytes(_build(kind, rng, size, scale))
+            files[kind].append(str(path))
+
+    manifest.write_text(json.dumps({"settings": settings, "files": files}))
+    return files
+
+
+def _build(kind: str, rng: random.Random, size: int, scale: float) -> bytes:
+    scaled = max(1, int(size * scale))
+    if kind == "random":
+        return randomData(rng, scaled)
+    if kind == "lowentropy":
+        return lowEntropyData(rng, scaled)
+    if kind == "pe_sections":
+        # `size` sections of 16 KB, every other one packed-like
+        return buildPE([
+            randomData(rng, 16 * 1024) if index % 2 else lowEntropyData(
+                rng, 16 * 1024) for index in range(size)
+        ])
+    if kind == "pe_overlay":
+        code = lowEntropyData(rng, 64 * 1024)
+        return buildPE([code, randomData(rng, 16 * 1024)],
+                       overlay=randomData(rng, scaled))
+    if kind == "tiny":
+        return randomData(rng, rng.randint(1, size))
+    raise ValueError("unknown corpus kind: {}".format(kind))
@@ -32,7 +32,10 @@ setup(name="zhongkui-file",
       package_dir={'': 'src/python'},
       include_package_data=True,
       namespace_packages=['zhongkui'],
+      entry_points={
+          "console_scripts": ["zhongkui-file = zhongkui.file.cli:main"]
+      },
       install_requires=[
-          "file-magic >= 0.4.0", "pefile >= 2019.4.18", "pytest",
+          "file-magic >= 0.4.0", "pefile >= 2019.4.18", "numpy", "pytest",
           "jyk-logging"
       ])
@@ -1,5 +1,8 @@
 """zhongkui file package"""
 from .core import File, Storage, TempPath
+from .store import SampleStore
+from .cache import ResultCache, StatIndex
+from .trid import TridIndex
 from .model import FILETYPE
 
 __version__ = "1.1.0"
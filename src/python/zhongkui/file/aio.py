@@ -0,0 +1,472 @@
+"""asyncio scanners and `AsyncFile`
+
+External scanners run with `asyncio.create_subprocess_exec` and are
+killed when their task is cancelled. All scanners of an event loop share
+one semaphore, so many samples can be in flight without a thread each.
+
+The exiftool daemons of a loop are closed when the loop shuts down its
+async generators, as `asyncio.run` does. A loop driven by hand must
+close them before it is closed:
+
+    loop.run_until_complete(AsyncExiftoolPool.shutdown())
+"""
+import os
+import signal
+import asyncio
+import logging
+from asyncio.subprocess import PIPE
+from pathlib import Path
+from typing import Any, Dict, Optional
+from .core import File
+from .elf import elfScan as _elfScan
+from .exceptions import (ZhongkuiScanError, ZhongkuiScanTimeoutError,
+                         ZhongkuiToolMissingError)
+from .exiftool import EXIFTOOL_READY
+from .model import EXIFTOOL, FILETYPE
+from .metrics import addSpawn, stage
+from .profile import resolveProfile
+from .runtime import circuit, fileSize, timeoutFor
+from .trid import TridIndex
+from .scan import _parseDiec, _parseExiftool, _parseTrid
+from .scan import magicScan as _magicScan
+from .scan import pefileScan as _pefileScan
+from .scan import ssdeepScan as _ssdeepScan
+
+log = logging.getLogger(__name__)
+
+SCAN_CONCURRENCY = 16
+
+_concurrency = SCAN_CONCURRENCY
+# values keyed by event loop, semaphores and pools hold their loop
+_semaphores = {}
+_pools = {}
+
+
+def setConcurrency(concurrency: int):
+    """max external scanners running at once in each event loop"""
+    global _concurrency
+    _concurrency = concurrency
+    _semaphores.clear()
+
+
+def _loopValue(values: dict, factory):
+    """value of the running loop, values of closed loops are dropped"""
+    loop = asyncio.get_running_loop()
+    if loop not in values:
+        for closed in [key for key in values if key.is_closed()]:
+            del values[closed]
+        values[loop] = factory()
+    return values[loop]
+
+
+def _semaphore() -> asyncio.Semaphore:
+    return _loopValue(_semaphores, lambda: asyncio.Semaphore(_concurrency))
+
+
+async def _kill(proc):
+    """kill the process group of a scanner and reap it"""
+    if proc.returncode is None:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            try:
+                proc.kill()
+            except ProcessLookupError:
+                pass
+        await proc.wait()
+
+
+async def _run(name, args, size=0, count=1) -> bytes:
+    """run an external scanner and return its stdout, see `runtime.run`
+    Raise:
+        ZhongkuiScanError: the scanner is unavailable, can not start or
+            times out
+    """
+    tool = os.path.basename(str(args[0]))
+    timeout = timeoutFor(tool, size, count)
+    async with _semaphore():
+        with circuit(tool):
+            try:
+                proc = await asyncio.create_subprocess_exec(
+                    *map(str, args), stdout=PIPE, start_new_session=True)
+            except OSError as e:
+                raise ZhongkuiToolMissingError("{} start error: {}".format(
+                    name, e))
+            addSpawn()
+            try:
+                stdout, _ = await asyncio.wait_for(proc.communicate(),
+                                                   timeout)
+            except asyncio.TimeoutError:
+                await _kill(proc)
+                raise ZhongkuiScanTimeoutError(
+                    "{} timeout after {:.1f}s".format(name, timeout))
+            except asyncio.CancelledError:
+                await asyncio.shield(_kill(proc))
+                raise
+
+    return stdout
+
+
+class AsyncExiftoolProcess:
+    """A single `exiftool -stay_open` worker on asyncio pipes"""
+    def __init__(self, executable="exiftool"):
+        self.executable = executable
+        self.proc = None
+
+    @property
+    def running(self) -> bool:
+        return self.proc is not None and self.proc.returncode is None
+
+    async def start(self):
+        try:
+            self.proc = await asyncio.create_subprocess_exec(
+                self.executable, '-stay_open', 'True', '-@', '-',
+                stdin=PIPE, stdout=PIPE, limit=64 * 1024 * 1024,
+                start_new_session=True)
+        except OSError as e:
+            raise ZhongkuiToolMissingError(
+                "exiftool daemon start error: {}".format(e))
+        addSpawn()
+        log.debug("start exiftool daemon, pid: {}".format(self.proc.pid))
+
+    async def close(self):
+        if self.running:
+            self.proc.stdin.write(b"-stay_open\nFalse\n")
+            try:
+                await asyncio.wait_for(self.proc.wait(), 1)
+            except asyncio.TimeoutError:
+                await _kill(self.proc)
+        self.proc = None
+
+    async def kill(self):
+        if self.proc is not None:
+            await _kill(self.proc)
+        self.proc = None
+
+    async def execute(self, *args, timeout: float = 15) -> bytes:
+        """Run one exiftool command, see `ExiftoolProcess.execute`"""
+        if any("\n" in str(arg) for arg in args):
+            raise ZhongkuiScanError(
+                "exiftool daemon can not take newline in arguments")
+        if not self.running:
+            await self.start()
+
+        command = "\n".join(str(arg) for arg in args) + "\n-execute\n"
+        try:
+            self.proc.stdin.write(command.encode("utf-8"))
+            output = await asyncio.wait_for(
+                self.proc.stdout.readuntil(EXIFTOOL_READY + b"\n"), timeout)
+        except asyncio.TimeoutError:
+            await self.kill()
+            raise ZhongkuiScanTimeoutError("exiftool daemon timeout")
+        except asyncio.CancelledError:
+            # the reply of the cancelled command would be read by the next
+            await asyncio.shield(self.kill())
+            raise
+        except (OSError, asyncio.IncompleteReadError,
+                asyncio.LimitOverrunError) as e:
+            await self.kill()
+            raise ZhongkuiScanError("exiftool daemon error: {}".format(e))
+
+        return output[:-len(EXIFTOOL_READY) - 1].rstrip()
+
+
+class AsyncExiftoolPool:
+    """A pool of `AsyncExiftoolProcess` shared by an event loop, closed
+    when the loop shuts down its async generators or by `shutdown`
+    """
+    def __init__(self, size=2, timeout=15, executable="exiftool"):
+        self.timeout = timeout
+        self.workers = [AsyncExiftoolProcess(executable) for _ in range(size)]
+        self.idle = asyncio.Queue()
+        for worker in self.workers:
+            self.idle.put_nowait(worker)
+        self._closing = None
+
+    async def _closeOnShutdown(self):
+        """finalized by `loop.shutdown_asyncgens`"""
+        try:
+            yield
+        finally:
+            await self.close()
+
+    async def execute(self, *args, timeout: Optional[float] = None) -> bytes:
+        if self._closing is None:
+            self._closing = self._closeOnShutdown()
+            await self._closing.asend(None)
+        worker = await self.idle.get()
+        try:
+            return await worker.execute(*args, timeout=timeout or self.timeout)
+        finally:
+            self.idle.put_nowait(worker)
+
+    async def close(self):
+        if _pools.get(asyncio.get_running_loop()) is self:
+            del _pools[asyncio.get_running_loop()]
+        for worker in self.workers:
+            await worker.close()
+
+    @classmethod
+    def get(cls) -> "AsyncExiftoolPool":
+        return _loopValue(_pools, cls)
+
+    @classmethod
+    async def shutdown(cls):
+        """close the pool of the running loop"""
+        pool = _pools.pop(asyncio.get_running_loop(), None)
+        if pool is not None:
+            await pool.close()
+
+
+async def exiftoolScan(target: Path) -> Dict[str, str]:
+    '''async exiftool scan target
+    Raise:
+        ZhongkuiScanError
+    '''
+    size = fileSize(target)
+    if "\n" in str(target):
+        stdout = await _run("exiftoolScan",
+                            ('exiftool', '-charset', 'utf-8', '-json', target),
+                            size)
+    else:
+        async with _semaphore():
+            with circuit("exiftool"):
+                stdout = await AsyncExiftoolPool.get().execute(
+                    '-charset',
+                    'utf-8',
+                    '-json',
+                    os.path.abspath(target),
+                    timeout=timeoutFor("exiftool", size))
+    log.info("finish exftoolScan...")
+    return _parseExiftool(stdout)
+
+
+async def tridScan(target: Path) -> Dict[str, str]:
+    '''async trid scan target, in the default executor if a `TridIndex`
+    is set
+    Raise:
+        ZhongkuiScanError
+    '''
+    index = TridIndex.get()
+    if index is not None:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, index.scan, target)
+
+    stdout = await _run("tridScan", ('trid', target), fileSize(target))
+    try:
+        results = _parseTrid(
+            stdout.decode('utf-8', errors='ignore').splitlines())
+    except Exception as e:
+        log.error("tridScan parse error: {}".format(e))
+        raise ZhongkuiScanError("tridScan parse error: {}".format(e))
+
+    log.info("finish tridScan...")
+    return results
+
+
+async def diecScan(target: Path) -> Dict[str, str]:
+    '''async diec scan target
+    Raise:
+        ZhongkuiScanError
+    '''
+    stdout = await _run("diecScan", ('diec', target), fileSize(target))
+    log.info("finish diecScan...")
+    return _parseDiec(stdout)
+
+
+async def magicScan(target: Path) -> Dict[str, str]:
+    '''async magic scan target in the default executor
+    Raise:
+        ZhongkuiScanError
+    '''
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, _magicScan, target)
+
+
+async def pefileScan(target: Path) -> Dict[str, Any]:
+    '''async pefile scan target in the default executor
+    Raise:
+        ZhongkuiScanError
+    '''
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, _pefileScan, target)
+
+
+async def elfScan(target: Path) -> Dict[str, Any]:
+    '''async elf scan target in the default executor
+    Raise:
+        ZhongkuiScanError
+    '''
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, _elfScan, target)
+
+
+async def ssdeepScan(target: Path) -> Dict[str, str]:
+    '''async ssdeep scan target in the default executor
+    Raise:
+        ZhongkuiScanError
+    '''
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, _ssdeepScan, target)
+
+
+class AsyncFile:
+    """asyncio counterpart of `File`
+
+        info = await AsyncFile(path).getAllInfo()
+
+    Scanner results are cached on the wrapped `file`, so its sync API
+    returns them without running the scanners again.
+    """
+    def __init__(self, file_path, **kwargs):
+        """
+        Args:
+            file_path: file path
+            kwargs: `File` arguments
+        """
+        self.file = file_path if isinstance(file_path, File) else File(
+            file_path, **kwargs)
+        self._stream = None
+        self._tasks = {}
+
+    async def analyseStream(self):
+        """hashes and entropy profile in the default executor"""
+        file = self.file
+        if file._md5 is None or file._entropy_profile is None:
+            if self._stream is None:
+                loop = asyncio.get_running_loop()
+                self._stream = loop.run_in_executor(None, file.analyseStream)
+            await asyncio.shield(self._stream)
+
+    async def _scan(self, name, func):
+        """async `File._scan`, concurrent callers share one scanner run
+        Args:
+            name: scanner name
+            func: coroutine function of the scanner, only called when the
+                result is not cached
+        """
+        if getattr(self.file, "_" + name) is None:
+            task = self._tasks.get(name)
+            if task is None or (task.done() and
+                                (task.cancelled() or task.exception())):
+                task = asyncio.ensure_future(self._runScan(name, func))
+                self._tasks[name] = task
+            await task
+        return getattr(self.file, "_" + name)
+
+    async def _runScan(self, name, func):
+        """run a scanner, consults the result cache like `File._scan`"""
+        file = self.file
+        # the task has its own context, stages of concurrent scanners
+        # count their bytes and spawns apart
+        with stage(name) as timing:
+            result = None
+            if file.resultCache is not None:
+                await self.analyseStream()
+                result = file._cacheGet(name)
+            if result is None:
+                result = await func()
+                file._cachePut(name, result)
+        setattr(file, "_" + name, result)
+        file._timings[name] = timing
+
+    async def _path(self):
+        """`File.file_path`, an in-memory file is written in the default
+        executor
+        """
+        if self.file._file_path is not None:
+            return self.file._file_path
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, lambda: self.file.file_path)
+
+    async def _tridScan(self):
+        if TridIndex.get() is not None and self.file.inMemory:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self.file._tridScan)
+        return await tridScan(await self._path())
+
+    async def _magicScan(self):
+        if self.file.inMemory:
+            return await magicScan(self.file._data)
+        return await magicScan(await self._path())
+
+    async def _exiftoolScan(self):
+        return await exiftoolScan(await self._path())
+
+    async def _diecScan(self):
+        return await diecScan(await self._path())
+
+    async def _pefileScan(self):
+        # the PE is loaded in the executor, it is shared with `File.pe`
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, lambda: _pefileScan(self.file.pe))
+
+    async def _elfScan(self):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None,
+                                          lambda: _elfScan(self.file.elf))
+
+    async def getTrid(self):
+        return await self._scan("trid", self._tridScan)
+
+    async def getMagic(self):
+        return await self._scan("magic", self._magicScan)
+
+    async def getExiftool(self):
+        return await self._scan("exiftool", self._exiftoolScan)
+
+    async def getDiec(self):
+        return await self._scan("diec", self._diecScan)
+
+    async def fileType(self):
+        """async `File.fileType`"""
+        file_type = self.file.sniffedType
+        if file_type is None:
+            exiftool = await self.getExiftool()
+            file_type = exiftool.get(EXIFTOOL.FILETYPE)
+        return file_type
+
+    async def getPefile(self):
+        if await self.fileType() in FILETYPE.PE:
+            return await self._scan("pefile", self._pefileScan)
+        return self.file._pefile
+
+    async def getElf(self):
+        if await self.fileType() in FILETYPE.ELF:
+            return await self._scan("elfinfo", self._elfScan)
+        return self.file._elfinfo
+
+    async def getBasicInfo(self, profile=None) -> Dict[str, Any]:
+        """file basic info, scanners run concurrently
+        Args:
+            profile: analysis profile, see `resolveProfile`
+        """
+        scanners = resolveProfile(profile)
+        scans = {
+            "exiftool": self.getExiftool,
+            "trid": self.getTrid,
+            "magic": self.getMagic,
+            "diec": self.getDiec,
+        }
+        await asyncio.gather(
+            self.analyseStream(),
+            *(scan() for name, scan in scans.items() if name in scanners))
+        return self.file.getBasicInfo(profile=scanners)
+
+    async def getAllInfo(self, timings=False, profile=None) -> Dict[str, Any]:
+        """file all info, scanners run concurrently
+        Args:
+            timings: add the `timings` of the scanners
+            profile: analysis profile, see `resolveProfile`
+        """
+        scanners = resolveProfile(profile)
+        scans = [self.getBasicInfo(scanners)]
+        # without exiftool only a sniffed type routes pefile and elfScan
+        if "exiftool" in scanners or self.file.sniffedType is not None:
+            if "pefile" in scanners:
+                scans.append(self.getPefile())
+            if "elfinfo" in scanners:
+                scans.append(self.getElf())
+        await asyncio.gather(*scans)
+        return self.file.getAllInfo(timings=timings, profile=scanners)
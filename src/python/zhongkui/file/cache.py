@@ -0,0 +1,351 @@
+"""persistent scanner result cache and file stat index"""
+import os
+import json
+import time
+import shutil
+import sqlite3
+import logging
+import threading
+import magic
+import pefile
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from .model import SCAN
+from .trid import TridIndex
+
+log = logging.getLogger(__name__)
+
+CACHE_MAX_SIZE = 256 * 1024 * 1024
+CACHE_TTL = 30 * 24 * 3600
+# a hit refreshes the LRU time of a result at most this often
+CACHE_ACCESS_RESOLUTION = 60
+
+# external tools whose binary a scanner result depends on
+SCANNER_TOOLS = {
+    "exiftool": ("exiftool", ),
+    "trid": ("trid", ),
+    "diec": ("diec", ),
+    "magic": (),
+    "pefile": (),
+    "elfinfo": (),
+    "basic": ("exiftool", "trid", "diec"),
+}
+
+_versions = {}
+
+
+def _toolVersion(tool: str) -> str:
+    """path and mtime of a tool binary, changes when the tool is updated"""
+    path = shutil.which(tool)
+    if path is None:
+        return "{}:missing".format(tool)
+    return "{}:{}:{}".format(tool, path, os.stat(path).st_mtime_ns)
+
+
+def scannerVersion(scanner: str) -> str:
+    """version string of a scanner, a cached result of an other version
+    is invalid
+    """
+    if scanner not in _versions:
+        from . import __version__
+        parts = [__version__]
+        parts.extend(
+            _toolVersion(tool) for tool in SCANNER_TOOLS.get(scanner, ()))
+        if scanner in ("magic", "basic"):
+            parts.append("libmagic:{}".format(
+                getattr(magic, "version", lambda: "")()))
+        if scanner == "pefile":
+            parts.append("pefile:{}".format(pefile.__version__))
+        _versions[scanner] = "|".join(parts)
+    index = TridIndex.get()
+    if index is not None and scanner in ("trid", "basic"):
+        # in-process matches depend on the definitions, not the binary
+        return "{}|triddefs:{}".format(_versions[scanner], index.digest)
+    return _versions[scanner]
+
+
+class ResultCache:
+    """sqlite cache of scanner results, keyed by sha256 and scanner name.
+
+    Results expire after `ttl` seconds or when the scanner version
+    changes, and least recently used results are evicted beyond
+    `max_size` bytes.
+    """
+    _cache = None
+    _lock = threading.Lock()
+
+    def __init__(self, path, max_size=CACHE_MAX_SIZE, ttl=CACHE_TTL):
+        """
+        Args:
+            path: sqlite database path
+            max_size: max bytes of cached results
+            ttl: seconds a result stays valid, `None` for no limit
+        """
+        self.path = Path(path)
+        self.max_size = max_size
+        self.ttl = ttl
+        self.pid = os.getpid()
+        self._db_lock = threading.Lock()
+        if not self.path.parent.exists():
+            os.makedirs(self.path.parent)
+        self.db = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS results (
+            sha256 TEXT NOT NULL,
+            scanner TEXT NOT NULL,
+            version TEXT NOT NULL,
+            value TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            created REAL NOT NULL,
+            accessed REAL NOT NULL,
+            PRIMARY KEY (sha256, scanner))""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS results_accessed "
+                        "ON results (accessed)")
+        # total size kept by triggers, shared by every process; the
+        # delete trigger also fires for rows dropped by INSERT OR REPLACE
+        self.db.execute("PRAGMA recursive_triggers = ON")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL)""")
+        if self.db.execute(
+                "SELECT 1 FROM meta WHERE key = 'size'").fetchone() is None:
+            self.db.execute(
+                "INSERT INTO meta SELECT 'size', COALESCE(SUM(size), 0) "
+                "FROM results")
+        self.db.execute("""CREATE TRIGGER IF NOT EXISTS results_insert
+            AFTER INSERT ON results BEGIN
+            UPDATE meta SET value = value + new.size WHERE key = 'size';
+            END""")
+        self.db.execute("""CREATE TRIGGER IF NOT EXISTS results_delete
+            AFTER DELETE ON results BEGIN
+            UPDATE meta SET value = value - old.size WHERE key = 'size';
+            END""")
+        self.db.commit()
+
+    def lookup(self, sha256: str, scanner: str) -> Optional[Any]:
+        """cached result, `None` if missing, expired or outdated"""
+        with self._db_lock:
+            row = self.db.execute(
+                "SELECT version, value, created, accessed FROM results "
+                "WHERE sha256 = ? AND scanner = ?",
+                (sha256, scanner)).fetchone()
+            if row is None:
+                return None
+            version, value, created, accessed = row
+            now = time.time()
+            if (version != scannerVersion(scanner)
+                    or (self.ttl is not None and created + self.ttl < now)):
+                self.db.execute(
+                    "DELETE FROM results WHERE sha256 = ? AND scanner = ?",
+                    (sha256, scanner))
+                self.db.commit()
+                return None
+            if now - accessed > CACHE_ACCESS_RESOLUTION:
+                # hits of a hot result do not commit each time
+                self.db.execute(
+                    "UPDATE results SET accessed = ? "
+                    "WHERE sha256 = ? AND scanner = ?",
+                    (now, sha256, scanner))
+                self.db.commit()
+
+        log.debug("result cache hit: {} {}".format(scanner, sha256))
+        return json.loads(value)
+
+    def store(self, sha256: str, scanner: str, result: Any):
+        """cache a result, `None` and `SCAN.ERROR` results are skipped"""
+        if result is None or (isinstance(result, dict)
+                              and SCAN.ERROR in result):
+            return
+        try:
+            value = json.dumps(result, separators=(",", ":"))
+        except (TypeError, ValueError) as e:
+            log.warning("result cache skip {}: {}".format(scanner, e))
+            return
+
+        now = time.time()
+        with self._db_lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (sha256, scanner, scannerVersion(scanner), value, len(value),
+                 now, now))
+            self._evict()
+            self.db.commit()
+
+    def _evict(self):
+        """drop least recently used results beyond `max_size`"""
+        total = self.db.execute(
+            "SELECT value FROM meta WHERE key = 'size'").fetchone()[0]
+        if total <= self.max_size:
+            return
+        rowids = []
+        rows = self.db.execute(
+            "SELECT rowid, size FROM results ORDER BY accessed")
+        for rowid, size in rows:
+            if total <= self.max_size:
+                break
+            rowids.append((rowid, ))
+            total -= size
+        self.db.executemany("DELETE FROM results WHERE rowid = ?", rowids)
+
+    def stats(self) -> Dict[str, int]:
+        with self._db_lock:
+            count = self.db.execute(
+                "SELECT COUNT(*) FROM results").fetchone()[0]
+            size = self.db.execute(
+                "SELECT value FROM meta WHERE key = 'size'").fetchone()[0]
+        return {"count": count, "size": size}
+
+    def clear(self):
+        with self._db_lock:
+            self.db.execute("DELETE FROM results")
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    @classmethod
+    def set(cls, path, max_size=CACHE_MAX_SIZE, ttl=CACHE_TTL):
+        """enable the shared result cache"""
+        with cls._lock:
+            if cls._cache is not None and cls._cache.pid == os.getpid():
+                cls._cache.close()
+            cls._cache = cls(path, max_size, ttl)
+        return cls._cache
+
+    @classmethod
+    def get(cls) -> Optional["ResultCache"]:
+        """the shared result cache, `None` until `set`"""
+        with cls._lock:
+            cache = cls._cache
+            if cache is not None and cache.pid != os.getpid():
+                # a forked child must not share the sqlite connection
+                cache = cls._cache = cls(cache.path, cache.max_size,
+                                         cache.ttl)
+        return cache
+
+    @classmethod
+    def shutdown(cls):
+        with cls._lock:
+            if cls._cache is not None and cls._cache.pid == os.getpid():
+                cls._cache.close()
+            cls._cache = None
+
+
+def statKey(st: os.stat_result) -> Tuple[int, int, int, int, int]:
+    """(device, inode, size, mtime_ns, ctime_ns), changes with the content"""
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+
+class StatIndex:
+    """sqlite index of file stats and the analysis of their content.
+
+    A file whose `statKey` matches its record is served from the record
+    without being opened.
+    """
+    _index = None
+    _lock = threading.Lock()
+
+    def __init__(self, path):
+        """
+        Args:
+            path: sqlite database path
+        """
+        self.path = Path(path)
+        self.pid = os.getpid()
+        self._db_lock = threading.Lock()
+        if not self.path.parent.exists():
+            os.makedirs(self.path.parent)
+        self.db = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            dev INTEGER NOT NULL,
+            ino INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            ctime_ns INTEGER NOT NULL,
+            value TEXT NOT NULL)""")
+        self.db.commit()
+
+    def lookup(self, path, st: os.stat_result = None) -> Optional[Dict]:
+        """record of an unchanged file, `None` if missing or changed
+        Args:
+            path: file path
+            st: `os.stat` of the file, stat it if not given
+        """
+        path = os.path.abspath(path)
+        try:
+            st = st or os.stat(path)
+        except OSError:
+            return None
+        with self._db_lock:
+            row = self.db.execute(
+                "SELECT dev, ino, size, mtime_ns, ctime_ns, value "
+                "FROM files WHERE path = ?", (path, )).fetchone()
+        if row is None or tuple(row[:5]) != statKey(st):
+            return None
+        return json.loads(row[5])
+
+    def store(self, path, st: os.stat_result, record: Dict):
+        """record the analysis of a file
+        Args:
+            path: file path
+            st: `os.stat` of the file taken before it was read
+            record: JSON serializable analysis, merged into the record of
+                the same stat
+        """
+        path = os.path.abspath(path)
+        record = dict(self.lookup(path, st) or {}, **record)
+        with self._db_lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (path, ) + statKey(st) +
+                (json.dumps(record, separators=(",", ":")), ))
+            self.db.commit()
+
+    def changed(self, paths: Iterable) -> List[str]:
+        """paths that have no record of their current stat"""
+        return [path for path in paths if self.lookup(path) is None]
+
+    def prune(self) -> int:
+        """drop records of files that no longer exist
+        Return:
+            number of dropped records
+        """
+        with self._db_lock:
+            paths = [
+                row[0] for row in self.db.execute("SELECT path FROM files")
+                if not os.path.exists(row[0])
+            ]
+            self.db.executemany("DELETE FROM files WHERE path = ?",
+                                [(path, ) for path in paths])
+            self.db.commit()
+        return len(paths)
+
+    def close(self):
+        self.db.close()
+
+    @classmethod
+    def set(cls, path):
+        """enable the shared stat index"""
+        with cls._lock:
+            if cls._index is not None and cls._index.pid == os.getpid():
+                cls._index.close()
+            cls._index = cls(path)
+        return cls._index
+
+    @classmethod
+    def get(cls) -> Optional["StatIndex"]:
+        """the shared stat index, `None` until `set`"""
+        with cls._lock:
+            index = cls._index
+            if index is not None and index.pid != os.getpid():
+                index = cls._index = cls(index.path)
+        return index
+
+    @classmethod
+    def shutdown(cls):
+        with cls._lock:
+            if cls._index is not None and cls._index.pid == os.getpid():
+                cls._index.close()
+            cls._index = None
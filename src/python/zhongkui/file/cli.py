@@ -0,0 +1,304 @@
+"""zhongkui-file command line
+
+    $ zhongkui-file scan samples/ -o results.jsonl --state scan.db
+
+Samples are hashed and then analysed in a process pool. A sample whose
+sha256 was already analysed is reported as a duplicate, and a path
+recorded in the state database is skipped when a scan is resumed. A
+failed path is not recorded, it is retried by the next scan.
+"""
+import os
+import sys
+import json
+import sqlite3
+import logging
+import argparse
+import itertools
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, Dict, Iterable, Iterator, Optional
+from .core import File
+from .cache import ResultCache, StatIndex
+from .trid import TridIndex
+from .profile import FULL, PROFILES, SCANNERS, resolveProfile
+
+log = logging.getLogger(__name__)
+
+
+class ScanState:
+    """sqlite progress of a scan, for dedupe and resume"""
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS paths ("
+                        "path TEXT PRIMARY KEY, sha256 TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS samples ("
+                        "sha256 TEXT PRIMARY KEY, path TEXT NOT NULL, "
+                        "done INTEGER NOT NULL)")
+        # samples of an interrupted scan are analysed again
+        self.db.execute("DELETE FROM samples WHERE done = 0")
+        self.db.commit()
+
+    def isDone(self, path) -> bool:
+        return self.db.execute("SELECT 1 FROM paths WHERE path = ?",
+                               (path, )).fetchone() is not None
+
+    def claim(self, sha256, path) -> Optional[str]:
+        """claim a sample for analysis
+        Return:
+            `None` if the sample is new, else the path it was claimed by
+        """
+        row = self.db.execute("SELECT path FROM samples WHERE sha256 = ?",
+                              (sha256, )).fetchone()
+        if row is not None:
+            return row[0]
+        self.db.execute("INSERT INTO samples VALUES (?, ?, 0)",
+                        (sha256, path))
+        self.db.commit()
+        return None
+
+    def release(self, sha256):
+        """drop the claim of a sample that failed, its next copy is
+        analysed
+        """
+        self.db.execute("DELETE FROM samples WHERE sha256 = ? AND done = 0",
+                        (sha256, ))
+        self.db.commit()
+
+    def done(self, path, sha256=None):
+        self.db.execute("INSERT OR REPLACE INTO paths VALUES (?, ?)",
+                        (path, sha256))
+        if sha256 is not None:
+            self.db.execute("UPDATE samples SET done = 1 WHERE path = ?",
+                            (path, ))
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+def walk(targets: Iterable[str], lists: Iterable[str] = ()) -> Iterator[str]:
+    """Yield regular, non-empty files under targets and in list files.
+    Args:
+        targets: files or directories
+        lists: files with a path per line, `-` for stdin
+    """
+    def expand(target):
+        if os.path.isdir(target):
+            for root, dirs, files in os.walk(target):
+                dirs.sort()
+                for name in sorted(files):
+                    yield os.path.join(root, name)
+        else:
+            yield target
+
+    def listed():
+        for name in lists:
+            f = sys.stdin if name == "-" else open(name, encoding="utf-8")
+            with f:
+                for line in f:
+                    if line.strip():
+                        yield line.rstrip("\r\n")
+
+    for target in itertools.chain(targets, listed()):
+        for path in expand(target):
+            if os.path.isfile(path) and os.path.getsize(path):
+                yield os.path.abspath(path)
+
+
+def _initWorker(cache, stat_index, trid_defs):
+    if cache:
+        ResultCache.set(cache)
+    if stat_index:
+        StatIndex.set(stat_index)
+    if trid_defs:
+        TridIndex.set(trid_defs)
+
+
+def _hash(path, memory_budget) -> Dict[str, Any]:
+    """first phase, hashes and entropy profile in one read"""
+    sample = File(path, memory_budget=memory_budget)
+    sample.analyseStream()
+    return sample._record()
+
+
+def _analyse(path, record, memory_budget, timings,
+             profile) -> Dict[str, Any]:
+    """second phase, scanners of a new sample"""
+    sample = File(path, memory_budget=memory_budget)
+    sample._loadRecord(record)
+    return sample.getAllInfo(timings=timings, profile=profile)
+
+
+def scan(args) -> int:
+    """Run `zhongkui-file scan`.
+    Return:
+        exit code, 1 if a sample failed
+    """
+    state_path = args.state
+    if state_path is None:
+        fd, state_path = tempfile.mkstemp(prefix="zhongkui-scan-",
+                                          suffix=".db")
+        os.close(fd)
+    state = ScanState(state_path)
+    out = sys.stdout if args.output == "-" else open(
+        args.output, "a", encoding="utf-8")
+    if args.trid_defs:
+        # parsed once here, workers load the cached index
+        TridIndex.set(args.trid_defs)
+    jobs = args.jobs or os.cpu_count()
+    profile = args.scanners or args.profile
+    max_inflight = args.max_inflight or jobs * 4
+    counts = {"scanned": 0, "duplicate": 0, "skipped": 0, "error": 0}
+
+    def emit(record):
+        out.write(json.dumps(record, default=str) + "\n")
+        out.flush()
+
+    targets = walk(args.targets, args.list)
+    pending = {}
+    try:
+        with ProcessPoolExecutor(jobs,
+                                 initializer=_initWorker,
+                                 initargs=(args.cache,
+                                           args.stat_index,
+                                           args.trid_defs)) as pool:
+            while True:
+                # backpressure, only `max_inflight` samples are in flight
+                while len(pending) < max_inflight:
+                    path = next(targets, None)
+                    if path is None:
+                        break
+                    if state.isDone(path):
+                        counts["skipped"] += 1
+                        continue
+                    future = pool.submit(_hash, path, args.memory_budget)
+                    pending[future] = (path, None)
+                if not pending:
+                    break
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path, record = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        log.error("scan {} error: {}".format(path, e))
+                        emit({"path": path, "error": str(e)})
+                        if record is not None:
+                            state.release(record["sha256"])
+                        counts["error"] += 1
+                        continue
+
+                    if record is not None:
+                        emit({
+                            "path": path,
+                            "sha256": record["sha256"],
+                            "info": result
+                        })
+                        state.done(path, record["sha256"])
+                        counts["scanned"] += 1
+                        continue
+
+                    first = state.claim(result["sha256"], path)
+                    if first is None:
+                        future = pool.submit(_analyse, path, result,
+                                             args.memory_budget,
+                                             args.timings, profile)
+                        pending[future] = (path, result)
+                    else:
+                        emit({
+                            "path": path,
+                            "sha256": result["sha256"],
+                            "duplicate": first
+                        })
+                        state.done(path, result["sha256"])
+                        counts["duplicate"] += 1
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        state.close()
+        if args.state is None:
+            os.remove(state_path)
+
+    log.info("scan finished: {}".format(counts))
+    return 1 if counts["error"] else 0
+
+
+def _scanners(value):
+    """`--scanners` argument, a list of valid scanner names"""
+    try:
+        return sorted(resolveProfile(value.split(",")))
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="zhongkui-file")
+    parser.add_argument("-v",
+                        "--verbose",
+                        action="store_true",
+                        help="log progress to stderr")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    scan_parser = commands.add_parser(
+        "scan", help="analyse files and directories, one JSON line each")
+    scan_parser.add_argument("targets",
+                             nargs="*",
+                             help="files or directories to scan")
+    scan_parser.add_argument("-l",
+                             "--list",
+                             action="append",
+                             default=[],
+                             help="file with a path per line, - for stdin")
+    scan_parser.add_argument("-o",
+                             "--output",
+                             default="-",
+                             help="JSONL output file, appended to")
+    scan_parser.add_argument("-j",
+                             "--jobs",
+                             type=int,
+                             help="worker processes, defaults to cpu count")
+    scan_parser.add_argument("--max-inflight",
+                             type=int,
+                             help="samples in flight, defaults to 4 * jobs")
+    scan_parser.add_argument("--state",
+                             help="sqlite progress database to resume from")
+    scan_parser.add_argument("--cache", help="sqlite result cache path")
+    scan_parser.add_argument("--stat-index",
+                             help="sqlite stat index path")
+    scan_parser.add_argument("--trid-defs",
+                             help="TrID XML definitions directory, "
+                             "matched in-process instead of running trid")
+    scan_parser.add_argument("--memory-budget",
+                             type=int,
+                             help="max bytes of a file held in memory")
+    scan_parser.add_argument("--timings",
+                             action="store_true",
+                             help="add scanner timings to each record")
+    scan_parser.add_argument("--profile",
+                             choices=tuple(PROFILES),
+                             default=FULL,
+                             help="analysis profile, defaults to full")
+    scan_parser.add_argument("--scanners",
+                             type=_scanners,
+                             help="comma separated scanners instead of a "
+                             "profile, of: {}".format(",".join(SCANNERS)))
+    scan_parser.set_defaults(func=scan)
+    return parser
+
+
+def main(argv=None) -> int:
+    args = parser().parse_args(argv)
+    logging.basicConfig(
+        stream=sys.stderr,
+        level=logging.INFO if args.verbose else logging.WARNING,
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
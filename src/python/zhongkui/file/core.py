@@ -1,25 +1,35 @@
 import os
-import math
+import mmap
 import shutil
-import hashlib
-import binascii
 import tempfile
 import logging
+import functools
+import threading
 import pefile
 from pathlib import Path
-from collections import Counter
 from dataclasses import asdict
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 from .exceptions import ZhongkuiCriticalError
-from .model import (DIEC, FILETYPE, EXIFTOOL, STATICINFO,
-                    FileinfoBasic)
-from .scan import (exiftoolScan, ssdeepScan, magicScan, pefileScan, tridScan,
-                   diecScan)
+from .model import (DIEC, FILETYPE, EXIFTOOL, STATICINFO, SCAN,
+                    EntropyProfile, FileinfoBasic)
+from .scan import (exiftoolScan, magicScan, pefileScan, tridScan, diecScan,
+                   loadPE)
+from .scheduler import ScanScheduler, ScanTask
+from .profile import PROFILES, STANDARD, resolveProfile
+from .metrics import addBytes, stage
+from .sniff import SNIFF_SIZE, sniffFileType
+from .trid import TridIndex
+from .elf import ELF, elfScan, loadELF
+from .cache import ResultCache, StatIndex, statKey
+from .entropy import EntropyEngine, shannonEntropy
+from .fuzzy import FuzzyHash, compareFuzzyHash
+from .stream import StreamAnalyzer, StreamConsumer, hashConsumers
 from .utils import Singleton
 
 log = logging.getLogger(__name__)
 
 FILE_CHUNK_SIZE = 16 * 1024 * 1024
+STORAGE_CHUNK_SIZE = 4 * 1024 * 1024
 
 
 class TempPath(metaclass=Singleton):
@@ -50,57 +60,87 @@ class Storage:
         return Path(path).name
 
     @staticmethod
-    def tempPut(content, path: Path = None) -> Path:
+    def write(fd: int,
+              content,
+              analyzer: StreamAnalyzer = None,
+              chunk_size=STORAGE_CHUNK_SIZE):
+        """Write content to a file descriptor.
+        Args:
+            fd: file descriptor open for writing
+            content: bytes or a readable stream
+            analyzer: `StreamAnalyzer` fed with each written chunk
+            chunk_size: read size of a stream
+        """
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+        if hasattr(content, "read"):
+            chunks = iter(lambda: content.read(chunk_size), b"")
+        else:
+            chunks = (content, )
+        for chunk in chunks:
+            with memoryview(chunk) as view:
+                written = 0
+                while written < len(view):
+                    written += os.write(fd, view[written:])
+            if analyzer is not None:
+                analyzer.update(chunk)
+
+    @staticmethod
+    def tempPut(content,
+                path: Path = None,
+                analyzer: StreamAnalyzer = None,
+                chunk_size=STORAGE_CHUNK_SIZE) -> Path:
         """Store a temporary file or files.
         Args:
             content: the content of this file
             path: directory path to store the file
+            analyzer: `StreamAnalyzer` fed while writing, see `write`
+            chunk_size: read size of a stream
         Return:
             filepath
         """
         fd, filepath = tempfile.mkstemp(prefix="upload_",
                                         dir=path or TempPath.get())
-
-        if hasattr(content, "read"):
-            chunk = content.read(1024)
-            while chunk:
-                os.write(fd, chunk)
-                chunk = content.read(1024)
-        else:
-            os.write(fd, content)
-
-        os.close(fd)
+        try:
+            Storage.write(fd, content, analyzer, chunk_size)
+        finally:
+            os.close(fd)
         return filepath
 
     @staticmethod
-    def tempNamedPut(content, filename, path: Path = None) -> Path:
+    def tempNamedPut(content,
+                     filename,
+                     path: Path = None,
+                     analyzer: StreamAnalyzer = None,
+                     chunk_size=STORAGE_CHUNK_SIZE) -> Path:
         """Store a named temporary file.
         Args:
             content: the content of this file
             filename: filename that the file should have
             path: directory path to store the file
+            analyzer: `StreamAnalyzer` fed while writing, see `write`
+            chunk_size: read size of a stream
         Return:
             full path to the temporary file
         """
         filename = Storage.getFilenameFromPath(filename)
         dirpath = tempfile.mkdtemp(dir=path or TempPath.get())
-        Storage.create(dirpath, filename, content)
+        Storage.create(dirpath, filename, content, analyzer, chunk_size)
         return Path(dirpath).joinpath(filename)
 
     @staticmethod
-    def create(root, filename, content):
+    def create(root,
+               filename,
+               content,
+               analyzer: StreamAnalyzer = None,
+               chunk_size=STORAGE_CHUNK_SIZE):
         if isinstance(root, (tuple, list)):
             root = Path().joinpath(*root)
 
         filepath = Path(root).joinpath(filename)
-        with open(filepath, "wb") as f:
-            if hasattr(content, "read"):
-                chunk = content.read(1024 * 1024)
-                while chunk:
-                    f.write(chunk)
-                    chunk = content.read(1024 * 1024)
-            else:
-                f.write(content)
+        with open(filepath, "wb", buffering=0) as f:
+            Storage.write(f.fileno(), content, analyzer, chunk_size)
         return filepath
 
     @staticmethod
@@ -130,17 +170,42 @@ class Storage:
 
 class File(Storage):
     """zhongkui basic file class"""
-    def __init__(self, file_path, temporary=False):
+    def __init__(self,
+                 file_path,
+                 temporary=False,
+                 memory_budget=None,
+                 cache=None,
+                 stat_index=None):
         """
         Args:
             file_path: file path.
             temporary: is the file temporary
+            memory_budget: max bytes of file data held in memory,
+                `None` for no limit
+            cache: `ResultCache` of scanner results, defaults to the
+                shared one if it is set
+            stat_index: `StatIndex` of unchanged files, defaults to the
+                shared one if it is set
         """
-        self.file_path = file_path
+        self._file_path = file_path
         self.temporary = temporary
+        self.memory_budget = memory_budget
+        self.cache = cache
+        self.stat_index = stat_index
+
+        # in-memory contents and name, see `fromBytes`
+        self._data = None
+        self._name = None
+        # `mkdtemp` directory of a named temporary file, see `cleanup`
+        self._temp_dir = None
 
         # for cache property
         self._file_data = None
+        self._mmap = None
+        self._view = None
+        self._pe = None
+        self._elf = None
+        self._sniffed = None
         self._crc32 = None
         self._md5 = None
         self._sha256 = None
@@ -148,28 +213,249 @@ class File(Storage):
         self._sha512 = None
         self._ssdeep = None
         self._is_probably_packed = None
+        self._entropy_profile = None
 
         # for cache info
         self._basic = None
         self._trid = None
         self._magic = None
         self._pefile = None
+        self._elfinfo = None
         self._diec = None
-        self._exiftool = exiftoolScan(self.file_path)
+        self._exiftool = None
+
+        # `StageTiming` of each scanner, filled on first access
+        self._timings = {}
+        # concurrent scanners share one view, PE and ELF
+        self._load_lock = threading.RLock()
+
+    @classmethod
+    def fromBytes(cls, data, name=None, **kwargs) -> "File":
+        """Build a file from in-memory contents.
+        Hashes, entropy, magic and pefile run on the contents; a temporary
+        file is only written when a scanner needs a path.
+        Args:
+            data: file contents, a bytes-like object
+            name: file name, defaults to the sha256
+            kwargs: `File` arguments
+        """
+        file = cls(None, **kwargs)
+        file._data = data
+        file._name = name
+        return file
+
+    @classmethod
+    def fromStream(cls, stream, name=None, **kwargs) -> "File":
+        """Build a file from a readable binary stream.
+        A stream larger than `memory_budget` is written to a temporary
+        file instead of memory.
+        Args:
+            stream: readable binary stream
+            name: file name, defaults to the sha256
+            kwargs: `File` arguments
+        """
+        budget = kwargs.get("memory_budget")
+        if budget is None:
+            return cls.fromBytes(stream.read(), name, **kwargs)
+
+        data = stream.read(budget + 1)
+        if len(data) <= budget:
+            return cls.fromBytes(data, name, **kwargs)
+
+        dirpath = tempfile.mkdtemp(dir=TempPath.get())
+        filepath = Path(dirpath).joinpath(
+            Storage.getFilenameFromPath(name or "upload"))
+        with open(filepath, "wb") as f:
+            f.write(data)
+            del data
+            shutil.copyfileobj(stream, f, FILE_CHUNK_SIZE)
+        kwargs["temporary"] = True
+        file = cls(filepath, **kwargs)
+        file._temp_dir = dirpath
+        return file
+
+    @classmethod
+    def ingest(cls,
+               content,
+               filename=None,
+               path: Path = None,
+               entropy=True,
+               chunk_size=STORAGE_CHUNK_SIZE,
+               **kwargs) -> "File":
+        """Store content as a temporary file, hashed while it is written.
+        The file is not read back to hash it.
+        Args:
+            content: bytes or a readable stream
+            filename: filename that the file should have
+            path: directory path to store the file
+            entropy: also compute the entropy profile while writing
+            chunk_size: read size of a stream
+            kwargs: `File` arguments
+        """
+        analyzer = StreamAnalyzer(hashConsumers())
+        if entropy:
+            analyzer.register(EntropyEngine())
+        if filename:
+            filepath = Storage.tempNamedPut(content, filename, path,
+                                            analyzer, chunk_size)
+        else:
+            filepath = Storage.tempPut(content, path, analyzer, chunk_size)
+
+        kwargs["temporary"] = True
+        file = cls(filepath, **kwargs)
+        if filename:
+            file._temp_dir = Path(filepath).parent
+        file._loadStream(analyzer.results())
+        return file
+
+    @property
+    def inMemory(self) -> bool:
+        """the file is built from in-memory contents"""
+        return self._data is not None
+
+    @property
+    def file_path(self):
+        """file path, an in-memory file is written to a temporary file
+        on first access
+        """
+        with self._load_lock:
+            if self._file_path is None and self._data is not None:
+                if self._name:
+                    self._file_path = Storage.tempNamedPut(
+                        self._data, self._name)
+                    self._temp_dir = Path(self._file_path).parent
+                else:
+                    self._file_path = Storage.tempPut(self._data)
+                self.temporary = True
+                log.debug("materialise in-memory file: {}".format(
+                    self._file_path))
+        return self._file_path
+
+    @file_path.setter
+    def file_path(self, file_path):
+        self._file_path = file_path
+
+    def cleanup(self):
+        """delete a temporary file and its `mkdtemp` directory, in-memory
+        contents are kept
+        """
+        if self.temporary and self._file_path is not None:
+            self.releaseData()
+            Storage.delete(self._file_path)
+            if self._temp_dir is not None:
+                try:
+                    os.rmdir(self._temp_dir)
+                except OSError:
+                    pass
+                self._temp_dir = None
+            if self._data is not None:
+                self._file_path = None
+
+    def _scan(self, name, func, *args):
+        """Run a scanner once, cache its result and track its cost.
+        Args:
+            name: cache attribute suffix, e.g. `trid` for `self._trid`
+            func: scanner function
+        Return:
+            the cached scanner result
+        """
+        attr = "_" + name
+        if getattr(self, attr) is None:
+            with stage(name) as timing:
+                result = self._cacheGet(name)
+                if result is None:
+                    result = func(*args)
+                    self._cachePut(name, result)
+            setattr(self, attr, result)
+            self._timings[name] = timing
+        return getattr(self, attr)
+
+    @property
+    def resultCache(self) -> Optional[ResultCache]:
+        return self.cache if self.cache is not None else ResultCache.get()
+
+    def _cacheGet(self, name):
+        """cached result of a scanner, `None` without a result cache"""
+        cache = self.resultCache
+        if cache is None:
+            return None
+        return cache.lookup(self.sha256, name)
+
+    def _cachePut(self, name, result):
+        cache = self.resultCache
+        if cache is not None:
+            cache.store(self.sha256, name, result)
+
+    @property
+    def statIndex(self) -> Optional[StatIndex]:
+        if self.stat_index is not None:
+            return self.stat_index
+        return StatIndex.get()
+
+    def _loadRecord(self, record):
+        """fill hashes, entropy profile and ssdeep from a stat record"""
+        if record is None:
+            return
+        if self._md5 is None and "md5" in record:
+            self._crc32 = record["crc32"]
+            self._md5 = record["md5"]
+            self._sha1 = record["sha1"]
+            self._sha256 = record["sha256"]
+            self._sha512 = record["sha512"]
+        if self._entropy_profile is None and "entropyProfile" in record:
+            self._entropy_profile = EntropyProfile(**record["entropyProfile"])
+        if self._ssdeep is None and "ssdeep" in record:
+            self._ssdeep = record["ssdeep"]
+
+    def _record(self) -> Dict[str, Any]:
+        """stream analysis for the stat index"""
+        record = {}
+        if self._md5 is not None:
+            record.update(crc32=self._crc32,
+                          md5=self._md5,
+                          sha1=self._sha1,
+                          sha256=self._sha256,
+                          sha512=self._sha512)
+        if self._entropy_profile is not None:
+            record["entropyProfile"] = asdict(self._entropy_profile)
+        if self._ssdeep is not None:
+            record["ssdeep"] = self._ssdeep
+        return record
 
     def isValid(self):
+        if self.inMemory:
+            return len(self._data) != 0
         return (self.file_path and Path(self.file_path).exists()
                 and Path(self.file_path).is_file()
                 and os.path.getsize(self.file_path) != 0)
 
+    @property
+    def chunkSize(self) -> int:
+        """read size of `getChunks`, a fraction of the memory budget"""
+        if self.memory_budget is None:
+            return FILE_CHUNK_SIZE
+        return max(4096, min(FILE_CHUNK_SIZE, self.memory_budget // 4))
+
     def getChunks(self):
-        """Read file contents in chunks (generator)."""
+        """Read file contents in chunks (generator).
+        Chunks are slices of `view` and are released once the next chunk
+        is asked for, a consumer keeping data must copy it.
+        """
+        chunk_size = self.chunkSize
+        view = self.view
+        if view is not None:
+            for start in range(0, len(view), chunk_size):
+                with view[start:start + chunk_size] as chunk:
+                    addBytes(len(chunk))
+                    yield chunk
+            return
 
         with open(self.file_path, "rb") as fd:
             while True:
-                chunk = fd.read(FILE_CHUNK_SIZE)
+                chunk = fd.read(chunk_size)
                 if not chunk:
                     break
+                addBytes(len(chunk))
                 yield chunk
 
     def calcEntropy(self, data=None):
@@ -177,59 +463,217 @@ class File(Storage):
         if data is None:
             return 0.0
 
-        cnt = Counter(bytearray(data))
-        entropy = 0
-        for i in cnt.values():
-            p_i = float(i) / len(data)
-            entropy -= p_i * math.log(p_i, 2)
+        return shannonEntropy(data)
 
-        return entropy
+    def analyseStream(self, *consumers: StreamConsumer,
+                      hashes=True, entropy=True,
+                      fuzzy=False) -> Dict[str, Any]:
+        """Feed one sequential read of the file to many consumers.
+        Hashes, entropy profile and ssdeep that are not computed yet are
+        cached. With a stat index, an unchanged file serves them from its
+        record and is only read for the rest.
+        Args:
+            consumers: extra `StreamConsumer`
+            hashes: compute crc32, md5, sha1, sha256 and sha512
+            entropy: compute the sliding-window entropy profile
+            fuzzy: compute the ssdeep digest
+        Return:
+            A dict of consumer results keyed by consumer name
+        """
+        with stage("stream") as timing:
+            results = self._analyseStream(consumers, hashes, entropy, fuzzy)
+        if results or "stream" not in self._timings:
+            self._timings["stream"] = timing
+        return results
+
+    def _analyseStream(self, consumers, hashes, entropy,
+                       fuzzy) -> Dict[str, Any]:
+        index = None if self.inMemory else self.statIndex
+        if index is not None:
+            st = os.stat(self.file_path)
+            self._loadRecord(index.lookup(self.file_path, st))
+
+        analyzer = StreamAnalyzer(consumers)
+        if hashes and self._md5 is None:
+            for consumer in hashConsumers():
+                analyzer.register(consumer)
+        if entropy and self._entropy_profile is None:
+            analyzer.register(EntropyEngine())
+        if fuzzy and self._ssdeep is None:
+            analyzer.register(FuzzyHash())
+
+        if not analyzer.consumers:
+            # everything is served by the stat index
+            return {}
+
+        results = analyzer.feed(self.getChunks()).results()
+        self._loadStream(results)
+
+        if index is not None:
+            # a file changed while it was read is not recorded
+            if statKey(os.stat(self.file_path)) == statKey(st):
+                index.store(self.file_path, st, self._record())
+
+        return results
+
+    def _loadStream(self, results: Dict[str, Any]):
+        """cache hashes, entropy profile and ssdeep of stream results"""
+        if "md5" in results:
+            self._crc32 = results["crc32"]
+            self._md5 = results["md5"]
+            self._sha1 = results["sha1"]
+            self._sha256 = results["sha256"]
+            self._sha512 = results["sha512"]
+        if EntropyEngine.name in results:
+            self._entropy_profile = results[EntropyEngine.name]
+        if FuzzyHash.name in results:
+            self._ssdeep = results[FuzzyHash.name]
 
     def calcHashes(self):
         """Calculate all possible hashes for this file."""
-        crc = 0
-        md5 = hashlib.md5()
-        sha1 = hashlib.sha1()
-        sha256 = hashlib.sha256()
-        sha512 = hashlib.sha512()
-
-        for chunk in self.getChunks():
-            crc = binascii.crc32(chunk, crc)
-            md5.update(chunk)
-            sha1.update(chunk)
-            sha256.update(chunk)
-            sha512.update(chunk)
-
-        self._crc32 = "".join("%02X" % ((crc >> i) & 0xff)
-                              for i in [24, 16, 8, 0])
-        self._md5 = md5.hexdigest()
-        self._sha1 = sha1.hexdigest()
-        self._sha256 = sha256.hexdigest()
-        self._sha512 = sha512.hexdigest()
+        self.analyseStream(entropy=False)
 
     @property
     def parse(self):
         if self.fileType in FILETYPE.PE:
-            return pefile.PE(self.file_path)
+            return self.pe
+        elif self.fileType in FILETYPE.ELF:
+            return self.elf
         else:
-            raise NotImplementedError("only support PE format")
-        # TODO add elf and android
+            raise NotImplementedError("only support PE and ELF format")
+        # TODO add android
+
+    @property
+    def pe(self) -> pefile.PE:
+        """fast loaded PE shared by the PE scanners, kept until
+        `releaseData`. Data directories are parsed on demand with
+        `parsePEDirectories`.
+        Raise:
+            ZhongkuiScanError
+        """
+        with self._load_lock:
+            if self._pe is None:
+                if self.inMemory:
+                    self._pe = loadPE(data=self._data)
+                else:
+                    self._pe = loadPE(self.file_path)
+        return self._pe
+
+    @property
+    def elf(self) -> ELF:
+        """ELF headers over `view`, kept until `releaseData`
+        Raise:
+            ZhongkuiScanError
+        """
+        with self._load_lock:
+            if self._elf is None:
+                view = self.view
+                if view is not None:
+                    self._elf = loadELF(data=view)
+                else:
+                    self._elf = loadELF(self.file_path)
+        return self._elf
 
     @property
     def fileName(self):
+        if self.inMemory:
+            return self._name or self.sha256
         return Path(self.file_path).name
 
+    @property
+    def sniffedType(self) -> Optional[str]:
+        """file type from the header bytes, `None` if not recognised"""
+        if self._sniffed is None:
+            if self._view is not None or self.inMemory:
+                header = self.view[:SNIFF_SIZE]
+            else:
+                with open(self.file_path, "rb") as f:
+                    header = f.read(SNIFF_SIZE)
+                    addBytes(len(header))
+            # "" marks an unrecognised header
+            self._sniffed = sniffFileType(header) or ""
+        return self._sniffed or None
+
     @property
     def fileType(self):
-        return self._exiftool.get(EXIFTOOL.FILETYPE)
+        """file type, exiftool only runs on headers `sniffedType` does
+        not recognise
+        """
+        return self.sniffedType or self.getExiftool().get(EXIFTOOL.FILETYPE)
+
+    @property
+    def size(self) -> int:
+        """file size in bytes, from `stat`"""
+        if self.inMemory:
+            return len(self._data)
+        return os.stat(self.file_path).st_size
+
+    @property
+    def view(self) -> Optional[memoryview]:
+        """read-only memoryview of the whole file backed by `mmap`, kept
+        until `releaseData`. Slices share the OS page cache instead of
+        copying. `None` if the file can not be mapped.
+        """
+        with self._load_lock:
+            if self._view is None and self.inMemory:
+                self._view = memoryview(self._data)
+            if self._view is None:
+                with open(self.file_path, "rb") as f:
+                    if os.fstat(f.fileno()).st_size == 0:
+                        # an empty file can not be mapped
+                        self._view = memoryview(b"")
+                        return self._view
+                    try:
+                        self._mmap = mmap.mmap(f.fileno(),
+                                               0,
+                                               access=mmap.ACCESS_READ)
+                    except (OSError, ValueError) as e:
+                        log.warning("mmap {} error: {}".format(
+                            self.file_path, e))
+                        return None
+                self._view = memoryview(self._mmap)
+        return self._view
 
     @property
     def fileData(self):
+        """whole file contents, kept until `releaseData`
+        Raise:
+            ZhongkuiCriticalError: the file exceeds the memory budget
+        """
         if self._file_data is None:
-            with open(self.file_path, "rb") as f:
-                self._file_data = f.read()
+            if (self.memory_budget is not None
+                    and self.size > self.memory_budget):
+                raise ZhongkuiCriticalError(
+                    "file exceeds memory budget {}, read it by chunks: {}".
+                    format(self.memory_budget, self.file_path))
+            if self.inMemory:
+                self._file_data = bytes(self._data)
+            else:
+                with open(self.file_path, "rb") as f:
+                    self._file_data = f.read()
+                addBytes(len(self._file_data))
         return self._file_data
 
+    def releaseData(self):
+        """drop the cached `fileData`, `view`, `pe` and `elf`"""
+        self._file_data = None
+        if self._elf is not None:
+            self._elf.close()
+            self._elf = None
+        if self._view is not None:
+            try:
+                self._view.release()
+                if self._mmap is not None:
+                    self._mmap.close()
+            except BufferError:
+                # slices are still in use, unmapped when collected
+                pass
+            self._view = None
+            self._mmap = None
+        if self._pe is not None:
+            self._pe.close()
+            self._pe = None
+
     @property
     def md5(self):
         if self._md5 is None:
@@ -263,9 +707,38 @@ class File(Storage):
     @property
     def ssdeep(self):
         if self._ssdeep is None:
-            self._ssdeep = ssdeepScan(self.file_path).get("ssdeep")
+            # hashes and entropy come with the same read
+            self.analyseStream(fuzzy=True)
         return self._ssdeep
 
+    def compareSsdeep(self, other) -> int:
+        """ssdeep match score from 0 to 100
+        Args:
+            other: a `File` or a ssdeep digest
+        """
+        if isinstance(other, File):
+            other = other.ssdeep
+        return compareFuzzyHash(self.ssdeep, other)
+
+    @property
+    def scanCosts(self) -> Dict[str, float]:
+        """seconds spent in each scanner that has run so far"""
+        return {name: timing.wall for name, timing in self._timings.items()}
+
+    @property
+    def timings(self) -> Dict[str, Dict[str, Any]]:
+        """wall and CPU seconds, bytes read and subprocesses spawned by
+        each scanner that has run so far
+        """
+        return {name: asdict(timing) for name, timing in self._timings.items()}
+
+    @property
+    def entropyProfile(self) -> EntropyProfile:
+        """sliding-window entropy profile"""
+        if self._entropy_profile is None:
+            self.analyseStream()
+        return self._entropy_profile
+
     @property
     def packer(self):
         """return file packer name and version if exit"""
@@ -279,7 +752,7 @@ class File(Storage):
     def isProbablyPacked(self) -> bool:
         """A file is probably packed:
         1. detect packer;
-        2. entropy of at least 20% data > 7.4.
+        2. entropy of at least 20% windows > 7.4.
         """
         if self._is_probably_packed is not None:
             return self._is_probably_packed
@@ -301,18 +774,7 @@ class File(Storage):
         #     raise NotImplementedError
 
         # others
-        total_file_data = len(self.fileData)
-        total_compressed_data = 0
-
-        for data in self.getChunks():
-            ck_entropy = self.calcEntropy(data)
-            ck_length = len(data)
-            if ck_entropy > 7.4:
-                total_compressed_data += ck_length
-        if ((1.0 * total_compressed_data) / total_file_data) > 0.2:
-            self._is_probably_packed = True
-        else:
-            self._is_probably_packed = False
+        self._is_probably_packed = self.entropyProfile.highFraction > 0.2
 
         return self._is_probably_packed
     
@@ -320,70 +782,228 @@ class File(Storage):
         if easy_read:
             return self.getExiftool().get(EXIFTOOL.FILESIZE)
         else:
-            return os.path.getsize(self.file_path)
+            return self.size
+
+    def _tridScan(self):
+        # the in-process matcher reads in-memory contents directly
+        index = TridIndex.get()
+        if index is not None and self.inMemory:
+            return index.match(self._data)
+        return tridScan(self.file_path)
+
+    def _magicScan(self):
+        # libmagic reads in-memory contents directly
+        return magicScan(self._data if self.inMemory else self.file_path)
+
+    def _exiftoolScan(self):
+        return exiftoolScan(self.file_path)
+
+    def _diecScan(self):
+        return diecScan(self.file_path)
 
     def getTrid(self):
         """file component info"""
-        if self._trid is None:
-            self._trid = tridScan(self.file_path)
-        return self._trid
+        return self._scan("trid", self._tridScan)
 
     def getMagic(self):
         """file magic info"""
-        if not self._magic:
-            self._magic = magicScan(self.file_path)
-        return self._magic
+        return self._scan("magic", self._magicScan)
 
     def getExiftool(self):
         """file exiftool info"""
-        return self._exiftool
+        return self._scan("exiftool", self._exiftoolScan)
 
     def getTimeStamp(self):
         """file timesample info"""
-        return self._exiftool.get("TimeStamp")
+        return self.getExiftool().get("TimeStamp")
 
     def getPefile(self):
         """pefile info"""
         if self.fileType in FILETYPE.PE:
-            if self._pefile is None:
-                self._pefile = pefileScan(self.file_path)
+            return self._scan("pefile", lambda: pefileScan(self.pe))
         return self._pefile
 
+    def getElf(self):
+        """elf info"""
+        if self.fileType in FILETYPE.ELF:
+            return self._scan("elfinfo", lambda: elfScan(self.elf))
+        return self._elfinfo
+
     def getDiec(self):
         """diec info"""
-        if not self._diec:
-            self._diec = diecScan(self.file_path)
+        return self._scan("diec", self._diecScan)
+
+    def scanConcurrently(self,
+                         deadline=None,
+                         pe=True,
+                         scheduler=None,
+                         profile=None):
+        """Run the scanners that have not run yet concurrently.
+        A scanner that fails or misses the deadline caches a `SCAN.ERROR`
+        result, so the info getters return partial results.
+        Args:
+            deadline: seconds allowed for all scanners
+            pe: also run pefile on PE files and elfScan on ELF files,
+                on the shared `pe` and `elf` in the thread pool
+            scheduler: `ScanScheduler`, defaults to the shared one
+            profile: analysis profile, only its scanners run, see
+                `resolveProfile`
+        Return:
+            A dict of error messages keyed by scanner name
+        """
+        def isPE(results):
+            exiftool = results.get("exiftool") or self.getExiftool()
+            return exiftool.get(EXIFTOOL.FILETYPE) in FILETYPE.PE
+
+        scanners = resolveProfile(profile)
+        sniffed = self.sniffedType
+
+        # the path is only asked for in the tasks of path based
+        # scanners, in-memory contents are not written for the others
+        scans = (("exiftool", self._exiftoolScan), ("trid", self._tridScan),
+                 ("magic", self._magicScan), ("diec", self._diecScan))
+        for name in ("exiftool", "trid", "magic", "diec", "pefile",
+                     "elfinfo"):
+            if getattr(self, "_" + name) is None:
+                setattr(self, "_" + name, self._cacheGet(name))
+        tasks = [
+            ScanTask(name, func) for name, func in scans
+            if name in scanners and getattr(self, "_" + name) is None
+        ]
+        hashes, entropy = "hashes" in scanners, "entropy" in scanners
+        if ((hashes and self._md5 is None)
+                or (entropy and self._entropy_profile is None)):
+            tasks.append(
+                ScanTask(
+                    "stream",
+                    functools.partial(self.analyseStream,
+                                      hashes=hashes,
+                                      entropy=entropy)))
+        pe_scan = pe and "pefile" in scanners
+        if (pe_scan and self._pefile is None and sniffed is None
+                and "exiftool" in scanners):
+            tasks.append(
+                ScanTask("pefile",
+                         lambda: pefileScan(self.pe),
+                         requires=("exiftool", ),
+                         condition=isPE))
+        elif pe_scan and self._pefile is None and sniffed in FILETYPE.PE:
+            # known PE, pefile need not wait for exiftool
+            tasks.append(ScanTask("pefile", lambda: pefileScan(self.pe)))
+        if (pe and "elfinfo" in scanners and self._elfinfo is None
+                and sniffed in FILETYPE.ELF):
+            tasks.append(ScanTask("elfinfo", lambda: elfScan(self.elf)))
+
+        scheduler = scheduler or ScanScheduler.get()
+        results, _ = scheduler.run(tasks, deadline, self._timings)
+
+        errors = {}
+        for name, result in results.items():
+            if isinstance(result, dict) and SCAN.ERROR in result:
+                errors[name] = result[SCAN.ERROR]
+            if name != "stream":
+                setattr(self, "_" + name, result)
+                self._cachePut(name, result)
+
+        return errors
+
+    def getBasicInfo(self, concurrent=False, deadline=None, profile=None):
+        """file basic info
+        Args:
+            concurrent: run the scanners concurrently, see `scanConcurrently`
+            deadline: seconds allowed for concurrent scanners
+            profile: analysis profile, see `resolveProfile`, fields of the
+                scanners it leaves out keep their defaults
+        """
+        scanners = resolveProfile(profile)
+        if concurrent:
+            self.scanConcurrently(deadline, pe=False, profile=scanners)
+        if not PROFILES[STANDARD] <= scanners:
+            # partial info is not cached, its scanner results are
+            return self._basicInfo(scanners)
+        if self._basic is None:
+            # a duplicate sample costs the hash pass and a lookup
+            basic = self._cacheGet("basic")
+            if basic is not None:
+                basic["name"] = self.fileName
+                self._basic = basic
+        if self._basic is None:
+            self._basic = self._basicInfo(scanners)
+            # info built on a failed scanner is not cached, the scanner
+            # is retried for the next copy of the sample
+            if all(result is not None and SCAN.ERROR not in result
+                   for result in (self._exiftool, self._trid, self._magic,
+                                  self._diec)):
+                self._cachePut("basic", self._basic)
 
-        return self._diec
+        return self._basic
 
-    def getBasicInfo(self):
-        """file basic info"""
-        if self._basic is None:
-            # basic info
-            basic_info = FileinfoBasic()
-            basic_info.name = self.fileName
+    def _basicInfo(self, scanners) -> Dict[str, Any]:
+        """basic info from the scanners of a profile"""
+        # hashes and entropy in one read
+        self.analyseStream(hashes="hashes" in scanners,
+                           entropy="entropy" in scanners)
+        # basic info
+        basic_info = FileinfoBasic()
+        basic_info.name = self.fileName
+        if "hashes" in scanners:
             basic_info.md5 = self.md5
             basic_info.sha256 = self.sha256
-            # basic_info.crc32 = self.crc32
+        # basic_info.crc32 = self.crc32
+        if "exiftool" in scanners:
             basic_info.fileType = self.fileType
+        elif "sniff" in scanners:
+            basic_info.fileType = self.sniffedType or ""
+        if "magic" in scanners:
             basic_info.magic = self.getMagic()
-            # basic_info.ssdeep = self.ssdeep
+        # basic_info.ssdeep = self.ssdeep
+        if "trid" in scanners:
             basic_info.trid = self.getTrid()
+        if "diec" in scanners:
             basic_info.packer = self.packer
             basic_info.isProbablyPacked = self.isProbablyPacked
+        elif "entropy" in scanners:
+            # `isProbablyPacked` without a packer
+            basic_info.isProbablyPacked = (
+                self.entropyProfile.highFraction > 0.2)
+        if "exiftool" in scanners:
             basic_info.fileSize = self.getFileSize()
             basic_info.timeStamp = self.getTimeStamp()
-            # basic_info.familyType = self.family_type
-            self._basic = asdict(basic_info)
-
-        return self._basic
-
-    def getAllInfo(self) -> Dict[str, Any]:
-        """file all info"""
+        # basic_info.familyType = self.family_type
+        return asdict(basic_info)
+
+    def getAllInfo(self,
+                   concurrent=False,
+                   deadline=None,
+                   timings=False,
+                   profile=None) -> Dict[str, Any]:
+        """file all info
+        Args:
+            concurrent: run the scanners concurrently, see `scanConcurrently`
+            deadline: seconds allowed for concurrent scanners
+            timings: add the `timings` of the scanners
+            profile: analysis profile, see `resolveProfile`, infos of the
+                scanners it leaves out are missing, defaults to `full`
+        """
+        scanners = resolveProfile(profile)
+        if concurrent:
+            self.scanConcurrently(deadline, profile=scanners)
         infos = {}
-        infos[STATICINFO.BASIC] = self.getBasicInfo()
-        infos[STATICINFO.PE] = self.getPefile()
-        infos[STATICINFO.DIEC] = self.getDiec()
-        infos[STATICINFO.EXIFTOOL] = self.getExiftool()
+        infos[STATICINFO.BASIC] = self.getBasicInfo(profile=scanners)
+        # without exiftool only a sniffed type routes pefile and elfScan
+        file_type = (self.fileType
+                     if "exiftool" in scanners else self.sniffedType)
+        if "pefile" in scanners:
+            infos[STATICINFO.PE] = (self.getPefile()
+                                    if file_type in FILETYPE.PE else None)
+        if "elfinfo" in scanners:
+            infos[STATICINFO.ELF] = (self.getElf()
+                                     if file_type in FILETYPE.ELF else None)
+        if "diec" in scanners:
+            infos[STATICINFO.DIEC] = self.getDiec()
+        if "exiftool" in scanners:
+            infos[STATICINFO.EXIFTOOL] = self.getExiftool()
+        if timings:
+            infos[STATICINFO.TIMINGS] = self.timings
 
         return infos
@@ -0,0 +1,428 @@
+"""ELF32/ELF64 parser on a memory view
+
+Headers, sections, segments and the dynamic section are read with
+`struct` straight from the mapped file, section data is hashed from
+zero-copy slices.
+"""
+import mmap
+import struct
+import hashlib
+import logging
+from pathlib import Path
+from collections import namedtuple
+from dataclasses import asdict
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+from .exceptions import ZhongkuiScanError
+from .entropy import ENTROPY_THRESHOLD, shannonEntropy
+from .metrics import addBytes, instrumented
+from .model import ELFInfo, ELFSection, ELFSegment
+
+log = logging.getLogger(__name__)
+
+ELF_MAGIC = b"\x7fELF"
+
+# (header, section, segment, dynamic entry, symbol) formats by class
+ELF_FORMATS = {
+    1: ("HHIIIIIHHHHHH", "IIIIIIIIII", "IIIIIIII", "iI", "IIIBBH"),
+    2: ("HHIQQQIHHHHHH", "IIQQQQIIQQ", "IIQQQQQQ", "qQ", "IBBHQQ"),
+}
+
+ELF_TYPES = {0: "NONE", 1: "REL", 2: "EXEC", 3: "DYN", 4: "CORE"}
+
+ELF_MACHINES = {
+    2: "SPARC",
+    3: "x86",
+    8: "MIPS",
+    20: "PowerPC",
+    21: "PowerPC64",
+    40: "ARM",
+    42: "SuperH",
+    43: "SPARC V9",
+    50: "IA-64",
+    62: "x86-64",
+    183: "AArch64",
+    243: "RISC-V",
+}
+
+SECTION_TYPES = {
+    0: "NULL",
+    1: "PROGBITS",
+    2: "SYMTAB",
+    3: "STRTAB",
+    4: "RELA",
+    5: "HASH",
+    6: "DYNAMIC",
+    7: "NOTE",
+    8: "NOBITS",
+    9: "REL",
+    11: "DYNSYM",
+    14: "INIT_ARRAY",
+    15: "FINI_ARRAY",
+    0x6ffffff6: "GNU_HASH",
+    0x6ffffffe: "VERNEED",
+    0x6fffffff: "VERSYM",
+}
+
+SEGMENT_TYPES = {
+    0: "NULL",
+    1: "LOAD",
+    2: "DYNAMIC",
+    3: "INTERP",
+    4: "NOTE",
+    6: "PHDR",
+    7: "TLS",
+    0x6474e550: "GNU_EH_FRAME",
+    0x6474e551: "GNU_STACK",
+    0x6474e552: "GNU_RELRO",
+    0x6474e553: "GNU_PROPERTY",
+}
+
+SHT_DYNAMIC = 6
+SHT_NOBITS = 8
+SHT_DYNSYM = 11
+PT_LOAD = 1
+PT_DYNAMIC = 2
+PT_INTERP = 3
+DT_NULL = 0
+DT_NEEDED = 1
+DT_STRTAB = 5
+SHN_XINDEX = 0xffff
+PN_XNUM = 0xffff
+
+Section = namedtuple("Section", "name type flags address offset size link "
+                     "info align entsize")
+Segment = namedtuple("Segment", "type flags offset address filesize memsize")
+
+
+class ELF:
+    """Parsed ELF headers over a buffer, e.g. `File.view`
+
+    The buffer is only referenced, section data is sliced on demand.
+    """
+    def __init__(self, data):
+        """
+        Args:
+            data: bytes, memoryview or mmap of the whole file
+        Raise:
+            ZhongkuiScanError: not an ELF file or truncated headers
+        """
+        self.data = data
+        self._mmap = None
+        self._file = None
+        try:
+            self._parse()
+        except (struct.error, IndexError, ValueError) as e:
+            raise ZhongkuiScanError("elf parse error: {}".format(e))
+
+    def _parse(self):
+        data = self.data
+        if bytes(data[:4]) != ELF_MAGIC:
+            raise ValueError("bad magic")
+        self.elf_class, self.endian_code = data[4], data[5]
+        if self.elf_class not in ELF_FORMATS:
+            raise ValueError("bad class")
+        if self.endian_code not in (1, 2):
+            raise ValueError("bad data encoding")
+        self.endian = "<" if self.endian_code == 1 else ">"
+        formats = ELF_FORMATS[self.elf_class]
+        self._fmt_section, self._fmt_segment = formats[1], formats[2]
+        self._fmt_dynamic, self._fmt_symbol = formats[3], formats[4]
+
+        (self.type, self.machine, _, self.entry, phoff, shoff, _, _,
+         phentsize, phnum, shentsize, shnum,
+         shstrndx) = struct.unpack_from(self.endian + formats[0], data, 16)
+
+        # extended numbering is kept in the first section header
+        if shoff and (shnum == 0 or shstrndx == SHN_XINDEX
+                      or phnum == PN_XNUM):
+            first = self._unpack(self._fmt_section, shoff)
+            shnum = shnum or first[5]
+            shstrndx = first[6] if shstrndx == SHN_XINDEX else shstrndx
+            phnum = first[7] if phnum == PN_XNUM else phnum
+
+        phnum = self._count("segment", self._fmt_segment, phoff, phentsize,
+                            phnum)
+        shnum = self._count("section", self._fmt_section, shoff, shentsize,
+                            shnum)
+        self.segments = [
+            self._segment(
+                self._unpack(self._fmt_segment, phoff + i * phentsize))
+            for i in range(phnum)
+        ]
+        headers = [
+            self._unpack(self._fmt_section, shoff + i * shentsize)
+            for i in range(shnum)
+        ]
+        names = headers[shstrndx] if shstrndx < len(headers) else None
+        self.sections = [
+            Section(self._string(names[4], header[0]) if names else "",
+                    *header[1:]) for header in headers
+        ]
+
+    def _count(self, kind: str, fmt: str, offset: int, entsize: int,
+               count: int) -> int:
+        """entries of a header table, a hostile count must not make the
+        parser loop beyond the data
+        Raise:
+            ValueError: bad entry size or entries beyond the data
+        """
+        if not offset or not count:
+            return 0
+        if entsize != struct.calcsize(self.endian + fmt):
+            raise ValueError("bad {} header size: {}".format(kind, entsize))
+        if count > (len(self.data) - offset) // entsize:
+            raise ValueError("{} {} headers beyond the data".format(
+                count, kind))
+        return count
+
+    def _unpack(self, fmt: str, offset: int) -> Tuple:
+        return struct.unpack_from(self.endian + fmt, self.data, offset)
+
+    def _segment(self, values: Tuple) -> Segment:
+        if self.elf_class == 1:
+            type, offset, address, _, filesize, memsize, flags, _ = values
+        else:
+            type, flags, offset, address, _, filesize, memsize, _ = values
+        return Segment(type, flags, offset, address, filesize, memsize)
+
+    def _string(self, table: int, index: int) -> str:
+        """nul terminated string at `table` + `index`"""
+        start = end = table + index
+        while True:
+            chunk = bytes(self.data[end:end + 256])
+            nul = chunk.find(b"\0")
+            if nul >= 0:
+                end += nul
+                break
+            if not chunk:
+                break
+            end += len(chunk)
+        return bytes(self.data[start:end]).decode("utf-8", errors="replace")
+
+    def _range(self, offset: int, size: int) -> Tuple[int, int]:
+        """file range clipped to the data"""
+        length = len(self.data)
+        return min(offset, length), min(offset + size, length)
+
+    def sectionData(self, section: Section) -> memoryview:
+        """zero-copy slice of the section, empty for NOBITS"""
+        if section.type == SHT_NOBITS:
+            return memoryview(b"")
+        start, end = self._range(section.offset, section.size)
+        return memoryview(self.data)[start:end]
+
+    def segmentData(self, segment: Segment) -> memoryview:
+        start, end = self._range(segment.offset, segment.filesize)
+        return memoryview(self.data)[start:end]
+
+    def offsetOf(self, address: int) -> Optional[int]:
+        """file offset of a virtual address in a LOAD segment"""
+        for segment in self.segments:
+            if (segment.type == PT_LOAD and
+                    segment.address <= address < segment.address +
+                    segment.filesize):
+                return segment.offset + address - segment.address
+        return None
+
+    @property
+    def interpreter(self) -> str:
+        for segment in self.segments:
+            if segment.type == PT_INTERP:
+                return self._string(segment.offset, 0)
+        return ""
+
+    def _dynamic(self) -> Iterator[Tuple[int, int]]:
+        """(tag, value) entries of the dynamic section"""
+        start = end = None
+        for section in self.sections:
+            if section.type == SHT_DYNAMIC:
+                start, end = self._range(section.offset, section.size)
+                break
+        else:
+            # section headers may be stripped, use the segment
+            for segment in self.segments:
+                if segment.type == PT_DYNAMIC:
+                    start, end = self._range(segment.offset, segment.filesize)
+                    break
+        if start is None:
+            return
+        fmt = self.endian + self._fmt_dynamic
+        size = struct.calcsize(fmt)
+        for offset in range(start, end - size + 1, size):
+            tag, value = struct.unpack_from(fmt, self.data, offset)
+            if tag == DT_NULL:
+                break
+            yield tag, value
+
+    @property
+    def needed(self) -> List[str]:
+        """needed libraries of the dynamic section"""
+        entries = list(self._dynamic())
+        strtab = None
+        for tag, value in entries:
+            if tag == DT_STRTAB:
+                strtab = self.offsetOf(value)
+        if strtab is None:
+            # relocatable objects have no address space
+            for section in self.sections:
+                if (section.type == SHT_DYNAMIC
+                        and section.link < len(self.sections)):
+                    strtab = self.sections[section.link].offset
+                    break
+        if strtab is None:
+            return []
+        return [
+            self._string(strtab, value) for tag, value in entries
+            if tag == DT_NEEDED
+        ]
+
+    @property
+    def dynamicSymbols(self) -> List[str]:
+        """names of the dynamic symbol table"""
+        symbols = []
+        fmt = self.endian + self._fmt_symbol
+        size = struct.calcsize(fmt)
+        for section in self.sections:
+            if (section.type != SHT_DYNSYM
+                    or section.link >= len(self.sections)):
+                continue
+            strtab = self.sections[section.link].offset
+            start, end = self._range(section.offset, section.size)
+            for offset in range(start, end - size + 1, size):
+                name = struct.unpack_from(fmt, self.data, offset)[0]
+                if name:
+                    symbols.append(self._string(strtab, name))
+        return symbols
+
+    def close(self):
+        """unmap a file opened by `loadELF`"""
+        self.data = None
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def loadELF(target: Path = None, data=None) -> ELF:
+    '''parse the ELF headers of a file or a buffer
+    Args:
+        target: file path, mapped until `ELF.close`
+        data: bytes or memoryview of the whole file
+    Raise:
+        ZhongkuiScanError
+    '''
+    if data is not None:
+        return ELF(data)
+    f = open(target, "rb")
+    try:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError) as e:
+        f.close()
+        raise ZhongkuiScanError("elf load error: {}".format(e))
+    try:
+        elf = ELF(mapped)
+    except ZhongkuiScanError:
+        mapped.close()
+        f.close()
+        raise
+    elf._mmap, elf._file = mapped, f
+    addBytes(len(mapped))
+    return elf
+
+
+def _name(names: Dict[int, str], value: int) -> str:
+    return names.get(value, hex(value))
+
+
+def _flags(flags: int) -> str:
+    return "".join(flag if flags & bit else "-"
+                   for flag, bit in (("R", 4), ("W", 2), ("X", 1)))
+
+
+def isProbablyPackedELF(elf: ELF, section_entropies=None) -> bool:
+    '''more than 20% of the file is in sections with entropy > 7.4, or in
+    LOAD segments when the section headers are stripped
+    Args:
+        elf: parsed ELF
+        section_entropies: (length, entropy) of each section if known
+    '''
+    if not section_entropies:
+        section_entropies = []
+        for segment in elf.segments:
+            if segment.type == PT_LOAD:
+                with elf.segmentData(segment) as data:
+                    section_entropies.append(
+                        (len(data), shannonEntropy(data)))
+    if not len(elf.data):
+        return True
+    total_compressed_data = sum(length
+                                for length, entropy in section_entropies
+                                if entropy > ENTROPY_THRESHOLD)
+    return (1.0 * total_compressed_data) / len(elf.data) > 0.2
+
+
+@instrumented
+def elfScan(target: Union[Path, ELF]) -> Dict:
+    '''elf scan target
+    Args:
+        target: A Path to target file, or an ELF from `loadELF`
+    Raise:
+        ZhongkuiScanError
+    Return:
+        A dict result
+    '''
+    elf = target if isinstance(target, ELF) else loadELF(target)
+    elf_info = ELFInfo()
+    section_entropies = []
+
+    try:
+        header = elf_info.header
+        header.elfClass = "ELF{}".format(32 * elf.elf_class)
+        header.endianness = "little" if elf.endian == "<" else "big"
+        header.type = _name(ELF_TYPES, elf.type)
+        header.machine = ELF_MACHINES.get(elf.machine, str(elf.machine))
+        header.entryPoint = str(elf.entry)
+        header.sections = len(elf.sections)
+        header.segments = len(elf.segments)
+
+        for section in elf.sections:
+            with elf.sectionData(section) as data:
+                entropy = shannonEntropy(data)
+                md5 = hashlib.md5(data).hexdigest()
+                section_entropies.append((len(data), entropy))
+            sec_info = ELFSection()
+            sec_info.name = section.name
+            sec_info.type = _name(SECTION_TYPES, section.type)
+            sec_info.address = str(section.address)
+            sec_info.offset = str(section.offset)
+            sec_info.size = str(section.size)
+            sec_info.entropy = round(entropy, 2)
+            sec_info.md5 = md5
+            elf_info.sections.append(sec_info)
+
+        for segment in elf.segments:
+            seg_info = ELFSegment()
+            seg_info.type = _name(SEGMENT_TYPES, segment.type)
+            seg_info.flags = _flags(segment.flags)
+            seg_info.offset = str(segment.offset)
+            seg_info.virtualAddress = str(segment.address)
+            seg_info.fileSize = str(segment.filesize)
+            seg_info.memorySize = str(segment.memsize)
+            elf_info.segments.append(seg_info)
+
+        elf_info.interpreter = elf.interpreter
+        elf_info.needed = elf.needed
+        elf_info.dynamicSymbols = elf.dynamicSymbols
+        elf_info.isProbablyPacked = isProbablyPackedELF(
+            elf, section_entropies)
+    except (struct.error, IndexError, ValueError) as e:
+        log.error("elf parse error: {}".format(e))
+        raise ZhongkuiScanError("elf parse error: {}".format(e))
+    finally:
+        if elf is not target:
+            elf.close()
+
+    log.info("finish elfScan...")
+    return asdict(elf_info)
@@ -0,0 +1,165 @@
+"""vectorized entropy engine"""
+import string
+import numpy as np
+from typing import Any, Dict, List
+from .model import EntropyProfile
+from .stream import StreamConsumer
+
+ENTROPY_WINDOW = 64 * 1024
+ENTROPY_STEP = 16 * 1024
+ENTROPY_THRESHOLD = 7.4
+
+PRINTABLE = np.frombuffer(string.printable.encode(), dtype=np.uint8)
+
+
+def byteHistogram(data) -> np.ndarray:
+    """count of each byte value in data"""
+    data = np.frombuffer(data, dtype=np.uint8)
+    if len(data) <= ENTROPY_STEP:
+        return np.bincount(data, minlength=256)
+    # bincount copies its input as intp, count by blocks to bound the copy
+    histogram = np.zeros(256, dtype=np.int64)
+    for i in range(0, len(data), ENTROPY_STEP):
+        histogram += np.bincount(data[i:i + ENTROPY_STEP], minlength=256)
+    return histogram
+
+
+def histogramEntropy(histograms: np.ndarray, length) -> np.ndarray:
+    """shannon entropy of each row of byte histograms with `length` bytes
+
+    H = log2(n) - sum(c * log2(c)) / n
+    """
+    counts = histograms.astype(np.float64)
+    weighted = counts * np.log2(np.maximum(counts, 1))
+    length = np.asarray(length, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        entropy = np.log2(length) - weighted.sum(axis=-1) / length
+    return np.where(length > 0, np.maximum(entropy, 0.0), 0.0)
+
+
+def shannonEntropy(data) -> float:
+    """shannon entropy of data"""
+    return float(histogramEntropy(byteHistogram(data), len(data)))
+
+
+class EntropyEngine(StreamConsumer):
+    """Sliding-window entropy profile of a chunk stream.
+
+    Byte histograms are counted once per `step` block; each window sums
+    `window // step` consecutive block histograms.
+    """
+    name = "entropyProfile"
+
+    def __init__(self,
+                 window=ENTROPY_WINDOW,
+                 step=ENTROPY_STEP,
+                 threshold=ENTROPY_THRESHOLD):
+        """
+        Args:
+            window: window size in bytes, a multiple of `step`
+            step: distance between two windows in bytes
+            threshold: entropy of a high-entropy window
+        """
+        if step <= 0 or window % step:
+            raise ValueError("window must be a multiple of step")
+        self.window = window
+        self.step = step
+        self.threshold = threshold
+        self.size = 0
+        self._blocks = window // step
+        self._pending = bytearray()
+        self._carry = np.zeros((0, 256), dtype=np.int64)
+        self._entropies = []
+        self._histogram = np.zeros(256, dtype=np.int64)
+
+    def update(self, chunk):
+        self.size += len(chunk)
+        data = np.frombuffer(chunk, dtype=np.uint8)
+        if self._pending:
+            need = self.step - len(self._pending)
+            self._pending.extend(data[:need].tobytes())
+            data = data[need:]
+            if len(self._pending) < self.step:
+                return
+            self._addBlocks(
+                np.frombuffer(bytes(self._pending), dtype=np.uint8))
+            self._pending = bytearray()
+
+        full = len(data) - len(data) % self.step
+        if full:
+            self._addBlocks(data[:full])
+        self._pending.extend(data[full:].tobytes())
+
+    def _addBlocks(self, data: np.ndarray):
+        step = self.step
+        histograms = np.empty((len(data) // step, 256), dtype=np.int64)
+        for i in range(len(histograms)):
+            histograms[i] = np.bincount(data[i * step:(i + 1) * step],
+                                        minlength=256)
+        self._histogram += histograms.sum(axis=0)
+
+        rows = np.concatenate((self._carry, histograms))
+        if len(rows) >= self._blocks:
+            cumsum = np.cumsum(rows, axis=0)
+            windows = cumsum[self._blocks - 1:].copy()
+            windows[1:] -= cumsum[:-self._blocks]
+            self._entropies.extend(
+                histogramEntropy(windows, self.window).tolist())
+        self._carry = rows[max(0, len(rows) - self._blocks + 1):]
+
+    def result(self) -> EntropyProfile:
+        histogram = self._histogram + byteHistogram(bytes(self._pending))
+        entropy = float(histogramEntropy(histogram, self.size))
+        entropies = self._entropies
+        if not entropies and self.size:
+            # shorter than one window, a single window of the whole data
+            entropies = [entropy]
+
+        high = [e > self.threshold for e in entropies]
+        return EntropyProfile(
+            window=min(self.window, self.size),
+            step=self.step,
+            size=self.size,
+            entropy=entropy,
+            entropies=[round(e, 4) for e in entropies],
+            highFraction=sum(high) / len(high) if high else 0.0,
+            highRegions=self._regions(high),
+        )
+
+    def _regions(self, high: List[bool]) -> List[List[int]]:
+        """merge high-entropy windows into [start, end) byte ranges"""
+        regions = []
+        for i, is_high in enumerate(high):
+            if not is_high:
+                continue
+            start = i * self.step
+            end = min(start + self.window, self.size)
+            if regions and start <= regions[-1][1]:
+                regions[-1][1] = end
+            else:
+                regions.append([start, end])
+        return regions
+
+
+class ByteStatsConsumer(StreamConsumer):
+    """byte histogram and statistics of the whole stream"""
+    name = "byteStats"
+
+    def __init__(self):
+        self._histogram = np.zeros(256, dtype=np.int64)
+        self._size = 0
+
+    def update(self, chunk):
+        self._histogram += byteHistogram(chunk)
+        self._size += len(chunk)
+
+    def result(self) -> Dict[str, Any]:
+        size = self._size or 1
+        return {
+            "size": self._size,
+            "distinct": int(np.count_nonzero(self._histogram)),
+            "nullRatio": int(self._histogram[0]) / size,
+            "printableRatio": int(self._histogram[PRINTABLE].sum()) / size,
+            "entropy": float(histogramEntropy(self._histogram, self._size)),
+            "histogram": self._histogram.tolist(),
+        }
@@ -9,6 +9,18 @@ class ZhongkuiScanError(ZhongkuiCriticalError):
     """zhongkui scan error"""
 
 
+class ZhongkuiScanTimeoutError(ZhongkuiScanError):
+    """zhongkui scanner timeout"""
+
+
+class ZhongkuiToolMissingError(ZhongkuiScanError):
+    """zhongkui scanner tool can not start"""
+
+
+class ZhongkuiToolUnavailableError(ZhongkuiScanError):
+    """zhongkui scanner tool circuit is open"""
+
+
 class ZhongkuiHTTPError(ZhongkuiCriticalError):
     """zhongkui http error"""
 
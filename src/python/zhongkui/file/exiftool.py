@@ -0,0 +1,172 @@
+"""long-lived exiftool workers built on `-stay_open True -@ -`"""
+import os
+import time
+import queue
+import atexit
+import logging
+import selectors
+import threading
+from subprocess import Popen, PIPE
+from typing import Optional
+from .exceptions import (ZhongkuiScanError, ZhongkuiScanTimeoutError,
+                         ZhongkuiToolMissingError)
+from .metrics import addSpawn
+from .runtime import killGroup
+
+log = logging.getLogger(__name__)
+
+EXIFTOOL_READY = b"{ready}"
+
+
+class ExiftoolProcess:
+    """A single `exiftool -stay_open` worker"""
+    def __init__(self, executable="exiftool"):
+        self.executable = executable
+        self.proc = None
+
+    @property
+    def running(self) -> bool:
+        return self.proc is not None and self.proc.poll() is None
+
+    def start(self):
+        args = (self.executable, '-stay_open', 'True', '-@', '-')
+        try:
+            self.proc = Popen(args,
+                              stdin=PIPE,
+                              stdout=PIPE,
+                              start_new_session=True)
+        except OSError as e:
+            raise ZhongkuiToolMissingError(
+                "exiftool daemon start error: {}".format(e))
+        addSpawn()
+        log.debug("start exiftool daemon, pid: {}".format(self.proc.pid))
+
+    def close(self):
+        if self.proc is None:
+            return
+        if self.running:
+            try:
+                self.proc.stdin.write(b"-stay_open\nFalse\n")
+                self.proc.stdin.flush()
+                self.proc.wait(timeout=1)
+            except Exception:
+                killGroup(self.proc)
+        self.proc.stdin.close()
+        self.proc.stdout.close()
+        self.proc = None
+
+    def kill(self):
+        if self.proc is None:
+            return
+        killGroup(self.proc)
+        self.proc.stdin.close()
+        self.proc.stdout.close()
+        self.proc = None
+
+    def execute(self, *args, timeout: float = 15) -> bytes:
+        """Run one exiftool command.
+        Args:
+            args: exiftool arguments, one per line of the args file
+            timeout: seconds to wait for the `{ready}` marker
+        Raise:
+            ZhongkuiScanError
+        Return:
+            stdout of the command
+        """
+        if any("\n" in str(arg) for arg in args):
+            raise ZhongkuiScanError(
+                "exiftool daemon can not take newline in arguments")
+        if not self.running:
+            self.kill()
+            self.start()
+
+        command = "\n".join(str(arg) for arg in args) + "\n-execute\n"
+        try:
+            self.proc.stdin.write(command.encode("utf-8"))
+            self.proc.stdin.flush()
+        except OSError as e:
+            self.kill()
+            raise ZhongkuiScanError(
+                "exiftool daemon write error: {}".format(e))
+
+        fd = self.proc.stdout.fileno()
+        deadline = time.monotonic() + timeout
+        output = bytearray()
+        with selectors.DefaultSelector() as selector:
+            selector.register(fd, selectors.EVENT_READ)
+            while not output.rstrip().endswith(EXIFTOOL_READY):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not selector.select(remaining):
+                    self.kill()
+                    raise ZhongkuiScanTimeoutError("exiftool daemon timeout")
+                chunk = os.read(fd, 65536)
+                if not chunk:
+                    self.kill()
+                    raise ZhongkuiScanError("exiftool daemon exited")
+                output.extend(chunk)
+
+        return bytes(output.rstrip()[:-len(EXIFTOOL_READY)])
+
+
+class ExiftoolPool:
+    """A pool of `ExiftoolProcess` shared by the current process"""
+    _pool = None
+    _lock = threading.Lock()
+
+    def __init__(self, size=2, timeout=15, executable="exiftool"):
+        """
+        Args:
+            size: number of exiftool workers
+            timeout: default seconds per request
+            executable: exiftool executable
+        """
+        self.size = size
+        self.timeout = timeout
+        self.pid = os.getpid()
+        self.workers = [ExiftoolProcess(executable) for _ in range(size)]
+        self.idle = queue.Queue()
+        for worker in self.workers:
+            self.idle.put(worker)
+
+    def execute(self, *args, timeout: Optional[float] = None) -> bytes:
+        """Run one exiftool command on an idle worker.
+        Raise:
+            ZhongkuiScanError
+        Return:
+            stdout of the command
+        """
+        worker = self.idle.get()
+        try:
+            return worker.execute(*args, timeout=timeout or self.timeout)
+        finally:
+            self.idle.put(worker)
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+
+    @classmethod
+    def set(cls, size=2, timeout=15, executable="exiftool"):
+        with cls._lock:
+            if cls._pool is not None and cls._pool.pid == os.getpid():
+                cls._pool.close()
+            cls._pool = cls(size, timeout, executable)
+        return cls._pool
+
+    @classmethod
+    def get(cls):
+        with cls._lock:
+            # a forked child must not share pipes with its parent
+            if cls._pool is None or cls._pool.pid != os.getpid():
+                cls._pool = cls()
+        return cls._pool
+
+    @classmethod
+    def shutdown(cls):
+        with cls._lock:
+            if cls._pool is not None and cls._pool.pid == os.getpid():
+                cls._pool.close()
+            cls._pool = None
+
+
+atexit.register(ExiftoolPool.shutdown)
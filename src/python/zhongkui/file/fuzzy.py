@@ -0,0 +1,287 @@
+"""in-process ssdeep compatible context triggered piecewise hashing
+
+The digest follows ssdeep's streaming `fuzzy_update`/`fuzzy_digest`:
+every block size from `MIN_BLOCKSIZE` up is hashed at once, and the
+final block size is picked from the total length.
+
+Two tricks keep the per-byte work small:
+
+- the rolling hash only depends on the last `ROLLING_WINDOW` bytes, so
+  it is computed for a whole chunk at once with numpy, and the python
+  loop only visits bytes where the smallest live block size triggers;
+- only the low 6 bits of the FNV piece hashes are ever used, and each
+  byte permutes those 64 states. `_perm` is the permutation of all
+  bytes so far (`bytes.translate` composes it one byte per call, driven
+  by `functools.reduce` to stay out of the interpreter loop), and
+  a piece hash is stored as the start state `q` whose image `_perm[q]`
+  is its current value. Resetting a piece hash is `_perm.index(init)`.
+"""
+import re
+from functools import reduce
+import numpy as np
+from typing import Tuple
+from .stream import StreamConsumer
+
+ROLLING_WINDOW = 7
+MIN_BLOCKSIZE = 3
+HASH_PRIME = 0x01000193
+HASH_INIT = 0x28021967
+NUM_BLOCKHASHES = 31
+SPAMSUM_LENGTH = 64
+
+B64 = b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"
+
+# rolling hash sums are computed this many bytes at a time
+ROLL_BLOCK_SIZE = 1024 * 1024
+
+_INIT = HASH_INIT % 64
+# translate tables: `_TABLES[c][h]` is the 6-bit sum hash of `h` and `c`
+_TABLES = [
+    bytes(((h * HASH_PRIME) ^ c) % 64 if h < 64 else 0 for h in range(256))
+    for c in range(256)
+]
+_IDENTITY = bytes(range(64))
+
+
+class _BlockHash:
+    """digest state of one block size"""
+    __slots__ = ("h", "halfh", "digest", "halfdigest", "lastdigest")
+
+    def __init__(self, h, halfh):
+        self.h = h  # start state of the piece hash, see `_perm`
+        self.halfh = halfh
+        self.digest = bytearray()
+        self.halfdigest = 0
+        # last char of a full digest, replaced on each trigger
+        self.lastdigest = 0
+
+
+class FuzzyHash(StreamConsumer):
+    """ssdeep digest of a chunk stream"""
+    name = "ssdeep"
+
+    def __init__(self):
+        self.total_size = 0
+        self._processed = 0
+        self._perm = _IDENTITY
+        self._window = np.zeros(ROLLING_WINDOW, dtype=np.uint8)
+        self._roll = 0
+        self._bhstart = 0
+        self._bh = [_BlockHash(_INIT, _INIT)]
+        self._lasth = None
+
+    def update(self, chunk):
+        self.total_size += len(chunk)
+        chunk = memoryview(chunk)
+        start = 0
+        while start < len(chunk):
+            # small blocks while the smallest live block size is small,
+            # so a block holds few possible triggers
+            size = min(ROLL_BLOCK_SIZE, max(4096, self._processed))
+            self._update(chunk[start:start + size])
+            self._processed += len(chunk[start:start + size])
+            start += size
+
+    def _rollSums(self, data: np.ndarray) -> np.ndarray:
+        """rolling hash after each byte of data
+
+        h1 + h2 weighs the last `ROLLING_WINDOW` bytes by 8, 7, ..., 2,
+        and h3 xors them shifted by 0, 5, ..., 30 bits.
+        """
+        ext = np.concatenate((self._window, data)).astype(np.uint32)
+        n = len(data)
+        sums = np.zeros(n, dtype=np.uint32)
+        h3 = np.zeros(n, dtype=np.uint32)
+        for k in range(ROLLING_WINDOW):
+            byte = ext[ROLLING_WINDOW - k:ROLLING_WINDOW - k + n]
+            sums += byte * np.uint32(ROLLING_WINDOW + 1 - k)
+            h3 ^= byte << np.uint32(5 * k)
+        sums += h3
+        self._window = ext[-ROLLING_WINDOW:].astype(np.uint8)
+        return sums
+
+    def _update(self, chunk):
+        data = np.frombuffer(chunk, dtype=np.uint8)
+        if not len(data):
+            return
+        sums = self._rollSums(data)
+        self._roll = int(sums[-1])
+
+        # block sizes only grow, so these are all possible triggers
+        size = MIN_BLOCKSIZE << self._bhstart
+        triggers = np.flatnonzero(sums % size == size - 1)
+
+        raw = chunk.tobytes()
+        table = _TABLES.__getitem__
+        pos = 0
+        for end, h in zip(triggers.tolist(), sums[triggers].tolist()):
+            if h % size != size - 1:
+                continue
+            self._perm = reduce(bytes.translate, map(table, raw[pos:end + 1]),
+                                self._perm)
+            pos = end + 1
+            self._trigger(h)
+            size = MIN_BLOCKSIZE << self._bhstart
+        self._perm = reduce(bytes.translate, map(table, raw[pos:]),
+                            self._perm)
+
+    def _trigger(self, h):
+        """ssdeep `fuzzy_engine_step` after the sum hashes are updated"""
+        perm = self._perm
+        i = self._bhstart
+        while i < len(self._bh):
+            size = MIN_BLOCKSIZE << i
+            if h % size != size - 1:
+                break
+            bh = self._bh[i]
+            if not bh.digest:
+                self._fork()
+            char = B64[perm[bh.h]]
+            bh.halfdigest = B64[perm[bh.halfh]]
+            if len(bh.digest) < SPAMSUM_LENGTH - 1:
+                bh.digest.append(char)
+                bh.h = perm.index(_INIT)
+                if len(bh.digest) < SPAMSUM_LENGTH // 2:
+                    bh.halfh = bh.h
+                    bh.halfdigest = 0
+            else:
+                bh.lastdigest = char
+                self._reduce()
+            i += 1
+
+    def _fork(self):
+        """ssdeep `fuzzy_try_fork_blockhash`"""
+        last = self._bh[-1]
+        if len(self._bh) < NUM_BLOCKHASHES:
+            self._bh.append(_BlockHash(last.h, last.halfh))
+        elif self._lasth is None:
+            self._lasth = last.h
+
+    def _reduce(self):
+        """ssdeep `fuzzy_try_reduce_blockhash`"""
+        if len(self._bh) - self._bhstart < 2:
+            return
+        size = MIN_BLOCKSIZE << self._bhstart
+        if size * SPAMSUM_LENGTH >= self.total_size:
+            return
+        if len(self._bh[self._bhstart + 1].digest) < SPAMSUM_LENGTH // 2:
+            return
+        self._bhstart += 1
+
+    def result(self) -> str:
+        """ssdeep `fuzzy_digest` without flags"""
+        perm = self._perm
+        h = self._roll
+        bi = self._bhstart
+        while (MIN_BLOCKSIZE << bi) * SPAMSUM_LENGTH < self.total_size:
+            bi += 1
+            if bi >= NUM_BLOCKHASHES:
+                raise ValueError("input too large for ssdeep")
+        bi = min(bi, len(self._bh) - 1)
+        while (bi > self._bhstart
+               and len(self._bh[bi].digest) < SPAMSUM_LENGTH // 2):
+            bi -= 1
+
+        bh = self._bh[bi]
+        result = bytearray(b"%d:" % (MIN_BLOCKSIZE << bi))
+        result += bh.digest
+        if h != 0:
+            result.append(B64[perm[bh.h]])
+        elif bh.lastdigest:
+            result.append(bh.lastdigest)
+        result += b":"
+
+        if bi < len(self._bh) - 1:
+            bh = self._bh[bi + 1]
+            result += bh.digest[:SPAMSUM_LENGTH // 2 - 1]
+            if h != 0:
+                result.append(B64[perm[bh.halfh]])
+            elif bh.halfdigest:
+                result.append(bh.halfdigest)
+        elif h != 0:
+            last = self._bh[bi].h if bi == 0 else self._lasth
+            result.append(B64[perm[last]])
+
+        return result.decode("ascii")
+
+
+def fuzzyHash(data) -> str:
+    """ssdeep digest of data"""
+    fuzzy = FuzzyHash()
+    fuzzy.update(data)
+    return fuzzy.result()
+
+
+def _eliminateSequences(digest: str) -> str:
+    """ssdeep `eliminate_sequences`, runs longer than 3 are cut to 3"""
+    return re.sub(r"(.)\1{3,}", r"\1\1\1", digest)
+
+
+def _hasCommonSubstring(s1: str, s2: str) -> bool:
+    pieces = {
+        s1[i:i + ROLLING_WINDOW]
+        for i in range(len(s1) - ROLLING_WINDOW + 1)
+    }
+    return any(s2[i:i + ROLLING_WINDOW] in pieces
+               for i in range(len(s2) - ROLLING_WINDOW + 1))
+
+
+def _editDistance(s1: str, s2: str) -> int:
+    """ssdeep `edit_distn`, insert and remove cost 1, replace costs 2"""
+    previous = list(range(len(s2) + 1))
+    for i, c1 in enumerate(s1, 1):
+        current = [i]
+        for j, c2 in enumerate(s2, 1):
+            current.append(
+                min(previous[j] + 1, current[j - 1] + 1,
+                    previous[j - 1] + (0 if c1 == c2 else 2)))
+        previous = current
+    return previous[-1]
+
+
+def _scoreStrings(s1: str, s2: str, block_size: int) -> int:
+    """ssdeep `score_strings`"""
+    if len(s1) > SPAMSUM_LENGTH or len(s2) > SPAMSUM_LENGTH:
+        return 0
+    if not _hasCommonSubstring(s1, s2):
+        return 0
+
+    score = _editDistance(s1, s2)
+    score = (score * SPAMSUM_LENGTH) // (len(s1) + len(s2))
+    score = (100 * score) // SPAMSUM_LENGTH
+    if score >= 100:
+        return 0
+    score = 100 - score
+
+    threshold = (99 + ROLLING_WINDOW) // ROLLING_WINDOW * MIN_BLOCKSIZE
+    if block_size >= threshold:
+        return score
+    return min(score, block_size // MIN_BLOCKSIZE * min(len(s1), len(s2)))
+
+
+def _parse(digest: str) -> Tuple[int, str, str]:
+    block_size, s1, s2 = digest.split(",")[0].split(":", 2)
+    return int(block_size), s1, s2
+
+
+def compareFuzzyHash(digest1: str, digest2: str) -> int:
+    """ssdeep `fuzzy_compare`, match score from 0 to 100
+    Raise:
+        ValueError: a digest is malformed
+    """
+    bs1, s1_1, s1_2 = _parse(digest1)
+    bs2, s2_1, s2_2 = _parse(digest2)
+    if bs1 != bs2 and bs1 != bs2 * 2 and bs2 != bs1 * 2:
+        return 0
+
+    s1_1, s1_2 = _eliminateSequences(s1_1), _eliminateSequences(s1_2)
+    s2_1, s2_2 = _eliminateSequences(s2_1), _eliminateSequences(s2_2)
+    if bs1 == bs2 and s1_1 == s2_1 and s1_2 == s2_2:
+        return 100
+
+    if bs1 == bs2:
+        return max(_scoreStrings(s1_1, s2_1, bs1),
+                   _scoreStrings(s1_2, s2_2, bs1 * 2))
+    elif bs1 == bs2 * 2:
+        return _scoreStrings(s1_1, s2_2, bs1)
+    return _scoreStrings(s1_2, s2_1, bs2)
@@ -0,0 +1,170 @@
+"""stage timings and metrics exporters
+
+A stage records wall time, CPU time of the running thread, bytes read
+and subprocesses spawned while it runs:
+
+    with stage("trid") as timing:
+        tridScan(path)
+    timing.wall, timing.spawns
+
+Finished stages are sent to the exporters added with `addExporter`.
+"""
+import time
+import logging
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Tuple
+
+log = logging.getLogger(__name__)
+
+# exported metric names, labelled with the stage name
+STAGE_CALLS = "zhongkui_stage_calls_total"
+STAGE_WALL = "zhongkui_stage_wall_seconds"
+STAGE_CPU = "zhongkui_stage_cpu_seconds"
+STAGE_BYTES = "zhongkui_stage_bytes_read_total"
+STAGE_SPAWNS = "zhongkui_stage_spawns_total"
+
+
+@dataclass
+class StageTiming:
+    """Args:
+        wall: seconds from start to end
+        cpu: CPU seconds of the thread running the stage, subprocesses
+            and other threads excluded
+        bytesRead: bytes of the file read
+        spawns: subprocesses started
+    """
+    wall: float = 0.0
+    cpu: float = 0.0
+    bytesRead: int = 0
+    spawns: int = 0
+
+
+class MetricsExporter:
+    """Receives counters and histograms, subclass it to forward them to a
+    metrics system. Methods are called from scanner threads.
+    """
+    def counter(self, name: str, value: float, labels: Dict[str, str]):
+        pass
+
+    def histogram(self, name: str, value: float, labels: Dict[str, str]):
+        pass
+
+
+class MemoryExporter(MetricsExporter):
+    """keeps counters and histogram observations in memory"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: Dict[Tuple, float] = {}
+        self.histograms: Dict[Tuple, List[float]] = {}
+
+    @staticmethod
+    def _key(name, labels) -> Tuple:
+        return (name, ) + tuple(sorted(labels.items()))
+
+    def counter(self, name, value, labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def histogram(self, name, value, labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self.histograms.setdefault(key, []).append(value)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """counters and histogram observations keyed by `name{labels}`"""
+        def label(key):
+            labels = ",".join("{}={}".format(k, v) for k, v in key[1:])
+            return "{}{{{}}}".format(key[0], labels)
+
+        with self._lock:
+            return {
+                "counters": {label(k): v
+                             for k, v in self.counters.items()},
+                "histograms": {label(k): list(v)
+                               for k, v in self.histograms.items()},
+            }
+
+
+_exporters: List[MetricsExporter] = []
+# stages running in the current thread or task, innermost last
+_stages = contextvars.ContextVar("zhongkui_stages", default=())
+
+
+def addExporter(exporter: MetricsExporter) -> MetricsExporter:
+    _exporters.append(exporter)
+    return exporter
+
+
+def removeExporter(exporter: MetricsExporter):
+    if exporter in _exporters:
+        _exporters.remove(exporter)
+
+
+def addBytes(size: int):
+    """count bytes read in the running stages"""
+    for timing in _stages.get():
+        timing.bytesRead += size
+
+
+def addSpawn():
+    """count a subprocess started in the running stages"""
+    for timing in _stages.get():
+        timing.spawns += 1
+
+
+def export(name: str, timing: StageTiming):
+    """send a finished stage to the exporters"""
+    labels = {"stage": name}
+    for exporter in list(_exporters):
+        try:
+            exporter.counter(STAGE_CALLS, 1, labels)
+            exporter.histogram(STAGE_WALL, timing.wall, labels)
+            exporter.histogram(STAGE_CPU, timing.cpu, labels)
+            exporter.counter(STAGE_BYTES, timing.bytesRead, labels)
+            exporter.counter(STAGE_SPAWNS, timing.spawns, labels)
+        except Exception as e:
+            log.error("metrics exporter error: {}".format(e))
+
+
+@contextmanager
+def stage(name: str, exporting=True) -> Iterator[StageTiming]:
+    """Time a stage.
+    Args:
+        name: stage name, the `stage` label of exported metrics
+        exporting: send the timing to the exporters when the stage ends
+    """
+    timing = StageTiming()
+    token = _stages.set(_stages.get() + (timing, ))
+    wall, cpu = time.perf_counter(), time.thread_time()
+    try:
+        yield timing
+    finally:
+        timing.wall = time.perf_counter() - wall
+        timing.cpu = time.thread_time() - cpu
+        _stages.reset(token)
+        if exporting:
+            export(name, timing)
+
+
+def timed(name: str, func, *args) -> Tuple[Any, StageTiming]:
+    """call `func` in a stage, the stage is not exported so the caller
+    can decide, e.g. `ScanScheduler` exports successful tasks only
+    """
+    with stage(name, exporting=False) as timing:
+        result = func(*args)
+    return result, timing
+
+
+def instrumented(func):
+    """run every call of a scanner function in a stage of its name"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with stage(func.__name__):
+            return func(*args, **kwargs)
+
+    return wrapper
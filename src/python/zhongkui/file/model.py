@@ -19,16 +19,29 @@ class STATICINFO:
     BASIC = "basicInfo"
     DIEC = "diecInfo"
     PE = "peInfo"
+    ELF = "elfInfo"
+    TIMINGS = "timings"
     EXIFTOOL = "exiftoolInfo"
 
 
+class SCAN:
+    ERROR = "scanError"
+
+
 class PEFILE:
     ISPROBABLYPACKED = "isProbablyPacked"
 
 
 class FILETYPE:
     PE = ("Win32 EXE", "Win32 DLL", "Win64 DLL", "Win64 EXE")
-    ELF = ("ELF executable", "ELF shared library")
+    ELF = ("ELF executable", "ELF shared library", "ELF object file",
+           "ELF core dump")
+    MACHO = ("Mach-O executable", "Mach-O dynamic library", "Mach-O bundle",
+             "Mach-O object file", "Mach-O fat binary")
+    ARCHIVE = ("ZIP", "RAR", "7Z", "GZIP", "BZ2", "XZ", "TAR", "CAB")
+    DOCUMENT = ("PDF", "RTF")
+    SCRIPT = ("Shell script", "Python script", "Perl script", "Ruby script",
+              "Node.js script", "PHP script")
 
 
 class EXIFTOOL:
@@ -55,6 +68,17 @@ class FileinfoBasic:
     timeStamp: str = field(default="")
 
 
+@dataclass
+class EntropyProfile:
+    window: int = field(default=0)
+    step: int = field(default=0)
+    size: int = field(default=0)
+    entropy: float = field(default=0.0)
+    entropies: List[float] = field(default_factory=list)
+    highFraction: float = field(default=0.0)
+    highRegions: List[List[int]] = field(default_factory=list)
+
+
 # pe header
 @dataclass
 class PEHeader:
@@ -87,4 +111,51 @@ class PEfileInfo:
     header: PEHeader = field(default_factory=PEHeader)
     sections: List[PESection] = field(default_factory=list)
     imports: List[PEImport] = field(default_factory=list)
-    isProbablyPacked: bool = field(default=False)
\ No newline at end of file
+    isProbablyPacked: bool = field(default=False)
+
+
+# elf header
+@dataclass
+class ELFHeader:
+    elfClass: str = field(default="")
+    endianness: str = field(default="")
+    type: str = field(default="")
+    machine: str = field(default="")
+    entryPoint: str = field(default="")
+    sections: int = field(default=0)
+    segments: int = field(default=0)
+
+
+# elf section
+@dataclass
+class ELFSection:
+    name: str = field(default="")
+    type: str = field(default="")
+    address: str = field(default="")
+    offset: str = field(default="")
+    size: str = field(default="")
+    entropy: float = field(default=0.0)
+    md5: str = field(default="")
+
+
+# elf segment
+@dataclass
+class ELFSegment:
+    type: str = field(default="")
+    flags: str = field(default="")
+    offset: str = field(default="")
+    virtualAddress: str = field(default="")
+    fileSize: str = field(default="")
+    memorySize: str = field(default="")
+
+
+# elf info
+@dataclass
+class ELFInfo:
+    header: ELFHeader = field(default_factory=ELFHeader)
+    sections: List[ELFSection] = field(default_factory=list)
+    segments: List[ELFSegment] = field(default_factory=list)
+    interpreter: str = field(default="")
+    needed: List[str] = field(default_factory=list)
+    dynamicSymbols: List[str] = field(default_factory=list)
+    isProbablyPacked: bool = field(default=False)
@@ -0,0 +1,54 @@
+"""analysis profiles, the scanners a `File` analysis runs
+
+    triage    hashes, native type sniffing and entropy, no subprocess
+    standard  triage and libmagic, trid, exiftool and diec
+    full      standard and pefile or elfScan
+
+A profile is a name or an explicit set of scanners:
+
+    sample.getAllInfo(profile="triage")
+    sample.getAllInfo(profile={"hashes", "sniff", "magic"})
+"""
+from typing import FrozenSet, Iterable, Optional, Union
+
+# hashes and entropy come from the stream pass, the others are scanners
+SCANNERS = ("hashes", "sniff", "entropy", "magic", "trid", "exiftool",
+            "diec", "pefile", "elfinfo")
+
+TRIAGE = "triage"
+STANDARD = "standard"
+FULL = "full"
+
+PROFILES = {
+    TRIAGE: frozenset(("hashes", "sniff", "entropy")),
+    STANDARD: frozenset(("hashes", "sniff", "entropy", "magic", "trid",
+                         "exiftool", "diec")),
+    FULL: frozenset(SCANNERS),
+}
+
+Profile = Union[str, Iterable[str]]
+
+
+def resolveProfile(profile: Optional[Profile] = None) -> FrozenSet[str]:
+    """Scanners of a profile.
+    Args:
+        profile: profile name, iterable of scanner names or `None` for
+            the full profile
+    Raise:
+        ValueError: unknown profile or scanner
+    Return:
+        scanner names
+    """
+    if profile is None:
+        return PROFILES[FULL]
+    if isinstance(profile, str):
+        if profile not in PROFILES:
+            raise ValueError("unknown profile: {}, expect one of {}".format(
+                profile, ", ".join(PROFILES)))
+        return PROFILES[profile]
+    scanners = frozenset(profile)
+    unknown = scanners.difference(SCANNERS)
+    if unknown:
+        raise ValueError("unknown scanners: {}".format(", ".join(
+            sorted(unknown))))
+    return scanners
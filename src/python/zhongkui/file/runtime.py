@@ -0,0 +1,232 @@
+"""external scanner runtime: timeouts, circuit breakers, process groups
+
+Each tool has a `ToolPolicy`. Its timeout grows with the size of the
+scanned files, and a tool that keeps failing is not called again until
+its cool-down has passed:
+
+    setPolicy("diec", timeout=5, failures=3, cooldown=120)
+"""
+import os
+import time
+import signal
+import logging
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass, replace
+from subprocess import Popen, PIPE, TimeoutExpired
+from typing import Dict, Optional
+from .metrics import addSpawn
+from .exceptions import (ZhongkuiScanError, ZhongkuiScanTimeoutError,
+                         ZhongkuiToolMissingError,
+                         ZhongkuiToolUnavailableError)
+
+log = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+
+@dataclass(frozen=True)
+class ToolPolicy:
+    """Args:
+        timeout: seconds allowed for one file
+        per_mb: extra seconds per MB scanned
+        max_timeout: upper bound of the timeout for one file
+        failures: consecutive failures that open the circuit
+        cooldown: seconds an open circuit rejects calls
+    """
+    timeout: float = 15
+    per_mb: float = 0.5
+    max_timeout: float = 120
+    failures: int = 3
+    cooldown: float = 60
+
+
+DEFAULT_POLICY = ToolPolicy()
+
+_policies = {
+    "exiftool": ToolPolicy(timeout=15, per_mb=0.2),
+    "trid": ToolPolicy(timeout=10, per_mb=0.1),
+    "diec": ToolPolicy(timeout=15, per_mb=1),
+}
+
+
+def setPolicy(tool: str, **kwargs) -> ToolPolicy:
+    """change fields of the policy of a tool, e.g. `timeout=5`"""
+    policy = replace(getPolicy(tool), **kwargs)
+    _policies[tool] = policy
+    breaker = _breakers.get(tool)
+    if breaker is not None:
+        breaker.failures, breaker.cooldown = policy.failures, policy.cooldown
+    return policy
+
+
+def getPolicy(tool: str) -> ToolPolicy:
+    return _policies.get(tool, DEFAULT_POLICY)
+
+
+def fileSize(*targets) -> int:
+    """total bytes of targets, unreadable targets count 0"""
+    size = 0
+    for target in targets:
+        try:
+            size += os.path.getsize(target)
+        except (OSError, TypeError):
+            pass
+    return size
+
+
+def timeoutFor(tool: str, size: int = 0, count: int = 1) -> float:
+    """seconds allowed to scan `count` files of `size` bytes in total"""
+    policy = getPolicy(tool)
+    return min(policy.timeout * count + policy.per_mb * size / MB,
+               policy.max_timeout * count)
+
+
+class CircuitBreaker:
+    """Stop calling a tool after `failures` consecutive failures.
+
+    The circuit opens for `cooldown` seconds, then lets a single call
+    through: the circuit closes if it succeeds and opens again if not.
+    """
+    def __init__(self, tool: str, failures=3, cooldown=60):
+        self.tool = tool
+        self.failures = failures
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._count = 0
+        self._opened = None
+        self._probing = False
+
+    @property
+    def isOpen(self) -> bool:
+        return self._opened is not None
+
+    def allow(self) -> bool:
+        """the tool may be called now"""
+        with self._lock:
+            if self._opened is None:
+                return True
+            if (not self._probing
+                    and time.monotonic() - self._opened >= self.cooldown):
+                self._probing = True
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            if self._opened is not None:
+                log.info("{} circuit closed".format(self.tool))
+            self._count = 0
+            self._opened = None
+            self._probing = False
+
+    def failure(self, trip=False):
+        """count a failure
+        Args:
+            trip: open the circuit now, e.g. the tool is not installed
+        """
+        with self._lock:
+            self._count += 1
+            self._probing = False
+            if trip or self._count >= self.failures:
+                if self._opened is None:
+                    log.warning("{} circuit open for {}s after {} failures".
+                                format(self.tool, self.cooldown, self._count))
+                self._opened = time.monotonic()
+
+    def abort(self):
+        """a call ended without a verdict, e.g. it was interrupted"""
+        with self._lock:
+            self._probing = False
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker(tool: str) -> CircuitBreaker:
+    """the circuit breaker of a tool in this process"""
+    with _breakers_lock:
+        if tool not in _breakers:
+            policy = getPolicy(tool)
+            _breakers[tool] = CircuitBreaker(tool, policy.failures,
+                                             policy.cooldown)
+        return _breakers[tool]
+
+
+@contextmanager
+def circuit(tool: str):
+    """Guard a call of a tool with its circuit breaker.
+    Raise:
+        ZhongkuiToolUnavailableError: the circuit is open
+    """
+    guard = breaker(tool)
+    if not guard.allow():
+        raise ZhongkuiToolUnavailableError(
+            "{} unavailable, circuit open".format(tool))
+    try:
+        yield guard
+    except ZhongkuiToolMissingError:
+        guard.failure(trip=True)
+        raise
+    except ZhongkuiScanError:
+        guard.failure()
+        raise
+    except BaseException:
+        guard.abort()
+        raise
+    guard.success()
+
+
+def killGroup(proc: Popen):
+    """kill the process group of a `start_new_session` child and reap it"""
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        proc.kill()
+    proc.communicate()
+
+
+def run(name: str,
+        args,
+        size: int = 0,
+        count: int = 1,
+        timeout: Optional[float] = None) -> bytes:
+    """Run an external scanner and return its stdout.
+
+    The scanner runs in its own session, so a timeout kills the helpers
+    it started too.
+    Args:
+        name: scanner name for messages
+        args: command, the tool is `args[0]`
+        size: bytes scanned, extends the timeout of the tool policy
+        count: files scanned
+        timeout: seconds, overrides the tool policy
+    Raise:
+        ZhongkuiToolUnavailableError: the circuit of the tool is open
+        ZhongkuiToolMissingError: the tool can not start
+        ZhongkuiScanTimeoutError
+    """
+    tool = os.path.basename(str(args[0]))
+    if timeout is None:
+        timeout = timeoutFor(tool, size, count)
+    with circuit(tool):
+        try:
+            proc = Popen([str(arg) for arg in args],
+                         stdout=PIPE,
+                         start_new_session=True)
+        except OSError as e:
+            raise ZhongkuiToolMissingError("{} start error: {}".format(
+                name, e))
+        addSpawn()
+        try:
+            stdout, _ = proc.communicate(timeout=timeout)
+        except TimeoutExpired:
+            killGroup(proc)
+            log.error("{} timeout after {:.1f}s".format(name, timeout))
+            raise ZhongkuiScanTimeoutError("{} timeout after {:.1f}s".format(
+                name, timeout))
+        except BaseException:
+            killGroup(proc)
+            raise
+    return stdout
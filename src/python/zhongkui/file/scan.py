@@ -1,19 +1,77 @@
+import os
 import logging
 import json
+import hashlib
+import threading
 import magic
 import pefile
-from peutils import is_probably_packed
 from datetime import datetime
-from subprocess import Popen, PIPE, TimeoutExpired
 from pathlib import Path
-from typing import Dict
+from typing import Dict, Iterable, Tuple, Union
 from dataclasses import asdict
 from .exceptions import ZhongkuiScanError
-from .model import PEfileInfo, PESection, PEImport
+from .entropy import ENTROPY_THRESHOLD, shannonEntropy
+from .exiftool import ExiftoolPool
+from .fuzzy import ROLL_BLOCK_SIZE, FuzzyHash
+from .model import SCAN, PEfileInfo, PESection, PEImport
+from .metrics import addBytes, instrumented
+from .runtime import circuit, fileSize, run, timeoutFor
+from .trid import TridIndex
 
 log = logging.getLogger(__name__)
 
 
+BATCH_MAX_ARGS = 256
+# bytes of a file libmagic reads, if it can not tell
+MAGIC_HEADER_SIZE = 1024 * 1024
+BATCH_MAX_CHARS = 128 * 1024
+
+
+def _batches(targets, max_args=BATCH_MAX_ARGS, max_chars=BATCH_MAX_CHARS):
+    """split targets into batches bounded by count and argument length"""
+    batch, chars = [], 0
+    for target in targets:
+        size = len(str(target)) + 1
+        if batch and (len(batch) >= max_args or chars + size > max_chars):
+            yield batch
+            batch, chars = [], 0
+        batch.append(target)
+        chars += size
+    if batch:
+        yield batch
+
+
+def _scanEach(scan, targets) -> Dict[str, Dict[str, str]]:
+    """scan targets one by one, isolating errors per target"""
+    results = {}
+    for target in targets:
+        try:
+            results[str(target)] = scan(target)
+        except Exception as e:
+            results[str(target)] = {SCAN.ERROR: str(e)}
+    return results
+
+
+def _filterExiftool(results: Dict[str, str]) -> Dict[str, str]:
+    ignores = [
+        'SourceFile', 'ExifToolVersion', 'FileName', 'Directory',
+        'FilePermissions', ''
+    ]
+
+    nulls = ('', '(none)')
+
+    # filter results
+    for k, v in results.items():
+        if v in nulls:
+            ignores.append(k)
+
+    for key in ignores:
+        results.pop(key, [])
+
+    return results
+
+
+@instrumented
 def exiftoolScan(target: Path) -> Dict[str, str]:
     '''exiftool scan target
     Args:
@@ -26,17 +84,27 @@ def exiftoolScan(target: Path) -> Dict[str, str]:
     # ? http://owl.phy.queensu.ca/~phil/exiftool/exiftool_pod.html#Input-output-text-formatting
     # -charset [[TYPE=]CHARSET]        Specify encoding for special characters
     # -j[[+]=JSONFILE] (-json)         Export/import tags in JSON format
-    args = ('exiftool', '-charset', 'utf-8', '-json', target)
-    proc = Popen(args, stdout=PIPE)
-    try:
-        stdout, stderr = proc.communicate(timeout=15)
-    except TimeoutExpired:
-        proc.kill()
-        stdout, stderr = proc.communicate()
+    size = fileSize(target)
+    if "\n" in str(target):
+        # the daemon reads its arguments line by line
+        stdout = run("exiftoolScan",
+                     ('exiftool', '-charset', 'utf-8', '-json', target), size)
+    else:
+        # the daemon may not share our working directory for long
+        with circuit("exiftool"):
+            stdout = ExiftoolPool.get().execute(
+                '-charset',
+                'utf-8',
+                '-json',
+                os.path.abspath(target),
+                timeout=timeoutFor("exiftool", size))
+
+    results = _parseExiftool(stdout)
+    log.info("finish exftoolScan...")
+    return results
 
-    if stderr:
-        log.error("exiftoolScan stderr: {}".format(stderr))
 
+def _parseExiftool(stdout: bytes) -> Dict[str, str]:
     try:
         stdout = stdout.decode('utf-8', errors='ignore')
         results = json.loads(stdout)[0]
@@ -44,27 +112,56 @@ def exiftoolScan(target: Path) -> Dict[str, str]:
         log.error("exiftoolScan json load error: {}".format(e))
         raise ZhongkuiScanError("exiftoolScan json loads error: {}".format(e))
 
-    ignores = [
-        'SourceFile', 'ExifToolVersion', 'FileName', 'Directory',
-        'FilePermissions', ''
-    ]
-
-    nulls = ('', '(none)')
-
-    # filter results
-    for k, v in results.items():
-        if v in nulls:
-            ignores.append(k)
+    return _filterExiftool(results)
 
-    for key in ignores:
-        results.pop(key, [])
 
-    log.info("finish exftoolScan...")
+@instrumented
+def exiftoolScanMany(targets: Iterable[Path]) -> Dict[str, Dict[str, str]]:
+    '''exiftool scan many targets, a batch of targets per exiftool command
+    Args:
+        targets: Paths to target files
+    Return:
+        A dict of results keyed by target, a failed target gets a
+        `SCAN.ERROR` result
+    '''
+    results = {}
+    for batch in _batches(targets):
+        if any("\n" in str(target) for target in batch):
+            results.update(_scanEach(exiftoolScan, batch))
+            continue
+
+        paths = {os.path.abspath(target): str(target) for target in batch}
+        try:
+            with circuit("exiftool"):
+                stdout = ExiftoolPool.get().execute(
+                    '-charset',
+                    'utf-8',
+                    '-json',
+                    *paths,
+                    timeout=timeoutFor("exiftool", fileSize(*batch),
+                                       len(batch)))
+            stdout = stdout.decode('utf-8', errors='ignore')
+            outputs = json.loads(stdout) if stdout.strip() else []
+        except Exception as e:
+            # retry one by one so a bad target fails alone
+            log.error("exiftoolScanMany batch error: {}".format(e))
+            results.update(_scanEach(exiftoolScan, batch))
+            continue
+
+        for output in outputs:
+            target = paths.pop(output.get('SourceFile'), None)
+            if target is not None:
+                results[target] = _filterExiftool(output)
+        for target in paths.values():
+            results[target] = {SCAN.ERROR: "exiftoolScan no output"}
+
+    log.info("finish exftoolScanMany...")
     return results
 
 
+@instrumented
 def ssdeepScan(target: Path) -> Dict[str, str]:
-    '''ssdeep scan target
+    '''ssdeep scan target, in-process and compatible with `ssdeep -c`
     Args:
         target: A Path to target file
     Raise:
@@ -72,33 +169,34 @@ def ssdeepScan(target: Path) -> Dict[str, str]:
     Return:
         A dict result
     '''
-    # ? ssdeep -h
-    # -c - Prints output in CSV format
-    args = ('ssdeep', '-c', target)
-    proc = Popen(args, stdout=PIPE)
+    fuzzy = FuzzyHash()
     try:
-        stdout, stderr = proc.communicate(timeout=15)
-    except TimeoutExpired:
-        proc.kill()
-        stdout, stderr = proc.communicate()
-
-    if stderr:
-        log.error("ssdeepScan stderr: {}".format(stderr))
-
-    try:
-        stdout = stdout.decode('utf-8', errors='ignore')
-        # ? ssdeep output example
-        # ssdeep,1.1--blocksize:hash:hash,filename
-        # 98304:xhvQdnJ46ub80MndJg1SYArmNTmwR9TOI:LKJ46C8XpYArmNTm6TOI,"/fileinfo/tests/malware"
-        results = {'ssdeep': stdout.splitlines()[1].split(',')[0]}
+        with open(target, "rb") as f:
+            for chunk in iter(lambda: f.read(ROLL_BLOCK_SIZE), b""):
+                addBytes(len(chunk))
+                fuzzy.update(chunk)
+        results = {'ssdeep': fuzzy.result()}
     except Exception as e:
-        log.error("ssdeepScan parse error: {}".format(e))
-        raise ZhongkuiScanError("ssdeepScan parse error: {}".format(e))
+        log.error("ssdeepScan error: {}".format(e))
+        raise ZhongkuiScanError("ssdeepScan error: {}".format(e))
 
     log.info("finish ssdeepScan...")
     return results
 
 
+@instrumented
+def ssdeepScanMany(targets: Iterable[Path]) -> Dict[str, Dict[str, str]]:
+    '''ssdeep scan many targets
+    Args:
+        targets: Paths to target files
+    Return:
+        A dict of results keyed by target, a failed target gets a
+        `SCAN.ERROR` result
+    '''
+    return _scanEach(ssdeepScan, targets)
+
+
+@instrumented
 def diecScan(target: Path) -> Dict[str, str]:
     '''diec scan target
     Args:
@@ -108,17 +206,13 @@ def diecScan(target: Path) -> Dict[str, str]:
     Return:
         A dict result
     '''
-    args = ('diec', target)
-    proc = Popen(args, stdout=PIPE)
-    try:
-        stdout, stderr = proc.communicate(timeout=15)
-    except TimeoutExpired:
-        proc.kill()
-        stdout, stderr = proc.communicate()
+    stdout = run("diecScan", ('diec', target), fileSize(target))
+    results = _parseDiec(stdout)
+    log.info("finish diecScan...")
+    return results
 
-    if stderr:
-        log.error("diecScan stderr: {}".format(stderr))
 
+def _parseDiec(stdout: bytes) -> Dict[str, str]:
     tkeys = ("packer", "protector", "compiler", 'linker')
     results = {}
 
@@ -140,12 +234,46 @@ def diecScan(target: Path) -> Dict[str, str]:
         log.error("diecScan parse error: {}".format(e))
         raise ZhongkuiScanError("diecScan parse error: {}".format(e))
 
-    log.info("finish diecScan...")
     return results
 
 
+@instrumented
+def diecScanMany(targets: Iterable[Path]) -> Dict[str, Dict[str, str]]:
+    '''diec scan many targets
+    diec takes a single target per command, so targets are scanned one
+    by one with errors isolated per target.
+    Args:
+        targets: Paths to target files
+    Return:
+        A dict of results keyed by target, a failed target gets a
+        `SCAN.ERROR` result
+    '''
+    return _scanEach(diecScan, targets)
+
+
+def _parseTrid(lines: Iterable[str]) -> Dict[str, str]:
+    results = {}
+    for line in lines:
+        if "%" not in line:
+            continue
+
+        line_split = line.split('(')
+        if len(line_split) < 2:
+            continue
+
+        key_split = line_split[1].split(')')
+        if len(key_split) < 2:
+            continue
+
+        val = line_split[0].strip()
+        key = key_split[1].strip()
+        results.update({key: val})
+    return results
+
+
+@instrumented
 def tridScan(target: Path) -> Dict[str, str]:
-    '''trid scan target
+    '''trid scan target, in-process if a `TridIndex` is set
     Args:
         target: A Path to target file
     Raise:
@@ -153,36 +281,15 @@ def tridScan(target: Path) -> Dict[str, str]:
     Return:
         A dict result
     '''
-    args = ('trid', target)
-    proc = Popen(args, stdout=PIPE)
-    try:
-        stdout, stderr = proc.communicate(timeout=15)
-    except TimeoutExpired:
-        proc.kill()
-        stdout, stderr = proc.communicate()
+    index = TridIndex.get()
+    if index is not None:
+        return index.scan(target)
 
-    if stderr:
-        log.error("tridScan stderr: {}".format(stderr))
-
-    results = {}
+    stdout = run("tridScan", ('trid', target), fileSize(target))
 
     try:
         stdout = stdout.decode('utf-8', errors='ignore')
-        for line in stdout.splitlines():
-            if "%" not in line:
-                continue
-
-            line_split = line.split('(')
-            if len(line_split) < 2:
-                continue
-
-            key_split = line_split[1].split(')')
-            if len(key_split) < 2:
-                continue
-
-            val = line_split[0].strip()
-            key = key_split[1].strip()
-            results.update({key: val})
+        results = _parseTrid(stdout.splitlines())
     except BaseException as e:
         log.error("tridScan parse error: {}".format(e))
         raise ZhongkuiScanError("tridScan parse error: {}".format(e))
@@ -191,54 +298,268 @@ def tridScan(target: Path) -> Dict[str, str]:
     return results
 
 
-def magicScan(target: Path) -> Dict[str, str]:
-    '''trid scan target
+@instrumented
+def tridScanMany(targets: Iterable[Path]) -> Dict[str, Dict[str, str]]:
+    '''trid scan many targets, a batch of targets per trid command
     Args:
-        target: A Path to target file
+        targets: Paths to target files
+    Return:
+        A dict of results keyed by target, a failed target gets a
+        `SCAN.ERROR` result
+    '''
+    if TridIndex.get() is not None:
+        # no process to share
+        return _scanEach(tridScan, targets)
+
+    # ? trid output example
+    # Collecting data from file: /fileinfo/tests/malware
+    #  53.9% (.EXE) InstallShield setup (43053/19/16)
+    marker = "Collecting data from file:"
+    results = {}
+    for batch in _batches(targets):
+        try:
+            stdout = run("tridScanMany", ('trid', ) + tuple(batch),
+                         fileSize(*batch), len(batch))
+        except ZhongkuiScanError as e:
+            # retry one by one so a bad target fails alone
+            log.error("tridScanMany batch error: {}".format(e))
+            results.update(_scanEach(tridScan, batch))
+            continue
+        blocks, lines = {}, None
+        for line in stdout.decode('utf-8', errors='ignore').splitlines():
+            if line.startswith(marker):
+                lines = blocks.setdefault(line[len(marker):].strip(), [])
+            elif lines is not None:
+                lines.append(line)
+
+        for target in batch:
+            if str(target) in blocks:
+                results[str(target)] = _parseTrid(blocks[str(target)])
+            else:
+                results[str(target)] = {SCAN.ERROR: "tridScan no output"}
+
+    log.info("finish tridScanMany...")
+    return results
+
+
+class MagicDetector:
+    """libmagic cookies loaded once per thread with the magic database"""
+    _local = threading.local()
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.mime = magic.open(magic.MAGIC_MIME)
+        self.name = magic.open(magic.MAGIC_NONE)
+        for cookie in (self.mime, self.name):
+            if cookie.load() != 0:
+                raise ZhongkuiScanError("libmagic load error: {}".format(
+                    cookie.error()))
+        # read as much of a file as libmagic would
+        try:
+            self.header_size = self.mime.getparam(
+                magic.MAGIC_PARAM_BYTES_MAX)
+        except (AttributeError, OSError):
+            self.header_size = MAGIC_HEADER_SIZE
+
+    @classmethod
+    def get(cls) -> "MagicDetector":
+        """the detector of the current thread"""
+        detector = getattr(cls._local, "detector", None)
+        if detector is None or detector.pid != os.getpid():
+            detector = cls._local.detector = cls()
+        return detector
+
+    @staticmethod
+    def _result(mime: str, name: str) -> Dict[str, str]:
+        if mime is None or name is None:
+            raise ZhongkuiScanError("libmagic detect error")
+        mime_type, _, encoding = mime.partition("; ")
+        return {
+            "mime_type": mime_type,
+            "encoding": encoding.replace("charset=", ""),
+            "type_name": name
+        }
+
+    def fromBuffer(self, data: bytes) -> Dict[str, str]:
+        return self._result(self.mime.buffer(data), self.name.buffer(data))
+
+    def fromDescriptor(self, fd: int) -> Dict[str, str]:
+        # libmagic may close the descriptor it is given
+        results = []
+        for cookie in (self.mime, self.name):
+            os.lseek(fd, 0, os.SEEK_SET)
+            dup = os.dup(fd)
+            try:
+                results.append(cookie.descriptor(dup))
+            finally:
+                try:
+                    os.close(dup)
+                except OSError:
+                    pass
+        return self._result(*results)
+
+
+@instrumented
+def magicScan(target: Union[Path, bytes]) -> Dict[str, str]:
+    '''magic scan target on the header of the file
+    Args:
+        target: A Path to target file, or the file contents
+    Raise:
+        ZhongkuiScanError
     Return:
         A dict result
     '''
-    detected = magic.detect_from_filename(target)
+    detector = MagicDetector.get()
+    if isinstance(target, (bytes, bytearray, memoryview)):
+        results = detector.fromBuffer(bytes(target[:detector.header_size]))
+    else:
+        with open(target, "rb") as f:
+            header = f.read(detector.header_size)
+            addBytes(len(header))
+            if header.startswith(b"\x7fELF"):
+                # ELF section headers are read beyond the header
+                results = detector.fromDescriptor(f.fileno())
+            else:
+                results = detector.fromBuffer(header)
     log.info("finish magicScan...")
 
-    return {
-        "mime_type": detected.mime_type,
-        "encoding": detected.encoding,
-        "type_name": detected.name
-    }
+    return results
 
 
-def pefileScan(target: Path) -> Dict[str, str]:
-    '''pefile scan target
+@instrumented
+def magicScanMany(targets: Iterable[Path]) -> Dict[str, Dict[str, str]]:
+    '''magic scan many targets on the cookies of the current thread
+    Args:
+        targets: Paths to target files
+    Return:
+        A dict of results keyed by target, a failed target gets a
+        `SCAN.ERROR` result
+    '''
+    return _scanEach(magicScan, targets)
+
+
+def loadPE(target: Path = None, data: bytes = None) -> pefile.PE:
+    '''parse PE headers and sections, data directories are left for
+    `parsePEDirectories`
     Args:
         target: A Path to target file
+        data: the file contents instead of a path
+    Raise:
+        ZhongkuiScanError
+    '''
+    try:
+        if data is not None:
+            return pefile.PE(data=bytes(data), fast_load=True)
+        pe = pefile.PE(str(target), fast_load=True)
+        addBytes(len(pe.__data__))
+        return pe
+    except Exception as e:
+        log.error("pefile load error: {}".format(e))
+        raise ZhongkuiScanError("pefile load error: {}".format(e))
+
+
+def parsePEDirectories(pe: pefile.PE, *names: str) -> pefile.PE:
+    '''parse data directories of a fast loaded PE once
+    Args:
+        pe: PE from `loadPE`
+        names: directory names, e.g. `IMPORT`, `RESOURCE`
+    '''
+    # a parsed directory sets `pe.DIRECTORY_ENTRY_<name>`
+    missing = [
+        pefile.DIRECTORY_ENTRY["IMAGE_DIRECTORY_ENTRY_" + name]
+        for name in names if not hasattr(pe, "DIRECTORY_ENTRY_" + name)
+    ]
+    if missing:
+        pe.parse_data_directories(directories=missing)
+    return pe
+
+
+def sectionRange(section) -> Tuple[int, int]:
+    '''`[offset, end)` slice of the PE data that `section.get_data()`
+    returns, to slice a memoryview instead of copying
+    '''
+    offset = section.get_PointerToRawData_adj()
+    if section.SizeOfRawData is not None:
+        end = offset + section.SizeOfRawData
+    else:
+        end = offset
+    if (section.PointerToRawData is not None
+            and section.SizeOfRawData is not None):
+        end = min(end, section.PointerToRawData + section.SizeOfRawData)
+    return offset, end
+
+
+def _sectionStats(pe: pefile.PE):
+    '''yield (section, length, entropy, md5) of each section'''
+    with memoryview(pe.__data__) as view:
+        for section in pe.sections:
+            offset, end = sectionRange(section)
+            with view[offset:end] as data:
+                yield (section, len(data), shannonEntropy(data),
+                       hashlib.md5(data).hexdigest())
+
+
+def isProbablyPackedPE(pe: pefile.PE, section_entropies=None) -> bool:
+    '''`peutils.is_probably_packed` on the vectorized entropy engine
+    Args:
+        pe: parsed PE
+        section_entropies: (length, entropy) of each section if known
+    Return:
+        more than 20% of the PE data is in sections with entropy > 7.4
+    '''
+    if section_entropies is None:
+        section_entropies = [(length, entropy)
+                             for _, length, entropy, _ in _sectionStats(pe)]
+
+    # length of `pe.trim()` without copying the data
+    total_pe_data_length = pe.get_overlay_data_start_offset()
+    if total_pe_data_length is None:
+        total_pe_data_length = len(pe.__data__)
+    if not total_pe_data_length:
+        return True
+
+    total_compressed_data = sum(length
+                                for length, entropy in section_entropies
+                                if entropy > ENTROPY_THRESHOLD)
+    return (1.0 * total_compressed_data) / total_pe_data_length > 0.2
+
+
+@instrumented
+def pefileScan(target: Union[Path, pefile.PE]) -> Dict[str, str]:
+    '''pefile scan target
+    Args:
+        target: A Path to target file, or a PE from `loadPE`
     Raise:
         ZhongkuiScanError
     Return:
         A dict result
     '''
-    pe = pefile.PE(target)
+    pe = target if isinstance(target, pefile.PE) else loadPE(target)
     pe_info = PEfileInfo()
+    section_entropies = []
 
     try:
+        # headers, sections and imports only
+        parsePEDirectories(pe, "IMPORT")
         # parse header
         pe_info.header.timestamp = str(
             datetime.fromtimestamp(pe.FILE_HEADER.TimeDateStamp))
         pe_info.header.sections = pe.FILE_HEADER.NumberOfSections
         pe_info.header.entryPoint = str(pe.OPTIONAL_HEADER.AddressOfEntryPoint)
         # parse sections
-        for section in pe.sections:
+        for section, length, entropy, md5 in _sectionStats(pe):
             sec_info = PESection()
             sec_info.name = bytes([i for i in section.Name
                                    if i != 0]).decode("utf-8")
             sec_info.virtualAddress = str(section.VirtualAddress)
             sec_info.virtualSize = str(section.Misc_VirtualSize)
             sec_info.rawSize = str(section.SizeOfRawData)
-            sec_info.entropy = round(section.get_entropy(), 2)
-            sec_info.md5 = section.get_hash_md5()
+            sec_info.entropy = round(entropy, 2)
+            sec_info.md5 = md5
             pe_info.sections.append(sec_info)
+            section_entropies.append((length, entropy))
         # parse imports
-        for entry in pe.DIRECTORY_ENTRY_IMPORT:
+        for entry in getattr(pe, "DIRECTORY_ENTRY_IMPORT", []):
             imp_info = PEImport()
             imp_info.dllName = entry.dll.decode("utf-8")
             imp_info.importFunctions = [
@@ -246,7 +567,7 @@ def pefileScan(target: Path) -> Dict[str, str]:
             ]
             pe_info.imports.append(imp_info)
         # is_probably_packed
-        pe_info.isProbablyPacked = is_probably_packed(pe)
+        pe_info.isProbablyPacked = isProbablyPackedPE(pe, section_entropies)
     except Exception as e:
         log.error("pefile parse error: {}".format(e))
         raise ZhongkuiScanError("pefile parse error: {}".format(e))
@@ -0,0 +1,151 @@
+"""run independent scanners concurrently"""
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+from .metrics import StageTiming, export, timed
+from .model import SCAN
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class ScanTask:
+    """A scanner call scheduled by `ScanScheduler`
+
+    Args:
+        name: result name
+        func: scanner function
+        args: scanner arguments
+        requires: names of tasks that must succeed before this one starts
+        condition: called with the results so far once requirements are
+            met, the task is skipped with a `None` result when it returns
+            False
+    """
+    name: str
+    func: Callable
+    args: Tuple = field(default_factory=tuple)
+    requires: Tuple[str, ...] = field(default_factory=tuple)
+    condition: Optional[Callable[[Dict[str, Any]], bool]] = None
+
+
+class ScanScheduler:
+    """Thread pool for the scanners of a file
+
+    External scanners wait on their subprocess and python parsers work
+    on the PE and ELF shared by the `File`, so both run in threads.
+    Samples are spread over processes by the caller, e.g. the
+    `zhongkui-file scan` command.
+    """
+    _scheduler = None
+    _lock = threading.Lock()
+
+    def __init__(self, max_threads=8, deadline=60):
+        """
+        Args:
+            max_threads: thread pool size
+            deadline: default seconds allowed per `run`
+        """
+        self.max_threads = max_threads
+        self.deadline = deadline
+        self.pid = os.getpid()
+        self._threads = None
+
+    @property
+    def threads(self):
+        if self._threads is None:
+            self._threads = ThreadPoolExecutor(self.max_threads,
+                                               thread_name_prefix="zhongkui")
+        return self._threads
+
+    def run(self, tasks: Iterable[ScanTask],
+            deadline: Optional[float] = None,
+            timings: Optional[Dict[str, StageTiming]] = None
+            ) -> Tuple[Dict[str, Any], Dict[str, float]]:
+        """Run tasks concurrently until they finish or the deadline passes.
+        Args:
+            tasks: tasks to run
+            deadline: seconds allowed for all tasks
+            timings: filled with the `StageTiming` of each finished task
+        Return:
+            results keyed by task name, a failed or unfinished task gets
+            a `SCAN.ERROR` result, and seconds spent by each finished task
+        """
+        tasks = {task.name: task for task in tasks}
+        end = time.monotonic() + (deadline or self.deadline)
+        results, costs, errors = {}, {}, set()
+        waiting = dict(tasks)
+        running = {}
+
+        def fail(name, message):
+            results[name] = {SCAN.ERROR: message}
+            errors.add(name)
+
+        def submit():
+            for name, task in list(waiting.items()):
+                required = [r for r in task.requires if r in tasks]
+                if any(r in errors for r in required):
+                    del waiting[name]
+                    fail(name, "requires {}".format(",".join(required)))
+                elif all(r in results for r in required):
+                    del waiting[name]
+                    condition = task.condition
+                    if condition is not None and not condition(results):
+                        results[name] = None
+                        continue
+                    future = self.threads.submit(timed, name, task.func,
+                                                 *task.args)
+                    running[future] = name
+
+        submit()
+        while running:
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                break
+            done, _ = wait(running, timeout=remaining,
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name], timing = future.result()
+                except Exception as e:
+                    log.error("{} scan error: {}".format(name, e))
+                    fail(name, str(e))
+                    continue
+                # only the stages of successful tasks are exported
+                export(name, timing)
+                costs[name] = timing.wall
+                if timings is not None:
+                    timings[name] = timing
+            submit()
+
+        for future, name in running.items():
+            future.cancel()
+            fail(name, "deadline exceeded")
+        for name in waiting:
+            fail(name, "deadline exceeded")
+
+        return results, costs
+
+    def close(self):
+        if self._threads is not None:
+            self._threads.shutdown(wait=False)
+
+    @classmethod
+    def set(cls, max_threads=8, deadline=60):
+        with cls._lock:
+            scheduler = cls._scheduler
+            if scheduler is not None and scheduler.pid == os.getpid():
+                scheduler.close()
+            cls._scheduler = cls(max_threads, deadline)
+        return cls._scheduler
+
+    @classmethod
+    def get(cls):
+        with cls._lock:
+            if cls._scheduler is None or cls._scheduler.pid != os.getpid():
+                cls._scheduler = cls()
+        return cls._scheduler
@@ -0,0 +1,155 @@
+"""in-process file type identification from header bytes
+
+`sniffFileType` returns the `FILETYPE` labels exiftool would give, or
+`None` to leave the file to exiftool.
+"""
+import os
+import struct
+from typing import Optional
+
+# header bytes read by `sniffFileType`
+SNIFF_SIZE = 4096
+
+IMAGE_FILE_DLL = 0x2000
+PE32_MAGIC = 0x10b
+PE32PLUS_MAGIC = 0x20b
+
+ELF_TYPES = {
+    1: "ELF object file",
+    2: "ELF executable",
+    3: "ELF shared library",
+    4: "ELF core dump",
+}
+
+MACHO_MAGICS = {
+    b"\xfe\xed\xfa\xce": ">",
+    b"\xce\xfa\xed\xfe": "<",
+    b"\xfe\xed\xfa\xcf": ">",
+    b"\xcf\xfa\xed\xfe": "<",
+}
+MACHO_TYPES = {
+    1: "Mach-O object file",
+    2: "Mach-O executable",
+    6: "Mach-O dynamic library",
+    8: "Mach-O bundle",
+}
+
+ARCHIVE_MAGICS = (
+    (b"Rar!\x1a\x07", "RAR"),
+    (b"7z\xbc\xaf\x27\x1c", "7Z"),
+    (b"\xfd7zXZ\x00", "XZ"),
+    (b"\x1f\x8b", "GZIP"),
+    (b"BZh", "BZ2"),
+    (b"MSCF\x00\x00\x00\x00", "CAB"),
+)
+
+DOCUMENT_MAGICS = (
+    (b"%PDF-", "PDF"),
+    (b"{\\rtf", "RTF"),
+)
+
+# first entries of zip based formats exiftool names on its own
+ZIP_CONTAINERS = (b"[Content_Types].xml", b"mimetype", b"META-INF/",
+                  b"AndroidManifest.xml")
+
+INTERPRETERS = {
+    "sh": "Shell script",
+    "bash": "Shell script",
+    "dash": "Shell script",
+    "zsh": "Shell script",
+    "ksh": "Shell script",
+    "python": "Python script",
+    "perl": "Perl script",
+    "ruby": "Ruby script",
+    "node": "Node.js script",
+    "php": "PHP script",
+}
+
+
+def _sniffPE(header: bytes) -> Optional[str]:
+    if len(header) < 0x40:
+        return None
+    offset = struct.unpack_from("<I", header, 0x3c)[0]
+    # signature, COFF header and optional header magic
+    if offset + 26 > len(header) or header[offset:offset + 4] != b"PE\0\0":
+        return None
+    characteristics, = struct.unpack_from("<H", header, offset + 22)
+    magic, = struct.unpack_from("<H", header, offset + 24)
+    if magic == PE32_MAGIC:
+        bits = "32"
+    elif magic == PE32PLUS_MAGIC:
+        bits = "64"
+    else:
+        return None
+    kind = "DLL" if characteristics & IMAGE_FILE_DLL else "EXE"
+    return "Win{} {}".format(bits, kind)
+
+
+def _sniffELF(header: bytes) -> Optional[str]:
+    if len(header) < 18 or header[5] not in (1, 2):
+        return None
+    e_type, = struct.unpack_from("<H" if header[5] == 1 else ">H", header, 16)
+    return ELF_TYPES.get(e_type)
+
+
+def _sniffMachO(header: bytes) -> Optional[str]:
+    if header[:4] == b"\xca\xfe\xba\xbe":
+        # java class files share the magic, their version is >= 45
+        if len(header) >= 8 and struct.unpack_from(">I", header, 4)[0] < 45:
+            return "Mach-O fat binary"
+        return None
+    endian = MACHO_MAGICS.get(header[:4])
+    if endian is None or len(header) < 16:
+        return None
+    filetype, = struct.unpack_from(endian + "I", header, 12)
+    return MACHO_TYPES.get(filetype)
+
+
+def _sniffZip(header: bytes) -> Optional[str]:
+    if header[:4] == b"PK\x05\x06":
+        return "ZIP"
+    if len(header) < 30:
+        return None
+    name_length, = struct.unpack_from("<H", header, 26)
+    name = header[30:30 + name_length]
+    if name.startswith(ZIP_CONTAINERS):
+        return None
+    return "ZIP"
+
+
+def _sniffScript(header: bytes) -> Optional[str]:
+    if header.startswith(b"<?php"):
+        return "PHP script"
+    line = header[2:].split(b"\n", 1)[0].decode("latin-1").split()
+    if not line:
+        return None
+    interpreter = os.path.basename(line[0])
+    if interpreter == "env" and len(line) > 1:
+        interpreter = line[1]
+    # python3.8 -> python
+    interpreter = interpreter.rstrip("0123456789.")
+    return INTERPRETERS.get(interpreter)
+
+
+def sniffFileType(header: bytes) -> Optional[str]:
+    """file type label of the header, `None` if unknown
+    Args:
+        header: the first `SNIFF_SIZE` bytes of the file
+    """
+    header = bytes(header[:SNIFF_SIZE])
+    if header[:2] == b"MZ":
+        return _sniffPE(header)
+    if header[:4] == b"\x7fELF":
+        return _sniffELF(header)
+    if header[:4] in MACHO_MAGICS or header[:4] == b"\xca\xfe\xba\xbe":
+        return _sniffMachO(header)
+    if header[:4] in (b"PK\x03\x04", b"PK\x05\x06"):
+        return _sniffZip(header)
+    for magic, label in ARCHIVE_MAGICS + DOCUMENT_MAGICS:
+        if header.startswith(magic):
+            return label
+    if header[257:262] == b"ustar":
+        return "TAR"
+    if header[:2] == b"#!" or header[:5] == b"<?php":
+        return _sniffScript(header)
+    return None
@@ -0,0 +1,253 @@
+"""content addressed sample store
+
+    root/
+        store.db                    reference counts
+        tmp/                        uploads being written
+        samples/fb/12/fb12aec2...   one file per sha256
+"""
+import os
+import re
+import time
+import sqlite3
+import logging
+import threading
+from pathlib import Path
+from typing import Dict, Optional
+from .core import File, Storage, STORAGE_CHUNK_SIZE
+from .entropy import EntropyEngine
+from .exceptions import ZhongkuiCriticalError
+from .stream import StreamAnalyzer, hashConsumers
+
+log = logging.getLogger(__name__)
+
+# uploads left in tmp/ longer than this are removed by `gc`
+STALE_UPLOAD_SECONDS = 3600
+
+
+class SampleStore:
+    """Deduplicating sample store keyed by sha256.
+
+    A sample is written once to a temporary file, hashed while it is
+    written, and renamed into place. Known samples only get a reference
+    added. Unreferenced samples are removed by `gc`.
+    """
+    def __init__(self, root, max_size=None):
+        """
+        Args:
+            root: store directory
+            max_size: bytes of samples kept by `gc`, `None` for no limit
+        """
+        self.root = Path(root)
+        self.max_size = max_size
+        self.tmp = self.root.joinpath("tmp")
+        self.samples = self.root.joinpath("samples")
+        for path in (self.tmp, self.samples):
+            if not path.exists():
+                os.makedirs(path, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(str(self.root.joinpath("store.db")),
+                                  check_same_thread=False,
+                                  isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS samples (
+            sha256 TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            refs INTEGER NOT NULL,
+            created REAL NOT NULL,
+            accessed REAL NOT NULL)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS samples_gc "
+                        "ON samples (refs, accessed)")
+
+    @staticmethod
+    def _sha256(sha256: str) -> str:
+        """lower case sha256
+        Raise:
+            ValueError: not 64 hex characters, e.g. a path
+        """
+        sha256 = str(sha256).lower()
+        if not re.fullmatch("[0-9a-f]{64}", sha256):
+            raise ValueError("invalid sha256: {!r}".format(sha256))
+        return sha256
+
+    def samplePath(self, sha256: str) -> Path:
+        """two levels of fan-out, e.g. `samples/fb/12/fb12...`
+        Raise:
+            ValueError: not a hex sha256
+        """
+        sha256 = self._sha256(sha256)
+        return self.samples.joinpath(sha256[:2], sha256[2:4], sha256)
+
+    def put(self,
+            content,
+            entropy=True,
+            chunk_size=STORAGE_CHUNK_SIZE,
+            **kwargs) -> File:
+        """Store content and add a reference to it.
+        Args:
+            content: bytes or a readable stream
+            entropy: also compute the entropy profile while writing
+            chunk_size: read size of a stream
+            kwargs: `File` arguments
+        Return:
+            the stored `File`, with hashes computed while writing
+        """
+        analyzer = StreamAnalyzer(hashConsumers())
+        if entropy:
+            analyzer.register(EntropyEngine())
+        tmp_path = Storage.tempPut(content, self.tmp, analyzer, chunk_size)
+        results = analyzer.results()
+        try:
+            self._add(results["sha256"], tmp_path, analyzer.size)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        file = File(self.samplePath(results["sha256"]), **kwargs)
+        file._loadStream(results)
+        return file
+
+    def putFile(self, path, **kwargs) -> File:
+        """Store a file already on disk and add a reference to it.
+        The file is hard linked into the store when it is on the same
+        file system, else copied. A linked file must not be modified in
+        place afterwards.
+        Args:
+            path: file path
+            kwargs: `File` arguments
+        """
+        file = File(path, **kwargs)
+        sha256 = file.sha256
+        tmp_path = self.tmp.joinpath("link_{}_{}".format(
+            os.getpid(), threading.get_ident()))
+        try:
+            os.link(path, tmp_path)
+        except OSError:
+            with open(path, "rb") as f:
+                tmp_path = Storage.tempPut(f, self.tmp)
+        try:
+            self._add(sha256, tmp_path, file.size)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        file.file_path = self.samplePath(sha256)
+        return file
+
+    def _add(self, sha256: str, tmp_path, size: int):
+        """rename a written sample into place, or count a reference"""
+        dest = self.samplePath(sha256)
+        now = time.time()
+        with self._lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.db.execute(
+                    "SELECT refs FROM samples WHERE sha256 = ?",
+                    (sha256, )).fetchone()
+                if row is None or not dest.exists():
+                    os.makedirs(dest.parent, exist_ok=True)
+                    # atomic, readers never see a partial sample
+                    os.replace(tmp_path, dest)
+                self.db.execute(
+                    "INSERT INTO samples VALUES (?, ?, 1, ?, ?) "
+                    "ON CONFLICT(sha256) DO UPDATE SET "
+                    "refs = refs + 1, accessed = excluded.accessed",
+                    (sha256, size, now, now))
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def get(self, sha256: str, **kwargs) -> Optional[File]:
+        """stored `File` of a sha256, `None` if unknown"""
+        sha256 = self._sha256(sha256)
+        path = self.samplePath(sha256)
+        if not path.exists():
+            return None
+        with self._lock:
+            self.db.execute("UPDATE samples SET accessed = ? "
+                            "WHERE sha256 = ?", (time.time(), sha256))
+        return File(path, **kwargs)
+
+    def link(self, sha256: str, dest) -> Path:
+        """hard link a stored sample to `dest`, e.g. to give a scanner a
+        file name, copies across file systems
+        Raise:
+            ZhongkuiCriticalError: unknown sample
+        """
+        path = self.samplePath(sha256)
+        if not path.exists():
+            raise ZhongkuiCriticalError("unknown sample: {}".format(sha256))
+        try:
+            os.link(path, dest)
+        except OSError:
+            Storage.copy(path, dest)
+        return Path(dest)
+
+    def release(self, sha256: str):
+        """drop a reference, the sample is removed by `gc` once unused"""
+        sha256 = self._sha256(sha256)
+        with self._lock:
+            self.db.execute(
+                "UPDATE samples SET refs = MAX(refs - 1, 0) "
+                "WHERE sha256 = ?", (sha256, ))
+
+    def refs(self, sha256: str) -> int:
+        sha256 = self._sha256(sha256)
+        row = self.db.execute("SELECT refs FROM samples WHERE sha256 = ?",
+                              (sha256, )).fetchone()
+        return row[0] if row else 0
+
+    def gc(self, max_size=None) -> int:
+        """Remove unreferenced samples, least recently used first, until
+        the store is within `max_size`, and stale uploads.
+        Args:
+            max_size: bytes of samples to keep, defaults to the store
+                `max_size`, `None` removes every unreferenced sample
+        Return:
+            number of removed samples
+        """
+        max_size = max_size if max_size is not None else self.max_size
+        removed = 0
+        with self._lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                total = self.db.execute(
+                    "SELECT COALESCE(SUM(size), 0) FROM samples").fetchone()[0]
+                rows = self.db.execute(
+                    "SELECT sha256, size FROM samples WHERE refs = 0 "
+                    "ORDER BY accessed").fetchall()
+                for sha256, size in rows:
+                    if max_size is not None and total <= max_size:
+                        break
+                    path = self.samplePath(sha256)
+                    if path.exists():
+                        os.remove(path)
+                    self.db.execute("DELETE FROM samples WHERE sha256 = ?",
+                                    (sha256, ))
+                    total -= size
+                    removed += 1
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+
+        deadline = time.time() - STALE_UPLOAD_SECONDS
+        for entry in os.scandir(self.tmp):
+            try:
+                if entry.stat().st_mtime < deadline:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+        log.info("sample store gc removed {} samples".format(removed))
+        return removed
+
+    def stats(self) -> Dict[str, int]:
+        count, size, unused = self.db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0), "
+            "COALESCE(SUM(refs = 0), 0) FROM samples").fetchone()
+        return {"count": count, "size": size, "unreferenced": unused}
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,78 @@
+"""single-pass streaming analysis, one sequential read feeds every consumer"""
+import hashlib
+import binascii
+from typing import Any, Dict, Iterable, List
+
+
+class StreamConsumer:
+    """A consumer of the chunk stream, registered on `StreamAnalyzer`"""
+    name = None
+
+    def update(self, chunk):
+        raise NotImplementedError
+
+    def result(self) -> Any:
+        raise NotImplementedError
+
+
+class HashConsumer(StreamConsumer):
+    """hashlib digest, `name` is a hashlib algorithm name"""
+    def __init__(self, name):
+        self.name = name
+        self._hash = hashlib.new(name)
+
+    def update(self, chunk):
+        self._hash.update(chunk)
+
+    def result(self) -> str:
+        return self._hash.hexdigest()
+
+
+class Crc32Consumer(StreamConsumer):
+    name = "crc32"
+
+    def __init__(self):
+        self._crc = 0
+
+    def update(self, chunk):
+        self._crc = binascii.crc32(chunk, self._crc)
+
+    def result(self) -> str:
+        return "%08X" % (self._crc & 0xffffffff)
+
+
+class StreamAnalyzer:
+    """Feed one chunk stream to all registered consumers"""
+    def __init__(self, consumers: Iterable[StreamConsumer] = ()):
+        self.consumers = []
+        self.size = 0
+        for consumer in consumers:
+            self.register(consumer)
+
+    def register(self, consumer: StreamConsumer) -> StreamConsumer:
+        self.consumers.append(consumer)
+        return consumer
+
+    def update(self, chunk):
+        self.size += len(chunk)
+        for consumer in self.consumers:
+            consumer.update(chunk)
+
+    def feed(self, chunks: Iterable[bytes]) -> "StreamAnalyzer":
+        for chunk in chunks:
+            self.update(chunk)
+        return self
+
+    def results(self) -> Dict[str, Any]:
+        return {
+            consumer.name: consumer.result()
+            for consumer in self.consumers
+        }
+
+
+def hashConsumers() -> List[StreamConsumer]:
+    """consumers for crc32, md5, sha1, sha256 and sha512"""
+    return [Crc32Consumer()] + [
+        HashConsumer(name)
+        for name in ("md5", "sha1", "sha256", "sha512")
+    ]
@@ -0,0 +1,327 @@
+"""in-process TrID compatible file type identification
+
+TrID definitions (the XML package made by TrIDScan, one `.trid.xml`
+file per type) are parsed once into a `TridIndex`:
+
+    TridIndex.set("triddefs_xml/")
+    tridScan(path)  # no trid process, same {type: percentage} result
+
+A definition matches when all its front block patterns are found at
+their offsets and all its global strings are found anywhere in the file,
+case insensitive. Definitions are indexed by the offset and first byte
+of one of their patterns, so a sample is only checked against the few
+definitions its header can match.
+
+The parsed index is written as JSON to the per-user cache directory,
+keyed by the definition files, so other processes load it without
+parsing the XML again. A cached index is only loaded if the current
+user owns it and no one else can write it.
+"""
+import os
+import re
+import json
+import stat
+import mmap
+import hashlib
+import logging
+import tempfile
+import threading
+import xml.etree.ElementTree as ET
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from .exceptions import ZhongkuiScanError
+from .metrics import addBytes
+
+log = logging.getLogger(__name__)
+
+# bump when the cached index layout or the scoring changes
+INDEX_VERSION = 1
+# results reported, like trid
+TRID_RESULTS = 5
+# points of a pattern byte at offset 0, elsewhere and of a string byte
+FRONT_POINTS = 1000
+PATTERN_POINTS = 1
+STRING_POINTS = 500
+
+
+class TridDefinition:
+    """A parsed TrID definition
+    Args:
+        fileType: type name, the result key
+        patterns: (offset, bytes) that must all match
+        strings: upper case bytes that must all be in the file
+    """
+    __slots__ = ("fileType", "patterns", "strings", "points")
+
+    def __init__(self, fileType: str, patterns: Tuple[Tuple[int, bytes],
+                                                      ...],
+                 strings: Tuple[bytes, ...]):
+        self.fileType = fileType
+        self.patterns = patterns
+        self.strings = strings
+        self.points = sum(
+            len(data) * (FRONT_POINTS if pos == 0 else PATTERN_POINTS)
+            for pos, data in patterns) + sum(
+                len(string) * STRING_POINTS for string in strings)
+
+
+def parseDefinition(source) -> TridDefinition:
+    """Parse a TrIDScan XML definition.
+    Args:
+        source: path or file object of a `.trid.xml` file
+    Raise:
+        ValueError: not a TrID definition
+    """
+    try:
+        root = ET.parse(source).getroot()
+    except ET.ParseError as e:
+        raise ValueError("xml error: {}".format(e))
+    if root.tag != "TrID":
+        raise ValueError("not a TrID definition")
+    file_type = (root.findtext("Info/FileType") or "").strip()
+    if not file_type:
+        raise ValueError("no FileType")
+
+    patterns = []
+    for pattern in root.iterfind("FrontBlock/Pattern"):
+        data = bytes.fromhex((pattern.findtext("Bytes") or "").strip())
+        if data:
+            patterns.append((int(pattern.findtext("Pos") or 0), data))
+    strings = []
+    check = (root.findtext("General/CheckStrings") or "True").strip()
+    if check.lower() == "true":
+        for string in root.iterfind("GlobalStrings/String"):
+            # TrIDScan writes a zero byte as `'`
+            text = (string.text or "").replace("'", "\0")
+            if text:
+                strings.append(text.encode("latin-1", "replace").upper())
+    if not patterns and not strings:
+        raise ValueError("no pattern")
+    return TridDefinition(file_type, tuple(sorted(patterns)), tuple(strings))
+
+
+def cacheDir() -> Path:
+    """per-user cache directory, `$XDG_CACHE_HOME/zhongkui`"""
+    root = os.environ.get("XDG_CACHE_HOME") or Path.home().joinpath(".cache")
+    return Path(root).joinpath("zhongkui")
+
+
+def _trusted(st: os.stat_result) -> bool:
+    """owned by the current user and not writable by others"""
+    if hasattr(os, "getuid") and st.st_uid != os.getuid():
+        return False
+    return not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+
+def _sources(path: Path) -> List[Path]:
+    if path.is_dir():
+        return sorted(p for p in path.rglob("*.xml") if p.is_file())
+    return [path] if path.is_file() else []
+
+
+class TridIndex:
+    """TrID definitions indexed by pattern offset and first byte"""
+    _index = None
+    _lock = threading.Lock()
+
+    def __init__(self, definitions: List[TridDefinition], digest=""):
+        """
+        Args:
+            definitions: parsed definitions
+            digest: identifies the definition files, for cache versions
+        """
+        self.definitions = definitions
+        self.digest = digest
+        # (offset, first byte) of an anchor pattern: definitions
+        self._front: Dict[Tuple[int, int], List[TridDefinition]] = {}
+        # definitions of strings only, checked for every sample
+        self._loose: List[TridDefinition] = []
+        self._compiled: Dict[bytes, "re.Pattern"] = {}
+        self.frontSize = 0
+        for definition in definitions:
+            if not definition.patterns:
+                self._loose.append(definition)
+                continue
+            # the longest pattern is the most selective
+            pos, data = max(definition.patterns, key=lambda p: len(p[1]))
+            self._front.setdefault((pos, data[0]), []).append(definition)
+            self.frontSize = max(
+                self.frontSize,
+                max(p + len(d) for p, d in definition.patterns))
+        self._offsets = sorted({pos for pos, _ in self._front})
+
+    def __len__(self):
+        return len(self.definitions)
+
+    @classmethod
+    def load(cls, path, cache_dir=None) -> "TridIndex":
+        """Load definitions, from the cached index if they did not change.
+        Args:
+            path: a definitions directory or a single definition file
+            cache_dir: directory of the cached index, defaults to
+                `cacheDir()`, `False` to skip it
+        Raise:
+            ZhongkuiScanError: no valid definition
+        """
+        sources = _sources(Path(path))
+        if not sources:
+            raise ZhongkuiScanError(
+                "no trid definition found in {}".format(path))
+        digest = hashlib.sha256(str(INDEX_VERSION).encode())
+        for source in sources:
+            st = source.stat()
+            digest.update("{}|{}|{}\n".format(source, st.st_size,
+                                              st.st_mtime_ns).encode())
+        digest = digest.hexdigest()
+
+        cache = None
+        if cache_dir is not False:
+            cache = Path(cache_dir or cacheDir()).joinpath(
+                "zhongkui-trid-{}.json".format(digest[:16]))
+            definitions = cls._loadCache(cache, digest)
+            if definitions is not None:
+                log.debug("trid index cache hit: {}".format(cache))
+                return cls(definitions, digest)
+
+        definitions = []
+        for source in sources:
+            try:
+                definitions.append(parseDefinition(str(source)))
+            except (OSError, ValueError) as e:
+                log.warning("skip trid definition {}: {}".format(source, e))
+        if not definitions:
+            raise ZhongkuiScanError(
+                "no trid definition found in {}".format(path))
+        log.info("load {} trid definitions from {}".format(
+            len(definitions), path))
+
+        if cache is not None:
+            cls._storeCache(cache, digest, definitions)
+        return cls(definitions, digest)
+
+    @staticmethod
+    def _loadCache(cache: Path, digest: str):
+        try:
+            # the check is on the opened file, not on the path
+            fd = os.open(str(cache),
+                         os.O_RDONLY | getattr(os, "O_NOFOLLOW", 0))
+            with os.fdopen(fd, encoding="utf-8") as f:
+                if not _trusted(os.fstat(f.fileno())):
+                    log.warning("ignore trid index cache {}: not owned by "
+                                "the current user".format(cache))
+                    return None
+                saved = json.load(f)
+            if saved["digest"] != digest:
+                return None
+            return [
+                TridDefinition(
+                    file_type,
+                    tuple((pos, bytes.fromhex(data))
+                          for pos, data in patterns),
+                    tuple(bytes.fromhex(string) for string in strings))
+                for file_type, patterns, strings in saved["definitions"]
+            ]
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    @staticmethod
+    def _storeCache(cache: Path, digest: str,
+                    definitions: List[TridDefinition]):
+        saved = {
+            "digest": digest,
+            "definitions": [[
+                d.fileType, [[pos, data.hex()] for pos, data in d.patterns],
+                [string.hex() for string in d.strings]
+            ] for d in definitions],
+        }
+        try:
+            os.makedirs(cache.parent, mode=0o700, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=str(cache.parent),
+                                       suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(saved, f, separators=(",", ":"))
+            # readers never see a partial index
+            os.replace(tmp, cache)
+        except OSError as e:
+            log.warning("trid index cache write error: {}".format(e))
+
+    def _search(self, string: bytes, data) -> bool:
+        pattern = self._compiled.get(string)
+        if pattern is None:
+            pattern = self._compiled[string] = re.compile(
+                re.escape(string), re.IGNORECASE | re.DOTALL)
+        return pattern.search(data) is not None
+
+    def match(self, data) -> Dict[str, str]:
+        """Identify file contents.
+        Args:
+            data: file contents, a bytes-like object or mmap
+        Return:
+            A dict of percentages keyed by file type, like `tridScan`
+        """
+        header = bytes(data[:self.frontSize])
+        addBytes(len(header))
+        candidates = list(self._loose)
+        for pos in self._offsets:
+            if pos >= len(header):
+                break
+            candidates.extend(self._front.get((pos, header[pos]), ()))
+
+        scores, searched = {}, False
+        for definition in candidates:
+            if not all(header[pos:pos + len(pattern)] == pattern
+                       for pos, pattern in definition.patterns):
+                continue
+            if definition.strings:
+                if not searched:
+                    addBytes(len(data) - len(header))
+                    searched = True
+                if not all(
+                        self._search(string, data)
+                        for string in definition.strings):
+                    continue
+            scores[definition.fileType] = max(
+                scores.get(definition.fileType, 0), definition.points)
+
+        total = sum(scores.values())
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return {
+            # truncated like trid
+            file_type: "{:.1f}%".format(points * 1000 // total / 10)
+            for file_type, points in ranked[:TRID_RESULTS]
+        }
+
+    def scan(self, target) -> Dict[str, str]:
+        """Identify a file.
+        Raise:
+            ZhongkuiScanError
+        """
+        try:
+            with open(target, "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return self.match(b"")
+                with mmap.mmap(f.fileno(), 0,
+                               access=mmap.ACCESS_READ) as data:
+                    return self.match(data)
+        except OSError as e:
+            log.error("trid match error: {}".format(e))
+            raise ZhongkuiScanError("trid match error: {}".format(e))
+
+    @classmethod
+    def set(cls, path, cache_dir=None) -> "TridIndex":
+        """use definitions in-process instead of the trid binary"""
+        index = cls.load(path, cache_dir)
+        with cls._lock:
+            cls._index = index
+        return index
+
+    @classmethod
+    def get(cls) -> Optional["TridIndex"]:
+        """the shared index, `None` until `set`"""
+        with cls._lock:
+            return cls._index
+
+    @classmethod
+    def shutdown(cls):
+        with cls._lock:
+            cls._index = None
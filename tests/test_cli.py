@@ -0,0 +1,65 @@
+import json
+import tempfile
+import unittest
+from pathlib import Path
+from zhongkui.logging import initConsoleLogging
+from zhongkui.file.cli import ScanState, main, walk
+
+MALWARE = Path(__file__).resolve().parent.joinpath("sample")
+
+
+class TestCli(unittest.TestCase):
+    @classmethod
+    def setUp(cls):
+        initConsoleLogging()
+
+    def test_walk(self):
+        paths = list(walk([str(MALWARE)]))
+        self.assertIn(str(MALWARE.joinpath("pe")), paths)
+        self.assertEqual(len(paths), len(set(paths)))
+
+    def test_scan(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            output = Path(tmpdir).joinpath("results.jsonl")
+            state = str(Path(tmpdir).joinpath("scan.db"))
+            copy = Path(tmpdir).joinpath("copy")
+            copy.write_bytes(MALWARE.joinpath("pe").read_bytes())
+            args = ["scan", str(MALWARE.joinpath("pe")), str(copy),
+                    "-o", str(output), "--state", state, "-j", "2"]
+            self.assertEqual(0, main(args))
+            records = [json.loads(line) for line in output.open()]
+            self.assertEqual(2, len(records))
+            self.assertEqual(1, sum("info" in r for r in records))
+            self.assertEqual(1, sum("duplicate" in r for r in records))
+
+            # resumed, nothing left to scan
+            self.assertEqual(0, main(args))
+            self.assertEqual(2, len(output.read_text().splitlines()))
+
+    def test_state(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            state = ScanState(str(Path(tmpdir).joinpath("scan.db")))
+            sha256 = "a" * 64
+            self.assertIsNone(state.claim(sha256, "first"))
+            self.assertEqual("first", state.claim(sha256, "copy"))
+            # the first path failed, the next copy is analysed
+            state.release(sha256)
+            self.assertFalse(state.isDone("first"))
+            self.assertIsNone(state.claim(sha256, "copy"))
+            state.done("copy", sha256)
+            # an analysed sample is kept
+            state.release(sha256)
+            self.assertEqual("copy", state.claim(sha256, "other"))
+            state.close()
+
+    def test_profile(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            output = Path(tmpdir).joinpath("results.jsonl")
+            args = ["scan", str(MALWARE.joinpath("elf")), "-o", str(output),
+                    "-j", "1", "--profile", "triage"]
+            self.assertEqual(0, main(args))
+            info = json.loads(output.read_text())["info"]
+            self.assertEqual(["basicInfo"], list(info))
+            self.assertEqual("", info["basicInfo"]["magic"])
+            with self.assertRaises(SystemExit):
+                main(["scan", str(MALWARE), "--scanners", "hashes,yara"])
@@ -1,9 +1,26 @@
+import io
+import os
+import asyncio
 import unittest
+import tracemalloc
 import tempfile
 import json
+import hashlib
+import binascii
+from unittest import mock
 from pathlib import Path
 from zhongkui.logging import initConsoleLogging
 from zhongkui.file import File, Storage
+from zhongkui.file.exceptions import ZhongkuiCriticalError
+from zhongkui.file.stream import StreamAnalyzer, hashConsumers
+from zhongkui.file.entropy import EntropyEngine, ByteStatsConsumer
+from zhongkui.file.cache import ResultCache, StatIndex
+from zhongkui.file.model import EXIFTOOL, SCAN
+from zhongkui.file.aio import AsyncFile
+from zhongkui.file.scan import loadPE, pefileScan
+from zhongkui.file.elf import elfScan
+from zhongkui.file.metrics import MemoryExporter, addExporter, removeExporter
+from zhongkui.file.store import SampleStore
 
 MALWARE = Path(__file__).resolve().parent.joinpath("sample")
 RESULT = Path(__file__).resolve().parent.joinpath("result")
@@ -26,6 +43,210 @@ class TestStorage(unittest.TestCase):
         assert Path(fpath).is_file()
         Storage.delete(fpath)
 
+    def test_ingest(self):
+        sample = File.ingest(io.BytesIO(self.data), "pe_upx", chunk_size=4096)
+        self.assertEqual(self.data, Path(sample.file_path).read_bytes())
+        # hashed while written, never read back
+        sample.getChunks = None
+        self.assertEqual(hashlib.md5(self.data).hexdigest(), sample.md5)
+        self.assertEqual(hashlib.sha256(self.data).hexdigest(),
+                         sample.sha256)
+        self.assertEqual(len(self.data), sample.entropyProfile.size)
+        sample.cleanup()
+
+
+class TestStreamAnalyzer(unittest.TestCase):
+    def test_singlePass(self):
+        data = bytes(range(256)) * 1024
+        analyzer = StreamAnalyzer(hashConsumers())
+        analyzer.register(EntropyEngine(window=65536, step=65536))
+        analyzer.register(ByteStatsConsumer())
+        chunks = [data[i:i + 10000] for i in range(0, len(data), 10000)]
+        results = analyzer.feed(chunks).results()
+
+        self.assertEqual(hashlib.sha256(data).hexdigest(), results["sha256"])
+        self.assertEqual("%08X" % binascii.crc32(data), results["crc32"])
+        self.assertEqual([8.0] * 4, results["entropyProfile"].entropies)
+        self.assertEqual(256, results["byteStats"]["distinct"])
+
+
+class TestEntropyEngine(unittest.TestCase):
+    def test_entropyProfile(self):
+        data = os.urandom(64 * 1024) + bytes(128 * 1024) + os.urandom(32768)
+        engine = EntropyEngine(window=32768, step=8192)
+        for i in range(0, len(data), 10000):
+            engine.update(data[i:i + 10000])
+        profile = engine.result()
+
+        self.assertEqual((len(data) - 32768) // 8192 + 1,
+                         len(profile.entropies))
+        self.assertEqual([[0, 65536], [196608, 229376]], profile.highRegions)
+        self.assertEqual(0.0, profile.entropies[10])
+
+    def test_smallData(self):
+        engine = EntropyEngine()
+        engine.update(b"abab")
+        profile = engine.result()
+        self.assertEqual([1.0], profile.entropies)
+        self.assertEqual(4, profile.window)
+
+
+class TestFileMemory(unittest.TestCase):
+    def test_memoryBudget(self):
+        budget = 1024 * 1024
+        fpath = Storage.tempPut(os.urandom(8 * budget))
+        sample = File(fpath, temporary=True, memory_budget=budget)
+
+        tracemalloc.start()
+        sample.analyseStream(ByteStatsConsumer())
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        self.assertLess(peak, budget)
+        self.assertEqual(8 * budget, sample.size)
+        with self.assertRaises(ZhongkuiCriticalError):
+            sample.fileData
+        Storage.delete(fpath)
+
+    def test_view(self):
+        data = MALWARE.joinpath("pe").read_bytes()
+        sample = File(MALWARE.joinpath("pe"), memory_budget=1024 * 1024)
+        self.assertEqual(data, sample.view.tobytes())
+        chunks = [bytes(chunk) for chunk in sample.getChunks()]
+        self.assertEqual(data, b"".join(chunks))
+        self.assertEqual(sample.chunkSize, len(chunks[0]))
+        sample.releaseData()
+        self.assertIsNone(sample._view)
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmpdir.name).joinpath("cache.db")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_getPut(self):
+        cache = ResultCache(self.path)
+        cache.store("a" * 64, "trid", {"Generic": "100.0%"})
+        cache.store("a" * 64, "diec", {SCAN.ERROR: "timeout"})
+        self.assertEqual({"Generic": "100.0%"}, cache.lookup("a" * 64, "trid"))
+        self.assertIsNone(cache.lookup("a" * 64, "diec"))
+        self.assertIsNone(cache.lookup("b" * 64, "trid"))
+
+        cache.db.execute("UPDATE results SET version = 'old'")
+        self.assertIsNone(cache.lookup("a" * 64, "trid"))
+        cache.close()
+
+    def test_evict(self):
+        cache = ResultCache(self.path, max_size=100, ttl=None)
+        for i in range(10):
+            cache.store(str(i), "magic", {"type_name": "x" * 10})
+        self.assertLessEqual(cache.stats()["size"], 100)
+        self.assertIsNone(cache.lookup("0", "magic"))
+        self.assertIsNotNone(cache.lookup("9", "magic"))
+
+        cache = ResultCache(self.path, ttl=-1)
+        self.assertIsNone(cache.lookup("9", "magic"))
+
+    def test_size(self):
+        cache = ResultCache(self.path, ttl=None)
+        cache.store("a" * 64, "magic", {"type_name": "x"})
+        cache.store("a" * 64, "magic", {"type_name": "xyz"})
+        cache.store("b" * 64, "magic", {"type_name": "x"})
+        cache.lookup("b" * 64, "magic")
+        cache.db.execute("UPDATE results SET version = 'old' "
+                         "WHERE sha256 = ?", ("b" * 64, ))
+        self.assertIsNone(cache.lookup("b" * 64, "magic"))
+        total = cache.db.execute("SELECT SUM(size) FROM results").fetchone()
+        self.assertEqual({"count": 1, "size": total[0]}, cache.stats())
+
+        # a recent hit does not write
+        accessed = "SELECT accessed FROM results"
+        before = cache.db.execute(accessed).fetchone()
+        cache.lookup("a" * 64, "magic")
+        self.assertEqual(before, cache.db.execute(accessed).fetchone())
+        cache.close()
+
+    def test_fileCache(self):
+        cache = ResultCache(self.path)
+        target = MALWARE.joinpath("pe")
+        trid = File(target, cache=cache).getTrid()
+        file = File(target, cache=cache)
+        self.assertEqual(trid, file.getTrid())
+        self.assertLess(file.scanCosts["trid"], 1)
+
+    def test_basicCache(self):
+        cache = ResultCache(self.path)
+        file = File(MALWARE.joinpath("pe"), cache=cache)
+        file._exiftool = {EXIFTOOL.FILETYPE: "Win32 EXE"}
+        file._magic = {"type_name": "PE32 executable"}
+        file._diec = {}
+        file._trid = {SCAN.ERROR: "trid start error"}
+        file.getBasicInfo()
+        # basic info of a failed scanner is not cached
+        self.assertIsNone(cache.lookup(file.sha256, "basic"))
+
+        file._trid, file._basic = {"Win32 Executable": "100.0%"}, None
+        self.assertEqual(file.getBasicInfo(),
+                         cache.lookup(file.sha256, "basic"))
+
+
+class TestStatIndex(unittest.TestCase):
+    def test_unchanged(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            index = StatIndex(Path(tmpdir).joinpath("stat.db"))
+            target = Path(tmpdir).joinpath("sample")
+            target.write_bytes(os.urandom(1024))
+
+            file = File(target, stat_index=index)
+            md5 = file.md5
+            profile = file.entropyProfile
+            self.assertEqual([], index.changed([target]))
+
+            # served without opening the file
+            file = File(target, stat_index=index)
+            file.getChunks = None
+            self.assertEqual(md5, file.md5)
+            self.assertEqual(profile, file.entropyProfile)
+
+            target.write_bytes(os.urandom(1024))
+            self.assertEqual([target], index.changed([target]))
+            self.assertNotEqual(md5, File(target, stat_index=index).md5)
+            index.close()
+
+
+class TestSampleStore(unittest.TestCase):
+    def test_store(self):
+        data = MALWARE.joinpath("pe_upx").read_bytes()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = SampleStore(tmpdir)
+            first = store.put(io.BytesIO(data))
+            second = store.put(data)
+            self.assertEqual(first.file_path, second.file_path)
+            self.assertEqual(hashlib.sha256(data).hexdigest(), first.sha256)
+            self.assertEqual(data, Path(first.file_path).read_bytes())
+            self.assertEqual(2, store.refs(first.sha256))
+            self.assertEqual([], os.listdir(store.tmp))
+            for sha256 in ("../../..", "0" * 63, "g" * 64):
+                with self.assertRaises(ValueError):
+                    store.get(sha256)
+                with self.assertRaises(ValueError):
+                    store.release(sha256)
+
+            copy = Path(tmpdir).joinpath("copy")
+            copy.write_bytes(data)
+            third = store.putFile(copy)
+            self.assertEqual(first.file_path, third.file_path)
+            self.assertEqual(1, store.stats()["count"])
+
+            for _ in range(3):
+                store.release(first.sha256)
+            self.assertEqual(1, store.gc())
+            self.assertIsNone(store.get(first.sha256))
+            store.close()
+
 
 class TestFile(unittest.TestCase):
     @classmethod
@@ -35,6 +256,130 @@ class TestFile(unittest.TestCase):
     def test_isValid(self):
         assert self.file.isValid()
 
+    def test_lazyScan(self):
+        sample = File(MALWARE.joinpath("pe"))
+        assert sample.md5 == "ff2a00e3d07afcf32a7459040bc9cc41"
+        assert sample._exiftool is None
+        assert "stream" in sample.scanCosts
+        assert "exiftool" not in sample.scanCosts
+
+    def test_sniffedType(self):
+        sample = File(MALWARE.joinpath("pe"))
+        self.assertEqual(sample.fileType, "Win32 EXE")
+        sample.getPefile()
+        assert "exiftool" not in sample.scanCosts
+        self.assertEqual(self.file.getExiftool()["FileType"], sample.fileType)
+        self.assertIsNone(File(MALWARE.joinpath("html")).sniffedType)
+
+    def test_elf(self):
+        sample = File(MALWARE.joinpath("elf"))
+        self.assertIs(sample.elf, sample.parse)
+        self.assertEqual(elfScan(MALWARE.joinpath("elf")), sample.getElf())
+        self.assertIsNone(self.file.getElf())
+        sample.releaseData()
+
+    def test_timings(self):
+        exporter = addExporter(MemoryExporter())
+        try:
+            sample = File(MALWARE.joinpath("pe"))
+            sample.getPefile()
+            sample.md5
+        finally:
+            removeExporter(exporter)
+        timings = sample.timings
+        self.assertEqual(sample.size, timings["stream"]["bytesRead"])
+        self.assertEqual(0, timings["pefile"]["spawns"])
+        self.assertLessEqual(timings["pefile"]["cpu"],
+                             timings["pefile"]["wall"] + 0.01)
+        counters = exporter.snapshot()["counters"]
+        self.assertEqual(
+            1, counters["zhongkui_stage_calls_total{stage=pefileScan}"])
+
+    def test_profile(self):
+        sample = File(MALWARE.joinpath("pe"))
+        infos = sample.getAllInfo(profile="triage")
+        self.assertEqual(["basicInfo"], list(infos))
+        self.assertEqual("Win32 EXE", infos["basicInfo"]["fileType"])
+        self.assertEqual(self.file.md5, infos["basicInfo"]["md5"])
+        self.assertEqual({"stream"}, set(sample.scanCosts))
+
+        infos = sample.getAllInfo(profile={"sniff", "pefile"})
+        self.assertEqual(pefileScan(MALWARE.joinpath("pe")), infos["peInfo"])
+        assert "exiftool" not in sample.scanCosts
+        with self.assertRaises(ValueError):
+            sample.getAllInfo(profile="deep")
+
+    def test_getAllInfo_concurrent(self):
+        sample = File(MALWARE.joinpath("pe"))
+        self.assertDictEqual(self.file.getAllInfo(),
+                             sample.getAllInfo(concurrent=True))
+        assert "pefile" in sample.scanCosts
+
+    def test_loadPE(self):
+        sample = File(MALWARE.joinpath("pe"))
+        with mock.patch("zhongkui.file.core.loadPE",
+                        wraps=loadPE) as load:
+            sample.getAllInfo(concurrent=True)
+            sample.isProbablyPacked
+            self.assertIs(sample.pe, sample.parse)
+        # one fast loaded PE shared by every scanner
+        self.assertEqual(1, load.call_count)
+
+    def test_pe(self):
+        sample = File(MALWARE.joinpath("pe"))
+        self.assertIs(sample.pe, sample.parse)
+        self.assertEqual(pefileScan(MALWARE.joinpath("pe")),
+                         sample.getPefile())
+        sample.releaseData()
+
+    def test_fromBytes(self):
+        data = MALWARE.joinpath("pe").read_bytes()
+        sample = File.fromBytes(data, "pe")
+        self.assertEqual(self.file.md5, sample.md5)
+        self.assertEqual(self.file.getMagic(), sample.getMagic())
+        self.assertEqual(len(self.file.pe.sections), len(sample.pe.sections))
+        # no temporary file for in-process scanners
+        self.assertIsNone(sample._file_path)
+        concurrent = File.fromBytes(data, "pe")
+        infos = concurrent.getAllInfo(
+            concurrent=True,
+            profile={"hashes", "sniff", "entropy", "magic", "pefile"})
+        self.assertEqual(sample.getMagic(), infos["basicInfo"]["magic"])
+        self.assertEqual(sample.getPefile(), infos["peInfo"])
+        self.assertIsNone(concurrent._file_path)
+        asynchronous = AsyncFile(File.fromBytes(data, "pe"))
+        infos = asyncio.run(
+            asynchronous.getAllInfo(
+                profile={"hashes", "sniff", "entropy", "magic", "pefile"}))
+        self.assertEqual(sample.getMagic(), infos["basicInfo"]["magic"])
+        self.assertEqual(sample.getPefile(), infos["peInfo"])
+        self.assertIsNone(asynchronous.file._file_path)
+
+        self.assertDictEqual(self.file.getBasicInfo(), sample.getBasicInfo())
+        self.assertTrue(Path(sample.file_path).is_file())
+        sample.cleanup()
+        self.assertIsNone(sample._file_path)
+
+    def test_fromStream(self):
+        with MALWARE.joinpath("pe").open("rb") as f:
+            sample = File.fromStream(f, "pe", memory_budget=1024)
+        self.assertFalse(sample.inMemory)
+        self.assertEqual(self.file.md5, sample.md5)
+        directory = Path(sample.file_path).parent
+        sample.cleanup()
+        self.assertFalse(directory.exists())
+
+        sample = File.fromBytes(b"zhongkui", "named")
+        directory = Path(sample.file_path).parent
+        sample.cleanup()
+        self.assertFalse(directory.exists())
+
+    def test_getAllInfo_async(self):
+        sample = AsyncFile(MALWARE.joinpath("pe"))
+        self.assertDictEqual(self.file.getAllInfo(),
+                             asyncio.run(sample.getAllInfo()))
+        assert "pefile" in sample.file.scanCosts
+
     def test_getAllInfo(self):
         self.file.getAllInfo()
         result = self.file.getBasicInfo()
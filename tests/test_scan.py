@@ -1,8 +1,30 @@
+import os
+import time
+import tempfile
+import struct
+import asyncio
 import unittest
+import threading
+from unittest import mock
 from pathlib import Path
 from zhongkui.logging import initConsoleLogging
 from zhongkui.file.scan import (diecScan, ssdeepScan, exiftoolScan, tridScan,
-                                magicScan, pefileScan)
+                                magicScan, pefileScan, exiftoolScanMany,
+                                ssdeepScanMany, tridScanMany, loadPE,
+                                magicScanMany)
+from zhongkui.file.model import SCAN
+from zhongkui.file.exiftool import ExiftoolPool
+from zhongkui.file.fuzzy import FuzzyHash, fuzzyHash, compareFuzzyHash
+from zhongkui.file.sniff import SNIFF_SIZE, sniffFileType
+from zhongkui.file.elf import ELF, elfScan
+from zhongkui.file import aio
+from zhongkui.file.runtime import CircuitBreaker, run, timeoutFor
+from zhongkui.file.metrics import stage
+from zhongkui.file.trid import TridIndex, parseDefinition
+from zhongkui.file.exceptions import (ZhongkuiScanError,
+                                      ZhongkuiScanTimeoutError,
+                                      ZhongkuiToolMissingError,
+                                      ZhongkuiToolUnavailableError)
 
 MALWARE = Path(__file__).resolve().parent.joinpath("sample")
 RESULT = Path(__file__).resolve().parent.joinpath("result")
@@ -37,6 +59,21 @@ class TestFileScan(unittest.TestCase):
 
         self.assertEqual(expect, ssdeepScan(target))
 
+    def test_fuzzyHash(self):
+        data = MALWARE.joinpath("pe").read_bytes()
+        fuzzy = FuzzyHash()
+        for i in range(0, len(data), 777):
+            fuzzy.update(data[i:i + 777])
+        self.assertEqual(fuzzyHash(data), fuzzy.result())
+        self.assertEqual(ssdeepScan(MALWARE.joinpath("pe"))["ssdeep"],
+                         fuzzy.result())
+
+        digest1 = "3:AXGBicFlgVNhBGcL6wCrFQEv:AXGHsNhxLsr2C"
+        digest2 = "3:AXGBicFlIHBGcL6wCrFQEv:AXGH6xLsr2C"
+        self.assertEqual(100, compareFuzzyHash(digest1, digest1))
+        self.assertEqual(22, compareFuzzyHash(digest1, digest2))
+        self.assertEqual(0, compareFuzzyHash(digest1, "96:AXGH:AXGH"))
+
     def test_exiftoolScan(self):
         target = MALWARE.joinpath("pe")
         ignores = ("FileModifyDate", "FileAccessDate", "FileInodeChangeDate")
@@ -76,6 +113,15 @@ class TestFileScan(unittest.TestCase):
             r.pop(k, [])
         self.assertDictEqual(r, expect)
 
+    def test_exiftoolPool(self):
+        target = MALWARE.joinpath("pe")
+        pool = ExiftoolPool(size=1)
+        first = pool.execute("-json", target)
+        # a crashed worker is restarted on the next request
+        pool.workers[0].kill()
+        self.assertEqual(first, pool.execute("-json", target))
+        pool.close()
+
     def test_tridScan(self):
         target = MALWARE.joinpath("pe")
         expect = {
@@ -95,6 +141,76 @@ class TestFileScan(unittest.TestCase):
         }
         self.assertDictEqual(tridScan(target), expect)
 
+    def test_scanMany(self):
+        targets = [MALWARE.joinpath(name) for name in ("pe", "html")]
+        missing = str(MALWARE.joinpath("missing"))
+        for scan, scan_many in ((exiftoolScan, exiftoolScanMany),
+                                (ssdeepScan, ssdeepScanMany),
+                                (tridScan, tridScanMany)):
+            results = scan_many(targets + [missing])
+            for target in targets:
+                self.assertDictEqual(scan(target), results[str(target)])
+            self.assertIn(SCAN.ERROR, results[missing])
+
+    def test_tridScanMany_batchError(self):
+        targets = [MALWARE.joinpath(name) for name in ("pe", "html")]
+
+        def run(name, args, size=0, count=1):
+            # one bad target times out the whole batch
+            if name == "tridScanMany" or args[1] == targets[1]:
+                raise ZhongkuiScanTimeoutError("trid timeout")
+            return (b"Collecting data from file: pe\n"
+                    b" 53.9% (.EXE) InstallShield setup (43053/19/16)\n")
+
+        with mock.patch("zhongkui.file.scan.run", side_effect=run):
+            results = tridScanMany(targets)
+        self.assertEqual({"InstallShield setup": "53.9%"},
+                         results[str(targets[0])])
+        self.assertIn(SCAN.ERROR, results[str(targets[1])])
+
+    def test_asyncScan(self):
+        target = MALWARE.joinpath("pe")
+
+        async def scan():
+            return await asyncio.gather(aio.exiftoolScan(target),
+                                        aio.tridScan(target),
+                                        aio.diecScan(target),
+                                        aio.magicScan(target))
+
+        expect = [exiftoolScan(target), tridScan(target), diecScan(target),
+                  magicScan(target)]
+        self.assertEqual(expect, asyncio.run(scan()))
+
+    def test_asyncMagicScan(self):
+        target = MALWARE.joinpath("pe")
+        threads = []
+
+        def scan(target):
+            threads.append(threading.get_ident())
+            return magicScan(target)
+
+        # libmagic runs in the default executor, off the event loop
+        with mock.patch.object(aio, "_magicScan", side_effect=scan):
+            self.assertEqual(magicScan(target),
+                             asyncio.run(aio.magicScan(target)))
+        self.assertNotEqual([threading.get_ident()], threads)
+
+    def test_asyncExiftoolPool(self):
+        target = MALWARE.joinpath("pe")
+
+        async def scan():
+            pool = aio.AsyncExiftoolPool.get()
+            try:
+                await pool.execute("-json", target)
+            except ZhongkuiToolMissingError:
+                pass
+            return pool
+
+        # asyncio.run closes the daemons of its loop
+        pool = asyncio.run(scan())
+        self.assertFalse(any(worker.running for worker in pool.workers))
+        self.assertDictEqual({}, aio._pools)
+
     def test_magicScan(self):
         target = MALWARE.joinpath("pe")
         expect = {
@@ -104,6 +220,68 @@ class TestFileScan(unittest.TestCase):
         }
         self.assertDictEqual(magicScan(target), expect)
 
+    def test_magicScanMany(self):
+        targets = [MALWARE.joinpath(name) for name in ("pe", "elf", "html")]
+        results = magicScanMany(targets + ["missing"])
+        for target in targets:
+            self.assertDictEqual(magicScan(target), results[str(target)])
+        self.assertIn(SCAN.ERROR, results["missing"])
+
+        target = MALWARE.joinpath("html")
+        self.assertDictEqual(magicScan(target),
+                             magicScan(target.read_bytes()))
+
+    def test_sniffFileType(self):
+        def sniff(name):
+            with MALWARE.joinpath(name).open("rb") as f:
+                return sniffFileType(f.read(SNIFF_SIZE))
+
+        self.assertEqual(sniff("pe"), "Win32 EXE")
+        self.assertEqual(sniff("pe_upx"), "Win32 EXE")
+        self.assertEqual(sniff("elf"), "ELF executable")
+        self.assertIsNone(sniff("html"))
+        self.assertEqual(sniffFileType(b"%PDF-1.7\n"), "PDF")
+        self.assertEqual(sniffFileType(b"#!/usr/bin/env python3\n"),
+                         "Python script")
+        self.assertEqual(sniffFileType(b"\xcf\xfa\xed\xfe" + bytes(8) +
+                                       b"\x02\x00\x00\x00"),
+                         "Mach-O executable")
+        # java class, not a fat Mach-O
+        self.assertIsNone(sniffFileType(b"\xca\xfe\xba\xbe\0\0\0\x34"))
+
+    def test_elfScan(self):
+        elf_info = elfScan(MALWARE.joinpath("elf"))
+        expect_header = {
+            "elfClass": "ELF32",
+            "endianness": "little",
+            "type": "EXEC",
+            "machine": "x86",
+            "entryPoint": "12662528",
+            "sections": 0,
+            "segments": 2
+        }
+        self.assertDictEqual(expect_header, elf_info["header"])
+        self.assertEqual("R-X", elf_info["segments"][0]["flags"])
+        # upx, no section headers and a high entropy load segment
+        self.assertTrue(elf_info["isProbablyPacked"])
+
+        header = struct.pack(">HHIIIIIHHHHHH", 2, 8, 1, 0x400000, 0, 0, 0,
+                             52, 32, 0, 40, 0, 0)
+        elf = ELF(b"\x7fELF\x01\x02\x01" + bytes(9) + header)
+        self.assertEqual("big", elfScan(elf)["header"]["endianness"])
+        self.assertEqual("MIPS", elfScan(elf)["header"]["machine"])
+
+        # hostile sizes and counts, an extended count of 50,000,000 kept
+        # in section 0 with a zero section header size
+        ident = b"\x7fELF\x02\x01\x01" + bytes(9)
+        section = struct.pack("<IIQQQQIIQQ", 0, 0, 0, 0, 0, 50000000, 0, 0,
+                              0, 0)
+        for shentsize, shnum in ((0, 0), (64, 0), (64, 2)):
+            header = struct.pack("<HHIQQQIHHHHHH", 2, 62, 1, 0, 0, 64, 0,
+                                 64, 0, 0, shentsize, shnum, 0)
+            with self.assertRaises(ZhongkuiScanError):
+                elfScan(ELF(ident + header + section))
+
     def test_pefileScan(self):
         target = MALWARE.joinpath("pe")
         expect_header = {
@@ -132,3 +310,128 @@ class TestFileScan(unittest.TestCase):
         self.assertDictEqual(expect_section_code, pefile_info["sections"][0])
         self.assertDictEqual(expect_import_advapi32, pefile_info["imports"][2])
         self.assertEqual(expect_sum_import, len(pefile_info["imports"]))
+
+        pe = loadPE(target)
+        self.assertEqual(pefile_info, pefileScan(pe))
+        # only the import directory is parsed
+        self.assertFalse(hasattr(pe, "DIRECTORY_ENTRY_RESOURCE"))
+
+
+TRID_DEFINITION = """<?xml version="1.0" encoding="ISO-8859-1"?>
+<TrID ver="2.00">
+    <Info><FileType>{}</FileType><Ext>EXE</Ext></Info>
+    <General><CheckStrings>True</CheckStrings></General>
+    <FrontBlock>{}</FrontBlock>
+    <GlobalStrings>{}</GlobalStrings>
+</TrID>
+"""
+
+
+class TestTrid(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.defs = Path(self.tmpdir.name).joinpath("defs")
+        self.defs.mkdir()
+        pattern = "<Pattern><Bytes>{}</Bytes><Pos>{}</Pos></Pattern>"
+        for name, file_type, patterns, strings in (
+            ("dos", "DOS Executable", [("4D5A", 0)], []),
+            ("win32", "Win32 Executable", [("4D5A", 0), ("50450000", 256)],
+             ["THIS PROGRAM"]),
+            ("zhongkui", "Zhongkui Executable", [("4D5A", 0)],
+             ["Z'H'O'N'G'K'U'I"]),
+            ("html", "HyperText Markup Language", [("3C68746D6C", 0)], []),
+        ):
+            self.defs.joinpath(name + ".trid.xml").write_text(
+                TRID_DEFINITION.format(
+                    file_type, "".join(pattern.format(*p) for p in patterns),
+                    "".join("<String>{}</String>".format(s)
+                            for s in strings)))
+
+    def tearDown(self):
+        TridIndex.shutdown()
+        self.tmpdir.cleanup()
+
+    def test_parseDefinition(self):
+        definition = parseDefinition(str(self.defs.joinpath("win32.trid.xml")))
+        self.assertEqual("Win32 Executable", definition.fileType)
+        self.assertEqual(((0, b"MZ"), (256, b"PE\0\0")), definition.patterns)
+        self.assertEqual(2000 + 4 + 12 * 500, definition.points)
+        definition = parseDefinition(
+            str(self.defs.joinpath("zhongkui.trid.xml")))
+        self.assertEqual((b"Z\0H\0O\0N\0G\0K\0U\0I", ),
+                         definition.strings)
+
+    def test_match(self):
+        index = TridIndex.load(self.defs, cache_dir=self.tmpdir.name)
+        self.assertEqual(4, len(index))
+        self.assertEqual({
+            "Win32 Executable": "80.0%",
+            "DOS Executable": "19.9%"
+        }, index.scan(MALWARE.joinpath("pe")))
+        self.assertEqual({}, index.scan(MALWARE.joinpath("elf")))
+        self.assertEqual({
+            "Zhongkui Executable": "82.6%",
+            "DOS Executable": "17.3%"
+        }, index.match(b"MZ.." + "zhongkui".encode("utf-16-le")))
+        self.assertEqual({}, index.match(b""))
+
+        # other processes load the parsed index
+        caches = list(Path(self.tmpdir.name).glob("zhongkui-trid-*.json"))
+        self.assertEqual(1, len(caches))
+        cached = TridIndex.load(self.defs, cache_dir=self.tmpdir.name)
+        self.assertEqual(index.scan(MALWARE.joinpath("pe")),
+                         cached.scan(MALWARE.joinpath("pe")))
+
+        # a cache others can write is parsed again, not trusted
+        caches[0].write_text('{"digest": "%s", "definitions": []}' %
+                             index.digest)
+        os.chmod(caches[0], 0o666)
+        self.assertEqual(4, len(TridIndex.load(self.defs,
+                                               cache_dir=self.tmpdir.name)))
+
+    def test_tridScan(self):
+        TridIndex.set(self.defs, cache_dir=False)
+        with stage("trid", exporting=False) as timing:
+            results = tridScanMany([MALWARE.joinpath("pe")])
+        self.assertEqual(TridIndex.get().scan(MALWARE.joinpath("pe")),
+                         results[str(MALWARE.joinpath("pe"))])
+        self.assertEqual(0, timing.spawns)
+
+
+class TestRuntime(unittest.TestCase):
+    def test_timeoutFor(self):
+        self.assertLess(timeoutFor("trid"), timeoutFor("trid", 64 << 20))
+        self.assertEqual(timeoutFor("trid", 1 << 40),
+                         timeoutFor("trid", 1 << 41))
+
+    def test_circuitBreaker(self):
+        breaker = CircuitBreaker("tool", failures=2, cooldown=0.2)
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertFalse(breaker.allow())
+        time.sleep(0.2)
+        # a single probe after the cool-down
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.success()
+        self.assertTrue(breaker.allow())
+
+    def test_missingTool(self):
+        with self.assertRaises(ZhongkuiToolMissingError):
+            run("missingScan", ("zhongkui-missing-tool", ))
+        with self.assertRaises(ZhongkuiToolUnavailableError):
+            run("missingScan", ("zhongkui-missing-tool", ))
+
+    def test_timeout(self):
+        start = time.monotonic()
+        # the background child holds stdout open until the group is killed
+        with self.assertRaises(ZhongkuiScanTimeoutError):
+            run("sleepScan", ("sh", "-c", "sleep 30 & wait"), timeout=0.5)
+        self.assertLess(time.monotonic() - start, 10)
+
+    def test_spawns(self):
+        with stage("echo", exporting=False) as timing:
+            stdout = run("echoScan", ("echo", "zhongkui"))
+        self.assertEqual(b"zhongkui\n", stdout)
+        self.assertEqual(1, timing.spawns)